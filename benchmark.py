@@ -0,0 +1,397 @@
+# benchmark.py
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# Rows inserted per executemany() call while generating data
+INSERT_BATCH_SIZE = 5000
+# Number of distinct words titles, subjects and publishers are built from
+VOCABULARY_SIZE = 5000
+# Zipf exponent used for word, book and user popularity
+ZIPF_EXPONENT = 1.1
+# Password of every generated user
+PASSWORD = "password"
+# Relative regression in p95 latency or ops/sec tolerated by --baseline
+DEFAULT_TOLERANCE = 0.2
+
+SYLLABLES = ["ka", "ri", "to", "ma", "shi", "no", "ra", "ven", "el", "dor", "an", "is", "ur", "bel", "mor",
+             "ta", "li", "sa", "gen", "va", "ro", "mi", "de", "lo", "qu", "en", "har", "cal", "pe", "zu"]
+GENRES = ["Fiction", "Mystery", "Science", "History", "Biography", "Fantasy", "Poetry", "Children", "Travel", "Reference"]
+LANGUAGES = ["English", "Hindi", "Bengali", "Tamil", "French", "German"]
+MEMBERSHIPS = ["public", "student", "staff"]
+
+def zipf_weights(count, exponent=ZIPF_EXPONENT):
+    """
+    Returns cumulative Zipf weights for `count` items, for random.choices(cum_weights=...).
+    """
+    cumulative = []
+    total = 0.0
+    for rank in range(1, count + 1):
+        total += 1.0 / rank ** exponent
+        cumulative.append(total)
+    return cumulative
+
+class Workload:
+    """
+    Deterministic source of synthetic library data and operation arguments.
+    Popular words, books and users are drawn with a Zipf skew, so a few
+    titles account for most searches and checkouts, like in a real library.
+    """
+
+    def __init__(self, books, users, seed):
+        self.books = books
+        self.users = users
+        self.random = random.Random(seed)
+        self.vocabulary = self._make_vocabulary()
+        self.word_weights = zipf_weights(len(self.vocabulary))
+        self.book_weights = zipf_weights(books)
+        self.user_weights = zipf_weights(users)
+        self._lock = threading.Lock()
+
+    def _make_vocabulary(self):
+        words = set()
+        while len(words) < VOCABULARY_SIZE:
+            words.add("".join(self.random.choice(SYLLABLES) for _ in range(self.random.randint(2, 4))))
+        return sorted(words)
+
+    def word(self):
+        with self._lock:
+            return self.random.choices(self.vocabulary, cum_weights=self.word_weights)[0]
+
+    def book_id(self):
+        with self._lock:
+            return self.random.choices(range(1, self.books + 1), cum_weights=self.book_weights)[0]
+
+    def user_id(self):
+        with self._lock:
+            return self.random.choices(range(1, self.users + 1), cum_weights=self.user_weights)[0]
+
+    def uniform(self):
+        with self._lock:
+            return self.random.random()
+
+def _insert_batches(connection, query, rows):
+    cursor = connection.cursor()
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= INSERT_BATCH_SIZE:
+            cursor.executemany(query, batch)
+            connection.commit()
+            batch.clear()
+    if batch:
+        cursor.executemany(query, batch)
+        connection.commit()
+    cursor.close()
+
+def generate_data(workload, loans_per_user, reservations):
+    """
+    Populates users, books, transactions and reservations with synthetic
+    data and builds the search index.
+
+    Past loans are returned, a share of the recent ones are still open
+    (some of them overdue), and available_copies is kept consistent with
+    the open loans.
+
+    Parameters:
+    workload (Workload): Source of the synthetic data
+    loans_per_user (float): Average number of historical loans per user
+    reservations (int): Number of active reservations to create
+    """
+    from db_config import get_connection
+    from catalog_management import rebuild_search_index
+    from user_management import hash_password
+
+    rng = workload.random
+    today = datetime.now().date()
+    password = hash_password(PASSWORD)
+
+    def users():
+        for user_id in range(1, workload.users + 1):
+            # One user in ten owes a fine, so checkouts see refusals too
+            fines = 50 if rng.random() < 0.1 else 0
+            yield (f"user{user_id}", password, "borrower", f"User {user_id}", f"user{user_id}@example.org",
+                   "5550100", rng.choice(MEMBERSHIPS), fines)
+
+    def books():
+        for book_id in range(1, workload.books + 1):
+            title = " ".join(workload.word() for _ in range(rng.randint(1, 5))).title()
+            author = f"{workload.word().title()} {workload.word().title()}"
+            copies = rng.choice([1, 1, 1, 2, 2, 3, 5])
+            yield (title, author, f"{9780000000000 + book_id}", f"{workload.word().title()} Press", "1",
+                   rng.choice(GENRES), rng.choice(LANGUAGES), rng.randint(1950, 2024),
+                   f"{rng.randint(0, 999):03d}.{rng.randint(0, 99):02d}", ", ".join(workload.word() for _ in range(3)),
+                   copies, copies)
+
+    with get_connection() as connection:
+        _insert_batches(connection, """INSERT INTO users (username, password, role, full_name, email, phone, membership_category, fines)
+                                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""", users())
+        _insert_batches(connection, """INSERT INTO books (title, author, isbn, publisher, edition, genre, language, publication_year,
+                                       dewey_decimal, subject_tags, total_copies, available_copies)
+                                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""", books())
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT book_id, total_copies FROM books")
+        available = dict(cursor.fetchall())
+
+        def transactions():
+            for _ in range(int(workload.users * loans_per_user)):
+                user_id = workload.user_id()
+                book_id = workload.book_id()
+                issue_date = today - timedelta(days=rng.randint(0, 365))
+                due_date = issue_date + timedelta(days=14)
+                # Loans issued in the last month are still open while copies last
+                if (today - issue_date).days < 30 and available[book_id] > 0:
+                    available[book_id] -= 1
+                    yield (user_id, book_id, issue_date, due_date, None)
+                else:
+                    yield (user_id, book_id, issue_date, due_date, issue_date + timedelta(days=rng.randint(1, 21)))
+
+        _insert_batches(connection, """INSERT INTO transactions (user_id, book_id, issue_date, due_date, return_date)
+                                       VALUES (%s, %s, %s, %s, %s)""", transactions())
+        _insert_batches(connection, "UPDATE books SET available_copies = %s WHERE book_id = %s",
+                        ((copies, book_id) for book_id, copies in available.items()))
+        _insert_batches(connection, """INSERT INTO reservations (user_id, book_id, reservation_date, status)
+                                       VALUES (%s, %s, %s, 'active')""",
+                        ((workload.user_id(), workload.book_id(), today - timedelta(days=rng.randint(0, 30)))
+                         for _ in range(reservations)))
+        cursor.close()
+
+    rebuild_search_index()
+
+class Recorder:
+    """
+    Collects the latencies and errors of each operation of a workload run.
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def time(self, name, func, *args):
+        started = time.perf_counter()
+        try:
+            result = func(*args)
+            failed = isinstance(result, dict) and result.get("status") == "error"
+        except Exception as err:
+            print(f"Error in {name}: {err}")
+            result, failed = None, True
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            if failed:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            if isinstance(result, dict) and "status" in result:
+                statuses = self.statuses.setdefault(name, {})
+                statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+        return result
+
+    def report(self, elapsed):
+        operations = {}
+        for name, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            operations[name] = {
+                "count": len(latencies),
+                "errors": self.errors.get(name, 0),
+                "ops_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+            }
+            if name in self.statuses:
+                operations[name]["statuses"] = self.statuses[name]
+        return {"elapsed": elapsed, "operations": operations}
+
+def percentile(sorted_values, percent):
+    """
+    Returns the nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(percent * len(sorted_values) / 100) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+def _run(operations, workers, step):
+    recorder = Recorder()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda index: step(recorder, index), range(operations)))
+    return recorder.report(time.perf_counter() - started)
+
+def search_heavy(workload, operations, workers):
+    """
+    Patrons at the catalog terminals: mostly searches, plus opening book
+    details, the main window (loan dashboard) and logins.
+    """
+    from catalog_management import search_books_page, get_book_by_id
+    from circulation import get_loan_dashboard
+    from user_management import authenticate_user
+
+    def step(recorder, index):
+        roll = workload.uniform()
+        if roll < 0.7:
+            recorder.time("search_books_page", search_books_page, workload.word())
+        elif roll < 0.85:
+            recorder.time("get_book_by_id", get_book_by_id, workload.book_id())
+        elif roll < 0.95:
+            recorder.time("get_loan_dashboard", get_loan_dashboard, workload.user_id())
+        else:
+            recorder.time("authenticate_user", authenticate_user, f"user{workload.user_id()}", PASSWORD)
+
+    return _run(operations, workers, step)
+
+def checkout_rush(workload, operations, workers):
+    """
+    Every desk issuing books at once, concentrated on the popular titles,
+    so many checkouts race for the last copy.
+    """
+    from circulation import issue_book
+
+    def step(recorder, index):
+        recorder.time("issue_book", issue_book, workload.user_id(), workload.book_id())
+
+    return _run(operations, workers, step)
+
+def end_of_day_returns(workload, operations, workers):
+    """
+    The returns bin being emptied: open loans returned in parallel.
+    """
+    from db_config import get_connection
+    from circulation import return_book
+
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT transaction_id FROM transactions WHERE return_date IS NULL ORDER BY transaction_id LIMIT %s",
+                       (operations,))
+        transaction_ids = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+    workload.random.shuffle(transaction_ids)
+
+    def step(recorder, index):
+        recorder.time("return_book", return_book, transaction_ids[index])
+
+    return _run(len(transaction_ids), workers, step)
+
+WORKLOADS = {
+    "search_heavy": search_heavy,
+    "checkout_rush": checkout_rush,
+    "end_of_day_returns": end_of_day_returns,
+}
+
+def check_consistency():
+    """
+    Checks that no book was overbooked: available_copies never drops below
+    zero and always equals total_copies minus the open loans and the copies
+    set aside for holds.
+
+    Returns:
+    dict: Dictionary with the keys negative_available and mismatched_available (numbers of books)
+    """
+    from db_config import get_connection
+
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM books WHERE available_copies < 0")
+        negative = cursor.fetchone()[0]
+        cursor.execute("""SELECT COUNT(*) FROM books b
+                          LEFT JOIN (SELECT book_id, COUNT(*) AS open_loans FROM transactions
+                                     WHERE return_date IS NULL GROUP BY book_id) t ON t.book_id = b.book_id
+                          LEFT JOIN (SELECT book_id, COUNT(*) AS held FROM reservations
+                                     WHERE status = 'active' AND hold_expires IS NOT NULL GROUP BY book_id) r ON r.book_id = b.book_id
+                          WHERE b.available_copies <> b.total_copies - COALESCE(t.open_loans, 0) - COALESCE(r.held, 0)""")
+        mismatched = cursor.fetchone()[0]
+        cursor.close()
+    return {"negative_available": negative, "mismatched_available": mismatched}
+
+def compare(results, baseline, tolerance):
+    """
+    Compares a run against a saved baseline.
+
+    An operation regresses when its p95 latency grows, or its throughput
+    drops, by more than `tolerance` (a fraction).
+
+    Returns:
+    list: One message per regression
+    """
+    regressions = []
+    for workload_name, workload in results["workloads"].items():
+        baseline_operations = baseline.get("workloads", {}).get(workload_name, {}).get("operations", {})
+        for name, current in workload["operations"].items():
+            previous = baseline_operations.get(name)
+            if not previous:
+                continue
+            if current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{workload_name}/{name}: p95 {previous['p95_ms']:.2f}ms -> {current['p95_ms']:.2f}ms")
+            if current["ops_per_sec"] < previous["ops_per_sec"] * (1 - tolerance):
+                regressions.append(f"{workload_name}/{name}: {previous['ops_per_sec']:.0f} -> {current['ops_per_sec']:.0f} ops/s")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the library system against a synthetic local database.")
+    parser.add_argument("--books", type=int, default=10000, help="Number of books to generate")
+    parser.add_argument("--users", type=int, default=10000, help="Number of users to generate")
+    parser.add_argument("--loans-per-user", type=float, default=3.0, help="Average historical loans per user")
+    parser.add_argument("--reservations", type=int, default=1000, help="Number of active reservations to generate")
+    parser.add_argument("--operations", type=int, default=2000, help="Operations per workload")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent workers (desks)")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help="Comma-separated workloads to run")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed, runs with the same seed use the same data")
+    parser.add_argument("--database", help="SQLite file to use, a fresh temporary file if omitted")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--baseline", help="Compare against a JSON report saved earlier, exit with status 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Regression tolerance as a fraction")
+    args = parser.parse_args()
+
+    # The benchmark always runs against a local SQLite file, so it needs no
+    # network and never touches a production database. This must be set
+    # before db_config and event_log are imported.
+    database = args.database or os.path.join(tempfile.mkdtemp(prefix="library-benchmark-"), "benchmark.db")
+    os.environ["DB_BACKEND"] = "sqlite"
+    os.environ["DB_PATH"] = database
+    os.environ.setdefault("DB_POOL_SIZE", str(args.workers))
+    # Events are written next to the database, so the log's cost is measured but the real log is untouched
+    os.environ["EVENT_LOG_DIR"] = os.path.join(os.path.dirname(os.path.abspath(database)), "events")
+
+    workload = Workload(args.books, args.users, args.seed)
+    started = time.perf_counter()
+    generate_data(workload, args.loans_per_user, args.reservations)
+    print(f"Generated {args.books} books and {args.users} users in {time.perf_counter() - started:.1f}s ({database}).")
+
+    results = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "database")},
+        "workloads": {},
+    }
+    for name in args.workloads.split(","):
+        print(f"Running {name}...")
+        results["workloads"][name] = WORKLOADS[name](workload, args.operations, args.workers)
+    results["checks"] = check_consistency()
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report)
+    print(report)
+
+    if results["checks"]["negative_available"] or results["checks"]["mismatched_available"]:
+        print("Inconsistent available_copies after the run.")
+        sys.exit(1)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
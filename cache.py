@@ -0,0 +1,132 @@
+# cache.py
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Cache sizes (entries) and time to live (seconds), overridable from .env
+BOOK_CACHE_SIZE = int(os.environ.get('CACHE_BOOK_SIZE') or 10000)
+USER_CACHE_SIZE = int(os.environ.get('CACHE_USER_SIZE') or 5000)
+CACHE_TTL = float(os.environ.get('CACHE_TTL') or 60)
+
+class LRUCache:
+    """
+    A thread-safe least-recently-used cache whose entries also expire after
+    `ttl` seconds, so changes made by other desks are picked up eventually
+    even when this process does not invalidate them.
+    """
+
+    def __init__(self, name, maxsize, ttl=CACHE_TTL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """
+        Registers callback(key) to be called whenever key is invalidated,
+        and with None when the cache is cleared, for state derived from
+        the same records.
+        """
+        self._listeners.append(callback)
+
+    def get(self, key):
+        """
+        Returns the cached value of key, or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """
+        Caches value under key, evicting the least recently used entry if the cache is full.
+        """
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value of key, calling loader() and caching its
+        result on a miss. None results are not cached, so a record created
+        later is found on the next call.
+        """
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def invalidate(self, key):
+        """
+        Removes key from the cache.
+        """
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+        for callback in self._listeners:
+            callback(key)
+
+    def clear(self):
+        """
+        Removes every entry, e.g. after a bulk change.
+        """
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+        for callback in self._listeners:
+            callback(None)
+
+    def stats(self):
+        """
+        Returns the cache's counters.
+
+        Returns:
+        dict: Dictionary with the keys size, maxsize, hits, misses, hit_rate, evictions, expirations and invalidations
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+# Books by book_id
+book_cache = LRUCache("books", BOOK_CACHE_SIZE)
+# Outstanding fines by user_id
+user_fine_cache = LRUCache("user_fines", USER_CACHE_SIZE)
+# User ids by lower-cased username
+user_id_cache = LRUCache("user_ids", USER_CACHE_SIZE)
+
+def cache_stats():
+    """
+    Returns the counters of every cache, keyed by cache name.
+    """
+    return {cache.name: cache.stats() for cache in (book_cache, user_fine_cache, user_id_cache)}
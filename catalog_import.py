@@ -0,0 +1,404 @@
+# catalog_import.py
+from db_config import get_connection, Error
+from cache import book_cache
+from metrics import timed
+from catalog_management import canonical_isbn, index_book
+from typeahead import typeahead_index
+from fuzzy_search import trigram_index
+from facets import facet_index
+import event_log
+import argparse
+import csv
+import re
+import time
+
+# Number of records inserted per executemany() call and per transaction
+DEFAULT_BATCH_SIZE = 1000
+
+# Maximum lengths of the books columns, longer values are truncated
+COLUMN_LENGTHS = {
+    "title": 255,
+    "author": 255,
+    "isbn": 20,
+    "publisher": 100,
+    "edition": 50,
+    "genre": 50,
+    "language": 50,
+    "dewey_decimal": 20,
+    "subject_tags": 255,
+}
+BOOK_COLUMNS = ["title", "author", "isbn", "publisher", "edition", "genre", "language",
+                "publication_year", "dewey_decimal", "subject_tags", "total_copies"]
+
+# MARC language codes of the languages most often found in our catalog
+MARC_LANGUAGES = {
+    "eng": "English",
+    "hin": "Hindi",
+    "ben": "Bengali",
+    "tam": "Tamil",
+    "tel": "Telugu",
+    "mar": "Marathi",
+    "urd": "Urdu",
+    "san": "Sanskrit",
+    "fre": "French",
+    "ger": "German",
+    "spa": "Spanish",
+    "rus": "Russian",
+}
+
+UPSERT_QUERY = """INSERT INTO books
+                  (title, author, isbn, publisher, edition, genre, language, publication_year, dewey_decimal, subject_tags, total_copies, available_copies)
+                  VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                  ON DUPLICATE KEY UPDATE
+                  total_copies = total_copies + VALUES(total_copies),
+                  available_copies = available_copies + VALUES(available_copies)"""
+
+class InvalidRecord(Exception):
+    """
+    Raised when an imported record cannot be turned into a book.
+    """
+
+def read_csv_records(path):
+    """
+    Reads book records from a CSV file one row at a time.
+
+    The first row must be a header. Column names are matched to the books
+    columns case-insensitively, with spaces treated as underscores, so both
+    "publication_year" and "Publication Year" work.
+
+    Parameters:
+    path (str): Path of the CSV file
+
+    Yields:
+    dict: One record per row, keyed by books column name
+    """
+    with open(path, newline="", encoding="utf-8-sig") as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader, None)
+        if header is None:
+            return
+        columns = [name.strip().lower().replace(" ", "_") for name in header]
+        for row in reader:
+            yield {column: value for column, value in zip(columns, row) if column in BOOK_COLUMNS}
+
+def _marc_subfields(data):
+    """
+    Splits the data of a MARC variable data field into (code, value) pairs.
+    """
+    subfields = []
+    for chunk in data[2:].split("\x1f")[1:]:
+        if chunk:
+            subfields.append((chunk[0], chunk[1:].strip()))
+    return subfields
+
+def _marc_fields(record):
+    """
+    Parses one ISO 2709 record into a list of (tag, data) pairs.
+    """
+    leader = record[:24]
+    encoding = "utf-8" if leader[9:10] == b"a" else "latin-1"
+    base_address = int(leader[12:17])
+    directory = record[24:base_address - 1]
+    fields = []
+    for offset in range(0, len(directory) - len(directory) % 12, 12):
+        entry = directory[offset:offset + 12]
+        tag = entry[:3].decode("ascii")
+        length = int(entry[3:7])
+        start = int(entry[7:12])
+        data = record[base_address + start:base_address + start + length].rstrip(b"\x1e")
+        fields.append((tag, data.decode(encoding, errors="replace")))
+    return fields
+
+def _first_subfield(fields, tags, code):
+    for tag, data in fields:
+        if tag in tags:
+            for subfield_code, value in _marc_subfields(data):
+                if subfield_code == code and value:
+                    return value
+    return None
+
+def _strip_punctuation(value):
+    if value is None:
+        return None
+    return value.strip().rstrip(" /:;,.").strip() or None
+
+def marc_to_record(fields):
+    """
+    Maps parsed MARC21 bibliographic fields to a books record.
+
+    Parameters:
+    fields (list): (tag, data) pairs of one MARC record
+
+    Returns:
+    dict: The record, keyed by books column name
+    """
+    control = {tag: data for tag, data in fields if tag < "010"}
+    fixed = control.get("008", "")
+
+    title = _first_subfield(fields, ("245",), "a")
+    remainder = _first_subfield(fields, ("245",), "b")
+    if title and remainder:
+        title = f"{_strip_punctuation(title)}: {remainder}"
+
+    isbn = _first_subfield(fields, ("020",), "a")
+    if isbn:
+        # 020 $a often carries a qualifier such as "0140449132 (pbk.)"
+        isbn = isbn.split()[0]
+
+    year = _first_subfield(fields, ("264", "260"), "c")
+    year_match = re.search(r"\d{4}", year or "") or re.fullmatch(r"\d{4}", fixed[7:11])
+    language_code = fixed[35:38].strip() or _first_subfield(fields, ("041",), "a")
+
+    subjects = []
+    for tag, data in fields:
+        if tag in ("650", "651"):
+            subjects.extend(_strip_punctuation(value) for code, value in _marc_subfields(data) if code == "a")
+
+    # Koha and similar systems export one 952 (or 852) field per physical item
+    copies = sum(1 for tag, _ in fields if tag in ("952", "852"))
+
+    return {
+        "title": _strip_punctuation(title),
+        "author": _strip_punctuation(_first_subfield(fields, ("100", "110", "111"), "a")),
+        "isbn": isbn,
+        "publisher": _strip_punctuation(_first_subfield(fields, ("264", "260"), "b")),
+        "edition": _strip_punctuation(_first_subfield(fields, ("250",), "a")),
+        "genre": _strip_punctuation(_first_subfield(fields, ("655",), "a")),
+        "language": MARC_LANGUAGES.get(language_code, language_code) if language_code else None,
+        "publication_year": year_match.group(0) if year_match else None,
+        "dewey_decimal": _first_subfield(fields, ("082",), "a"),
+        "subject_tags": ", ".join(subject for subject in subjects if subject) or None,
+        "total_copies": copies or 1,
+    }
+
+def read_marc_records(path):
+    """
+    Reads book records from a MARC21 (ISO 2709) file one record at a time.
+
+    Parameters:
+    path (str): Path of the .mrc file
+
+    Yields:
+    dict: One record per MARC record, keyed by books column name, or an
+    InvalidRecord for a record that cannot be read
+    """
+    with open(path, "rb") as marc_file:
+        while True:
+            length = marc_file.read(5)
+            if len(length) < 5 or not length.strip():
+                return
+            if not length.isdigit():
+                # The next record cannot be found without its length, so the import stops here
+                # after the records read so far are written
+                yield InvalidRecord(f"Corrupt MARC record length {length!r}, stopped reading {path}")
+                return
+            record = length + marc_file.read(int(length) - 5)
+            try:
+                yield marc_to_record(_marc_fields(record))
+            except (ValueError, IndexError, UnicodeDecodeError) as err:
+                # Yield the failure so it is counted as a rejected record instead of ending the import
+                yield InvalidRecord(f"Unreadable MARC record: {err}")
+
+def normalize_record(record):
+    """
+    Validates a record and converts it to the values of one books row.
+
+    ISBNs are stripped of hyphens, their check digit is verified and ISBN-10s
+    are converted to ISBN-13, so the same book always lands on the same
+    `isbn` key. Text is trimmed to the column lengths.
+
+    Parameters:
+    record (dict): Record keyed by books column name
+
+    Returns:
+    tuple: Values for UPSERT_QUERY
+
+    Raises:
+    InvalidRecord: If the record has no title, an invalid ISBN or a non-numeric copy count
+    """
+    if isinstance(record, InvalidRecord):
+        raise record
+    values = {}
+    for column in BOOK_COLUMNS:
+        value = record.get(column)
+        if isinstance(value, str):
+            value = value.strip() or None
+        values[column] = value
+
+    if not values["title"]:
+        raise InvalidRecord("Missing title")
+
+    try:
+        values["isbn"] = canonical_isbn(values["isbn"])
+    except ValueError as err:
+        raise InvalidRecord(str(err))
+
+    try:
+        values["total_copies"] = int(values["total_copies"] or 1)
+    except ValueError:
+        raise InvalidRecord(f"Invalid total_copies {values['total_copies']!r}")
+    if values["total_copies"] < 1:
+        raise InvalidRecord(f"Invalid total_copies {values['total_copies']!r}")
+
+    year = values["publication_year"]
+    # The YEAR column only holds 1901-2155, older books are stored without a year
+    if year is not None:
+        try:
+            year = int(year)
+        except ValueError:
+            raise InvalidRecord(f"Invalid publication_year {year!r}")
+    values["publication_year"] = year if year is not None and 1901 <= year <= 2155 else None
+
+    for column, length in COLUMN_LENGTHS.items():
+        if values[column] is not None:
+            values[column] = str(values[column])[:length]
+
+    return tuple(values[column] for column in BOOK_COLUMNS) + (values["total_copies"],)
+
+def _write_batch(connection, cursor, batch):
+    """
+    Upserts one batch of rows and indexes the newly inserted books, in one transaction.
+
+    New books are told apart from merged ones by the batch's own ISBNs, whose
+    existing rows are locked first so no other desk can add them meanwhile,
+    and by the ids of the rows without an ISBN, which are always inserted.
+
+    Returns the number of new books inserted.
+    """
+    isbns = list(dict.fromkeys(row[2] for row in batch if row[2]))
+    isbn_sql = ', '.join(['%s'] * len(isbns))
+    existing = {}
+    if isbns:
+        cursor.execute(f"SELECT isbn, book_id FROM books WHERE isbn IN ({isbn_sql}) FOR UPDATE", isbns)
+        existing = dict(cursor.fetchall())
+
+    with_isbn = [row for row in batch if row[2]]
+    if with_isbn:
+        cursor.executemany(UPSERT_QUERY, with_isbn)
+    # Rows without an ISBN never merge, one statement each gives their ids
+    new_book_ids = []
+    for row in batch:
+        if not row[2]:
+            cursor.execute(UPSERT_QUERY, row)
+            new_book_ids.append(cursor.lastrowid)
+
+    book_ids = {}
+    if isbns:
+        cursor.execute(f"SELECT isbn, book_id FROM books WHERE isbn IN ({isbn_sql})", isbns)
+        book_ids = dict(cursor.fetchall())
+    new_book_ids += [book_id for isbn, book_id in book_ids.items() if isbn not in existing]
+
+    copies_added = {}
+    for row in batch:
+        if row[2] in existing:
+            copies_added[existing[row[2]]] = copies_added.get(existing[row[2]], 0) + row[11]
+
+    # Existing books only had their copies merged, so only new rows need search terms
+    dict_cursor = connection.cursor(dictionary=True)
+    new_books = []
+    if new_book_ids:
+        id_sql = ', '.join(['%s'] * len(new_book_ids))
+        dict_cursor.execute(f"""SELECT book_id, title, author, publisher, genre, language, publication_year, subject_tags, total_copies,
+                                       dewey_decimal, available_copies
+                                FROM books WHERE book_id IN ({id_sql})""", new_book_ids)
+        new_books = dict_cursor.fetchall()
+        dict_cursor.execute(f"DELETE FROM book_search_terms WHERE book_id IN ({id_sql})", new_book_ids)
+        for book in new_books:
+            index_book(dict_cursor, book["book_id"], book)
+            copies_added[book["book_id"]] = book["total_copies"]
+    dict_cursor.close()
+    connection.commit()
+    event_log.record_many({'type': event_log.COPIES_ADDED, 'book_id': book_id, 'copies': copies}
+                          for book_id, copies in copies_added.items() if copies)
+    # Only merged books have new copy counts, new ones were not cached
+    for book_id in existing.values():
+        book_cache.invalidate(book_id)
+    for book in new_books:
+        typeahead_index.add(book["book_id"], book["title"], book["author"], book["total_copies"])
+        trigram_index.add_book(book)
+        facet_index.add(book)
+    return len(new_books)
+
+@timed
+def import_books(records, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+    """
+    Imports book records into the catalog in batches.
+
+    Records are upserted on the unique `isbn` key: a book that already exists
+    has the imported copies added to its total_copies and available_copies.
+    Each batch is written with executemany() and committed as its own
+    transaction, so only one batch is held in memory at a time and a failure
+    loses at most the batch in flight.
+
+    Parameters:
+    records (iterable): Records keyed by books column name, e.g. from read_csv_records or read_marc_records
+    batch_size (int): Number of records per batch and per transaction
+    progress (callable): Called with the running stats dictionary after every batch
+
+    Returns:
+    dict: Dictionary with the keys read, inserted, merged, rejected, elapsed (seconds) and rate (records per second)
+    """
+    stats = {"read": 0, "inserted": 0, "merged": 0, "rejected": 0, "elapsed": 0.0, "rate": 0.0}
+    started = time.monotonic()
+
+    with get_connection() as connection:
+        if not connection:
+            return stats
+        cursor = connection.cursor()
+        batch = []
+
+        def flush():
+            inserted = _write_batch(connection, cursor, batch)
+            stats["inserted"] += inserted
+            stats["merged"] += len(batch) - inserted
+            batch.clear()
+            stats["elapsed"] = time.monotonic() - started
+            stats["rate"] = stats["read"] / stats["elapsed"] if stats["elapsed"] else 0.0
+            if progress:
+                progress(stats)
+
+        try:
+            for record in records:
+                stats["read"] += 1
+                try:
+                    batch.append(normalize_record(record))
+                except InvalidRecord as err:
+                    stats["rejected"] += 1
+                    print(f"Skipping record {stats['read']}: {err}")
+                    continue
+                if len(batch) >= batch_size:
+                    flush()
+            if batch:
+                flush()
+        except Error as err:
+            connection.rollback()
+            print(f"Error: {err}")
+        finally:
+            cursor.close()
+
+    stats["elapsed"] = time.monotonic() - started
+    stats["rate"] = stats["read"] / stats["elapsed"] if stats["elapsed"] else 0.0
+    return stats
+
+def print_progress(stats):
+    """
+    Prints a one-line progress report for import_books.
+    """
+    print(f"{stats['read']} read, {stats['inserted']} inserted, {stats['merged']} merged, "
+          f"{stats['rejected']} rejected - {stats['rate']:.0f} records/s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import books into the catalog from CSV or MARC21 files.")
+    parser.add_argument("path", help="CSV or MARC21 (.mrc) file to import")
+    parser.add_argument("--format", choices=["csv", "marc"], help="File format, guessed from the file extension if omitted")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Records per batch and transaction")
+    args = parser.parse_args()
+
+    file_format = args.format or ("marc" if args.path.lower().endswith((".mrc", ".marc")) else "csv")
+    records = read_marc_records(args.path) if file_format == "marc" else read_csv_records(args.path)
+    stats = import_books(records, batch_size=args.batch_size, progress=print_progress)
+    print(f"Done in {stats['elapsed']:.1f}s.")
+    print_progress(stats)
+
+if __name__ == "__main__":
+    main()
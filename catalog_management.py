@@ -1,6 +1,156 @@
-from db_config import create_connection
-import mysql.connector
+from db_config import get_connection, wrote_recently, Error
+from cache import book_cache
+from metrics import timed
+from facets import facet_index, facet_counts, facets_ready, normalize_filters, filter_conditions, FACET_RESULT_CAP
+import event_log
+import re
+import sys
+import unicodedata
 
+# Weight each indexed column contributes to a matching term's relevance score
+SEARCH_FIELD_WEIGHTS = {
+    "title": 5,
+    "author": 4,
+    "subject_tags": 3,
+    "publisher": 2,
+    "genre": 2,
+    "language": 1,
+    "publication_year": 1,
+}
+# Longest term stored in the search index, matches book_search_terms.term
+MAX_TERM_LENGTH = 64
+# Shortest query token that is also matched as a prefix of longer terms
+MIN_PREFIX_LENGTH = 3
+# Default number of results per page of search_books_page()
+SEARCH_PAGE_SIZE = 50
+# search_books_page() stops counting matches at this many
+COUNT_ESTIMATE_CAP = 10000
+# Books are re-indexed this many at a time by rebuild_search_index()
+REINDEX_CHUNK_SIZE = 1000
+
+def tokenize(text):
+    """
+    Splits text into normalized search terms.
+
+    Text is lower-cased and accents are stripped so that e.g. "Gödel" and
+    "godel" produce the same term.
+
+    Parameters:
+    text (str): Text to tokenize
+
+    Returns:
+    list: List of terms in the order they appear
+    """
+    if text is None:
+        return []
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return [term[:MAX_TERM_LENGTH] for term in re.findall(r"[^\W_]+", text)]
+
+def index_terms(book):
+    """
+    Computes the weighted search terms of a book.
+
+    Parameters:
+    book (dict): Book details keyed by column name
+
+    Returns:
+    dict: Mapping of term to its summed field weight
+    """
+    terms = {}
+    for field, weight in SEARCH_FIELD_WEIGHTS.items():
+        for term in set(tokenize(book.get(field))):
+            terms[term] = terms.get(term, 0) + weight
+    return terms
+
+def normalize_isbn(value):
+    """
+    Strips hyphens and spaces from an ISBN.
+
+    Parameters:
+    value (str): ISBN as typed
+
+    Returns:
+    str: The bare ISBN, or None if the value does not look like an ISBN-10 or ISBN-13
+    """
+    isbn = re.sub(r"[\s-]", "", str(value)).upper()
+    if re.fullmatch(r"\d{9}[\dX]|\d{13}", isbn):
+        return isbn
+    return None
+
+def isbn_is_valid(isbn):
+    """
+    Checks the check digit of a bare ISBN-10 or ISBN-13.
+
+    Parameters:
+    isbn (str): ISBN as returned by normalize_isbn
+
+    Returns:
+    bool: True if the check digit is correct
+    """
+    if len(isbn) == 10:
+        total = sum((10 - i) * (10 if ch == "X" else int(ch)) for i, ch in enumerate(isbn))
+        return total % 11 == 0
+    if len(isbn) == 13 and isbn.isdigit():
+        total = sum((3 if i % 2 else 1) * int(ch) for i, ch in enumerate(isbn))
+        return total % 10 == 0
+    return False
+
+def isbn_to_13(isbn):
+    """
+    Converts a bare ISBN-10 to ISBN-13. ISBN-13s are returned unchanged.
+
+    Parameters:
+    isbn (str): ISBN as returned by normalize_isbn
+
+    Returns:
+    str: The ISBN-13
+    """
+    if len(isbn) != 10:
+        return isbn
+    digits = "978" + isbn[:9]
+    check = (10 - sum((3 if i % 2 else 1) * int(ch) for i, ch in enumerate(digits)) % 10) % 10
+    return digits + str(check)
+
+def canonical_isbn(value):
+    """
+    Converts an ISBN as typed to the form stored in books.isbn, so books added by
+    hand and by import share one unique key.
+
+    Parameters:
+    value (str): ISBN as typed, or None
+
+    Returns:
+    str: The bare ISBN-13, or None if value is blank
+
+    Raises:
+    ValueError: If value is not a valid ISBN-10 or ISBN-13
+    """
+    if value is None or not str(value).strip():
+        return None
+    isbn = normalize_isbn(value)
+    if not isbn or not isbn_is_valid(isbn):
+        raise ValueError(f"Invalid ISBN {value!r}")
+    return isbn_to_13(isbn)
+
+def index_book(cursor, book_id, book):
+    """
+    Writes the search terms of a book to book_search_terms.
+
+    The caller owns the transaction and must remove any existing terms of
+    the book first.
+
+    Parameters:
+    cursor: Cursor of the connection to write with
+    book_id (int): ID of the book
+    book (dict): Book details keyed by column name
+    """
+    terms = index_terms(book)
+    if terms:
+        cursor.executemany("INSERT INTO book_search_terms (term, book_id, weight) VALUES (%s, %s, %s)",
+                           [(term, book_id, weight) for term, weight in terms.items()])
+
+@timed
 def add_book(title, author, isbn, publisher, edition, genre, language, publication_year, dewey_decimal, subject_tags, total_copies):
     """
     Add a book to the catalog.
@@ -8,7 +158,7 @@ def add_book(title, author, isbn, publisher, edition, genre, language, publicati
     Parameters:
     title (str): Book title
     author (str): Book author
-    isbn (str): Book ISBN
+    isbn (str): Book ISBN, stored as ISBN-13
     publisher (str): Book publisher
     edition (str): Book edition
     genre (str): Book genre
@@ -19,71 +169,414 @@ def add_book(title, author, isbn, publisher, edition, genre, language, publicati
     total_copies (int): Total number of copies of the book
 
     Returns:
-    None
-    """
-    connection = create_connection()
-    if connection:
-        cursor = connection.cursor()
-        query = """INSERT INTO books 
-                   (title, author, isbn, publisher, edition, genre, language, publication_year, dewey_decimal, subject_tags, total_copies, available_copies)
-                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
-        values = (title, author, isbn, publisher, edition, genre, language, publication_year, dewey_decimal, subject_tags, total_copies, total_copies)
-        try:
-            cursor.execute(query, values)
-            connection.commit()
-            print("Book added successfully.")
-        except mysql.connector.Error as err:
-            print(f"Error: {err}")
-        finally:
-            cursor.close()
-            connection.close()
+    int: ID of the new book, or None if it could not be added
+    """
+    try:
+        isbn = canonical_isbn(isbn)
+    except ValueError as err:
+        print(f"Error: {err}")
+        return None
+
+    book_id = None
+    with get_connection() as connection:
+        if connection:
+            cursor = connection.cursor()
+            query = """INSERT INTO books 
+                       (title, author, isbn, publisher, edition, genre, language, publication_year, dewey_decimal, subject_tags, total_copies, available_copies)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+            values = (title, author, isbn, publisher, edition, genre, language, publication_year, dewey_decimal, subject_tags, total_copies, total_copies)
+            try:
+                cursor.execute(query, values)
+                book_id = cursor.lastrowid
+                # Index the new book in the same transaction so search never misses it
+                index_book(cursor, book_id, {
+                    "title": title,
+                    "author": author,
+                    "publisher": publisher,
+                    "genre": genre,
+                    "language": language,
+                    "publication_year": publication_year,
+                    "subject_tags": subject_tags,
+                })
+                connection.commit()
+                event_log.record(event_log.COPIES_ADDED, book_id=book_id, copies=total_copies)
+                book_cache.invalidate(book_id)
+                # Imported here as these modules import this one
+                from typeahead import typeahead_index
+                from fuzzy_search import trigram_index
+                typeahead_index.add(book_id, title, author, total_copies)
+                trigram_index.add_book({"title": title, "author": author, "subject_tags": subject_tags})
+                facet_index.add({"book_id": book_id, "genre": genre, "language": language, "publication_year": publication_year,
+                                 "dewey_decimal": dewey_decimal, "available_copies": total_copies})
+                print("Book added successfully.")
+            except Error as err:
+                connection.rollback()
+                book_id = None
+                print(f"Error: {err}")
+            finally:
+                cursor.close()
+    return book_id
+
+def _token_condition(token):
+    if len(token) >= MIN_PREFIX_LENGTH:
+        return "term LIKE %s", token + "%"
+    return "term = %s", token
+
+def _term_conditions(tokens):
+    conditions = []
+    params = []
+    for token in tokens:
+        condition, param = _token_condition(token)
+        conditions.append(condition)
+        params.append(param)
+    return " OR ".join(conditions), params
 
-def search_books(keyword):
+def _token_scores(tokens):
+    # One row per book and token with the token's best matching term, so a
+    # prefix that matches several terms of a book counts once
+    selects = []
+    params = []
+    for token in tokens:
+        condition, param = _token_condition(token)
+        selects.append(f"SELECT book_id, MAX(weight) AS weight FROM book_search_terms WHERE {condition} GROUP BY book_id")
+        params.append(param)
+    return " UNION ALL ".join(selects), params
+
+def _ranked_query(tokens, after=None, limit=None, filters=None):
+    """
+    Builds the ranked search query for a list of tokens.
+
+    Rows are ordered by (score DESC, book_id ASC). When `after` is given,
+    only rows that sort after that (score, book_id) pair are returned.
+    `filters` restricts the books to facet values, see facets.normalize_filters.
+    """
+    scores, params = _token_scores(tokens)
+    having = ""
+    if after is not None:
+        having = "HAVING score < %s OR (score = %s AND book_id > %s)"
+        params += [after[0], after[0], after[1]]
+    where = ""
+    if filters:
+        filter_sql, filter_params = filter_conditions(filters)
+        where = "WHERE " + " AND ".join(filter_sql)
+        params += filter_params
+    query = f"""SELECT b.*, s.score FROM books b
+                JOIN (SELECT book_id, SUM(weight) AS score FROM ({scores}) matches
+                      GROUP BY book_id {having}) s ON s.book_id = b.book_id
+                {where}
+                ORDER BY s.score DESC, b.book_id"""
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+    return query, params
+
+def _find_by_isbn(cursor, keyword):
+    isbn = normalize_isbn(keyword)
+    if not isbn:
+        return []
+    cursor.execute("SELECT * FROM books WHERE isbn IN (%s, %s, %s)", (isbn, isbn_to_13(isbn), keyword.strip()))
+    return cursor.fetchall()
+
+@timed
+def search_books(keyword, limit=None, fuzzy=False):
     """
     Search for books in the catalog by keyword.
 
+    A keyword that looks like an ISBN is looked up directly on the unique
+    isbn column. Otherwise the keyword is tokenized and matched against the
+    book_search_terms index over title, author, subject tags, publisher,
+    genre, language and publication year. Tokens of three or more characters
+    also match longer terms they are a prefix of. Results are ranked by the
+    summed weight of each token's best matching term.
+
+    With fuzzy set, a keyword that matches nothing is searched again
+    allowing for typos with fuzzy_search.fuzzy_search_books.
+
     Parameters:
     keyword (str): Keyword to search for
+    limit (int): Maximum number of results to return, or None for all
+    fuzzy (bool): Whether to fall back to a typo-tolerant search
 
     Returns:
-    list: List of dictionaries containing the book details, or an empty list if there are no results
+    list: List of dictionaries containing the book details, best match first, or an empty list if there are no results
     """
-    connection = create_connection()
-    if connection:
+    tokens = list(dict.fromkeys(tokenize(keyword)))
+    if not tokens:
+        return []
+
+    results = []
+    with get_connection(readonly=True) as connection:
+        if connection:
+            cursor = connection.cursor(dictionary=True)
+            results = _find_by_isbn(cursor, keyword)
+            if not results:
+                query, params = _ranked_query(tokens, limit=limit)
+                cursor.execute(query, params)
+                results = cursor.fetchall()
+            cursor.close()
+    if not results and fuzzy:
+        from fuzzy_search import fuzzy_search_books, FUZZY_RESULT_LIMIT
+        results = fuzzy_search_books(keyword, limit or FUZZY_RESULT_LIMIT)
+    return results
+
+@timed
+def search_books_page(keyword, page_size=SEARCH_PAGE_SIZE, after=None, fuzzy=False, filters=None, with_facets=False):
+    """
+    Returns one page of search results, ranked the same way as search_books.
+
+    Pages are addressed with keyset cursors rather than offsets: pass the
+    `next_cursor` of a page as `after` to get the page that follows it, so
+    deep pages cost no more than the first one.
+
+    Parameters:
+    keyword (str): Keyword to search for
+    page_size (int): Maximum number of results on the page
+    after (tuple): The `next_cursor` of the previous page, or None for the first page
+    fuzzy (bool): Whether a first page that matches nothing is searched again allowing for typos.
+        The typo-tolerant results are returned as a single page. Not done when filters are given.
+    filters (dict): Facet values to narrow the results to, e.g. {"genre": "Fiction", "availability": "available"}.
+        See facets.FACETS for the facet names.
+    with_facets (bool): Whether to count the first page's matching books per facet value
+
+    Raises:
+    ValueError: If filters names an unknown facet or has a malformed value
+
+    Returns:
+    dict: Dictionary with the keys
+        results (list): The book dictionaries on this page
+        next_cursor (tuple): Cursor of the next page, or None if this is the last page
+        total_estimate (int): Number of matching books, counted up to COUNT_ESTIMATE_CAP. Only computed for the first page, None otherwise
+        total_is_exact (bool): False if the count stopped at COUNT_ESTIMATE_CAP
+        fuzzy (bool): True if the results are typo-tolerant matches
+        fuzzy_pending (bool): True if typo-tolerant matches were wanted but the trigram index is still being built
+        facets (dict): With with_facets, the (value, count) tuples of each facet for the first page,
+            counted from precomputed facet bitmaps over up to FACET_RESULT_CAP matching books. None otherwise,
+            or while the facet index is still being built
+    """
+    page = {"results": [], "next_cursor": None, "total_estimate": None, "total_is_exact": True, "fuzzy": False, "fuzzy_pending": False,
+            "facets": None}
+    filters = normalize_filters(filters)
+    # Searches do not wait for the facet index, they are counted without it until it is built
+    with_facets = with_facets and facets_ready()
+    tokens = list(dict.fromkeys(tokenize(keyword)))
+    if not tokens:
+        page["total_estimate"] = 0
+        return page
+    matching_ids = None
+
+    with get_connection(readonly=True) as connection:
+        if connection:
+            cursor = connection.cursor(dictionary=True)
+            results = _find_by_isbn(cursor, keyword) if after is None else []
+            if results:
+                # An ISBN names the book exactly, filters do not apply
+                filters = {}
+                page["results"] = results
+                page["total_estimate"] = len(results)
+                if with_facets:
+                    matching_ids = [book["book_id"] for book in results]
+            else:
+                query, params = _ranked_query(tokens, after=after, limit=page_size + 1, filters=filters)
+                cursor.execute(query, params)
+                results = cursor.fetchall()
+                if len(results) > page_size:
+                    results = results[:page_size]
+                    page["next_cursor"] = (results[-1]["score"], results[-1]["book_id"])
+                page["results"] = results
+
+                if after is None:
+                    conditions, params = _term_conditions(tokens)
+                    if with_facets:
+                        # The facet bitmaps narrow and count the matches, so no join with books is needed
+                        id_cursor = connection.cursor()
+                        id_cursor.execute(f"SELECT DISTINCT book_id FROM book_search_terms WHERE {conditions} LIMIT %s",
+                                          params + [FACET_RESULT_CAP])
+                        matching_ids = [row[0] for row in id_cursor.fetchall()]
+                        id_cursor.close()
+                    elif page["next_cursor"] is None:
+                        page["total_estimate"] = len(results)
+                    elif filters:
+                        filter_sql, filter_params = filter_conditions(filters)
+                        cursor.execute(f"""SELECT COUNT(*) AS total FROM
+                                           (SELECT DISTINCT s.book_id FROM book_search_terms s JOIN books b ON b.book_id = s.book_id
+                                            WHERE ({conditions}) AND {" AND ".join(filter_sql)} LIMIT %s) t""",
+                                       params + filter_params + [COUNT_ESTIMATE_CAP])
+                        page["total_estimate"] = cursor.fetchone()["total"]
+                        page["total_is_exact"] = page["total_estimate"] < COUNT_ESTIMATE_CAP
+                    else:
+                        cursor.execute(f"""SELECT COUNT(*) AS total FROM
+                                           (SELECT DISTINCT book_id FROM book_search_terms WHERE {conditions} LIMIT %s) t""",
+                                       params + [COUNT_ESTIMATE_CAP])
+                        page["total_estimate"] = cursor.fetchone()["total"]
+                        page["total_is_exact"] = page["total_estimate"] < COUNT_ESTIMATE_CAP
+            cursor.close()
+
+    if matching_ids is not None:
+        # Counted once the connection is back in the pool, as the index may read availability
+        page["total_estimate"], page["facets"] = facet_counts(matching_ids, filters)
+        page["total_is_exact"] = len(matching_ids) < FACET_RESULT_CAP
+    if fuzzy and not filters and after is None and not page["results"]:
+        from fuzzy_search import fuzzy_search_books, fuzzy_ready
+        if fuzzy_ready():
+            results = fuzzy_search_books(keyword, page_size)
+            page.update(results=results, total_estimate=len(results), total_is_exact=True, fuzzy=bool(results))
+        else:
+            page["fuzzy_pending"] = True
+    return page
+
+@timed
+def iter_search_books(keyword, fetch_size=SEARCH_PAGE_SIZE):
+    """
+    Streams search results, ranked the same way as search_books.
+
+    Rows are read from an unbuffered server-side cursor `fetch_size` at a
+    time, so memory use does not grow with the number of matches. The
+    generator holds a pooled connection until it is exhausted or closed.
+
+    Parameters:
+    keyword (str): Keyword to search for
+    fetch_size (int): Number of rows fetched from the server at a time
+
+    Yields:
+    dict: Book details, best match first
+    """
+    tokens = list(dict.fromkeys(tokenize(keyword)))
+    if not tokens:
+        return
+
+    with get_connection(readonly=True) as connection:
+        if not connection:
+            return
         cursor = connection.cursor(dictionary=True)
-        query = """SELECT * FROM books WHERE 
-                   title LIKE %s OR 
-                   author LIKE %s OR 
-                   isbn LIKE %s OR 
-                   genre LIKE %s OR 
-                   language LIKE %s OR 
-                   publication_year LIKE %s"""
-        like_keyword = f"%{keyword}%"
-        cursor.execute(query, (like_keyword, like_keyword, like_keyword, like_keyword, like_keyword, like_keyword))
-        results = cursor.fetchall()
+        results = _find_by_isbn(cursor, keyword)
         cursor.close()
-        connection.close()
-        return results
-    return []
+        if results:
+            yield from results
+            return
+
+        cursor = connection.cursor(dictionary=True, buffered=False)
+        finished = False
+        try:
+            query, params = _ranked_query(tokens)
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    finished = True
+                    break
+                yield from rows
+        finally:
+            if not finished and connection.unread_result:
+                # Drain the rest of the result set so the connection can go back to the pool
+                connection.consume_results()
+            cursor.close()
+
+@timed
+def rebuild_search_index():
+    """
+    Rebuilds the book_search_terms index from the books table.
+
+    Books are read and re-indexed in chunks of REINDEX_CHUNK_SIZE, each in
+    its own transaction, so the catalog stays searchable while this runs.
+
+    Returns:
+    int: Number of books indexed
+    """
+    indexed = 0
+    last_book_id = 0
+    with get_connection() as connection:
+        if not connection:
+            return 0
+        cursor = connection.cursor(dictionary=True)
+        try:
+            while True:
+                cursor.execute("""SELECT book_id, title, author, publisher, genre, language, publication_year, subject_tags
+                                  FROM books WHERE book_id > %s ORDER BY book_id LIMIT %s""",
+                               (last_book_id, REINDEX_CHUNK_SIZE))
+                books = cursor.fetchall()
+                if not books:
+                    break
+                # Also clears terms of deleted books whose ids fall inside this chunk's range
+                cursor.execute("DELETE FROM book_search_terms WHERE book_id > %s AND book_id <= %s", (last_book_id, books[-1]["book_id"]))
+                last_book_id = books[-1]["book_id"]
+                for book in books:
+                    index_book(cursor, book["book_id"], book)
+                connection.commit()
+                indexed += len(books)
+            # Drop terms left behind by deleted books
+            cursor.execute("DELETE FROM book_search_terms WHERE book_id > %s", (last_book_id,))
+            connection.commit()
+        except Error as err:
+            connection.rollback()
+            print(f"Error: {err}")
+        finally:
+            cursor.close()
+    print(f"Indexed {indexed} books.")
+    return indexed
 
+def _load_book(book_id):
+    # Books are cached for every thread, so shortly after any write of this process they are
+    # read from the primary; a replica's older copy count would otherwise stay cached for CACHE_TTL
+    with get_connection(readonly=not wrote_recently(any_thread=True)) as connection:
+        if connection:
+            cursor = connection.cursor(dictionary=True)
+            query = "SELECT * FROM books WHERE book_id = %s"
+            cursor.execute(query, (book_id,))
+            result = cursor.fetchone()
+            cursor.close()
+            return result
+    return None
 
+@timed
 def get_book_by_id(book_id):
     """
     Get a book from the catalog by its ID.
 
+    Books are served from cache.book_cache when possible. The returned
+    dictionary is shared with the cache and must not be modified.
+
     Parameters:
     book_id (int): ID of the book
 
     Returns:
     dict: Dictionary containing the book details, or None if the book is not found
     """
-    connection = create_connection()
-    if connection:
-        cursor = connection.cursor(dictionary=True)
-        query = "SELECT * FROM books WHERE book_id = %s"
-        cursor.execute(query, (book_id,))
-        result = cursor.fetchone()
-        cursor.close()
-        connection.close()
-        return result
-    return None
\ No newline at end of file
+    return book_cache.get_or_load(book_id, lambda: _load_book(book_id))
+
+@timed
+def preload_books(recent_loans=200):
+    """
+    Loads the books of the most recent loans into cache.book_cache with one
+    query, e.g. at startup, as they are the likeliest to be looked up next.
+
+    Parameters:
+    recent_loans (int): Number of most recent loans whose books are loaded
+
+    Returns:
+    int: Number of books cached
+    """
+    # See _load_book
+    with get_connection(readonly=not wrote_recently(any_thread=True)) as connection:
+        if connection:
+            cursor = connection.cursor(dictionary=True)
+            try:
+                cursor.execute("""SELECT * FROM books WHERE book_id IN
+                                  (SELECT book_id FROM (SELECT book_id FROM transactions
+                                                        ORDER BY transaction_id DESC LIMIT %s) recent)""",
+                               (recent_loans,))
+                books = cursor.fetchall()
+            except Error as err:
+                print(f"Error: {err}")
+                return 0
+            finally:
+                cursor.close()
+            for book in books:
+                book_cache.put(book["book_id"], book)
+            return len(books)
+    return 0
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--rebuild-search-index"]:
+        rebuild_search_index()
+    else:
+        print("Usage: python3 catalog_management.py --rebuild-search-index")
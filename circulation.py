@@ -1,8 +1,47 @@
-from db_config import create_connection
-import mysql.connector
+from db_config import get_connection, Error
+from fines import FINE_RATES, accrue_transaction_fine, accrue_transaction_fines
+from cache import book_cache, user_fine_cache
+from holds import priority_sql, release_copies, release_book_copies, collect_hold, get_hold
+from metrics import timed
+import event_log
+import random
+import time
 from datetime import datetime, timedelta
-from tkinter import messagebox
 
+# Loan period in days
+LOAN_PERIOD_DAYS = 14
+# Loans due within this many days are flagged as due soon
+DUE_SOON_DAYS = 3
+# Result codes of issue_book, return_book, place_hold and cancel_hold
+ISSUED = 'issued'
+RETURNED = 'returned'
+OUTSTANDING_FINES = 'outstanding_fines'
+NOT_AVAILABLE = 'not_available'
+NOT_FOUND = 'not_found'
+DB_ERROR = 'error'
+HOLD_PLACED = 'hold_placed'
+HOLD_CANCELLED = 'hold_cancelled'
+ALREADY_HELD = 'already_held'
+BOOK_AVAILABLE = 'book_available'
+
+RESULT_MESSAGES = {
+    ISSUED: "Book issued successfully.",
+    RETURNED: "Book returned on time.",
+    OUTSTANDING_FINES: "User has outstanding fines.",
+    NOT_AVAILABLE: "Book is not available.",
+    NOT_FOUND: "Transaction not found or book already returned.",
+    DB_ERROR: "Could not connect to the database.",
+    HOLD_PLACED: "Hold placed.",
+    HOLD_CANCELLED: "Hold cancelled.",
+    ALREADY_HELD: "User already has a hold on this book.",
+    BOOK_AVAILABLE: "A copy is available, borrow it instead of placing a hold.",
+}
+
+# MySQL error numbers after which a transaction is retried: deadlock and lock wait timeout
+RETRYABLE_ERRORS = (1213, 1205)
+MAX_RETRIES = 5
+
+@timed
 def get_transactions(user_id):
     """
     Returns the list of books borrowed by a user.
@@ -11,92 +50,489 @@ def get_transactions(user_id):
     user_id (int): The user ID.
 
     Returns:
-    list: The list of books borrowed by the user.
-    """
-    connection = create_connection()
-    cursor = connection.cursor(dictionary=True)
-    query = "SELECT * FROM transactions WHERE user_id = %s AND return_date IS NULL"
-    cursor.execute(query, (user_id,))
-    books = cursor.fetchall()   
-    cursor.close()
-    connection.close()
+    list: The list of books borrowed by the user, empty if the database could not be reached.
+    """
+    books = []
+    with get_connection(readonly=True) as connection:
+        if not connection:
+            return books
+        cursor = connection.cursor(dictionary=True)
+        query = "SELECT * FROM transactions WHERE user_id = %s AND return_date IS NULL"
+        cursor.execute(query, (user_id,))
+        books = cursor.fetchall()   
+        cursor.close()
     return books
 
+@timed
+def get_loan_dashboard(user_id):
+    """
+    Returns a user's active loans with their book details, due-soon/overdue
+    flags and accrued fines, together with the user's outstanding fines.
+
+    Everything is read in a single query.
+
+    Parameters:
+    user_id (int): The user ID.
+
+    Returns:
+    dict: Dictionary with the keys
+        outstanding_fines: The fines already charged to the user.
+        loans (list): One dictionary per active loan, soonest due first, with the transaction
+            columns, the book's title, author and isbn, and the keys due_soon (bool),
+            overdue (bool), days_overdue (int) and accrued_fine (the loan's total fine if
+            returned today, the part already charged by fines.accrue_fines is included in
+            outstanding_fines).
+        None if the database could not be reached.
+    """
+    with get_connection() as connection:
+        if not connection:
+            return None
+        cursor = connection.cursor(dictionary=True)
+        query = """SELECT u.fines, u.membership_category,
+                          t.transaction_id, t.book_id, t.issue_date, t.due_date,
+                          b.title, b.author, b.isbn
+                   FROM users u
+                   LEFT JOIN transactions t ON t.user_id = u.user_id AND t.return_date IS NULL
+                   LEFT JOIN books b ON b.book_id = t.book_id
+                   WHERE u.user_id = %s
+                   ORDER BY t.due_date, t.transaction_id"""
+        cursor.execute(query, (user_id,))
+        rows = cursor.fetchall()
+        cursor.close()
+
+    dashboard = {"outstanding_fines": rows[0]['fines'] if rows else 0, "loans": []}
+    today = datetime.now().date()
+    for row in rows:
+        if row['transaction_id'] is None:
+            continue
+        days_overdue = max((today - row['due_date']).days, 0)
+        dashboard["loans"].append({
+            'transaction_id': row['transaction_id'],
+            'book_id': row['book_id'],
+            'issue_date': row['issue_date'],
+            'due_date': row['due_date'],
+            'title': row['title'],
+            'author': row['author'],
+            'isbn': row['isbn'],
+            'overdue': days_overdue > 0,
+            'due_soon': days_overdue == 0 and (row['due_date'] - today).days <= DUE_SOON_DAYS,
+            'days_overdue': days_overdue,
+            'accrued_fine': days_overdue * FINE_RATES.get(row['membership_category'], 0),
+        })
+    return dashboard
+
+def _result(status, message=None, **details):
+    result = {'status': status, 'message': message or RESULT_MESSAGES[status]}
+    result.update(details)
+    return result
+
+def _run_transaction(func, *args):
+    """
+    Runs func(connection, cursor, *args) on a pooled connection, retrying
+    with jittered backoff when the transaction is picked as a deadlock
+    victim or times out waiting for a lock.
+    """
+    for attempt in range(MAX_RETRIES):
+        with get_connection() as connection:
+            if not connection:
+                return _result(DB_ERROR)
+            cursor = connection.cursor()
+            try:
+                return func(connection, cursor, *args)
+            except Error as err:
+                connection.rollback()
+                if err.errno not in RETRYABLE_ERRORS or attempt == MAX_RETRIES - 1:
+                    print(f"Error: {err}")
+                    return _result(DB_ERROR, f"{err}")
+            finally:
+                cursor.close()
+        time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+def _issue_book(connection, cursor, user_id, book_id):
+    # A copy set aside for the user's hold is not counted in available_copies
+    collected = collect_hold(cursor, user_id, book_id)
+    if not collected:
+        # Take a copy only if one is left and the user owes nothing. The row lock
+        # taken by the UPDATE serializes desks issuing the same book, and the
+        # condition is re-checked against the latest committed count.
+        cursor.execute("""UPDATE books SET available_copies = available_copies - 1
+                          WHERE book_id = %s AND available_copies > 0
+                          AND NOT EXISTS (SELECT 1 FROM users WHERE user_id = %s AND fines > 0)""",
+                       (book_id, user_id))
+        if cursor.rowcount != 1:
+            connection.rollback()
+            cursor.execute("SELECT (SELECT fines FROM users WHERE user_id = %s), (SELECT available_copies FROM books WHERE book_id = %s)",
+                           (user_id, book_id))
+            fines, available_copies = cursor.fetchone()
+            if fines is not None and fines > 0:
+                return _result(OUTSTANDING_FINES)
+            return _result(NOT_AVAILABLE)
+
+    issue_date = datetime.now().date()
+    due_date = issue_date + timedelta(days=LOAN_PERIOD_DAYS)
+    cursor.execute("""INSERT INTO transactions (user_id, book_id, issue_date, due_date)
+                      VALUES (%s, %s, %s, %s)""", (user_id, book_id, issue_date, due_date))
+    transaction_id = cursor.lastrowid
+    connection.commit()
+    event_log.record(event_log.LOAN_ISSUED, user_id, book_id, transaction_id, copies=0 if collected else -1)
+    return _result(ISSUED, transaction_id=transaction_id, due_date=due_date)
+
+@timed
 def issue_book(user_id, book_id):
     """
     Issues a book to a user.
 
+    The copy is taken with a single conditional UPDATE, so concurrent desks
+    can never issue more copies than are available. Shows no dialogs, so it
+    can run on a worker thread; the caller reports the returned message.
+
     :param user_id: The ID of the user
     :param book_id: The ID of the book
-    :return: None
+    :return: A dictionary with the keys status (ISSUED, OUTSTANDING_FINES, NOT_AVAILABLE or DB_ERROR)
+             and message, plus transaction_id and due_date when the book was issued
     """
-    
-    connection = create_connection()
-    if connection:
-        cursor = connection.cursor()
-        # Make sure user has no fines
-        cursor.execute("SELECT fines FROM users WHERE user_id = %s", (user_id,))
-        result = cursor.fetchone()
-        if result and result[0] > 0:
-            messagebox.showerror("Error", "User has outstanding fines.")
-            return
-        # Check availability
-        cursor.execute("SELECT available_copies FROM books WHERE book_id = %s", (book_id,))
-        result = cursor.fetchone()
-        if result and result[0] > 0:
-            due_date = datetime.now().date() + timedelta(days=14)  # 2 weeks loan period
-            query = """INSERT INTO transactions (user_id, book_id, issue_date, due_date)
-                       VALUES (%s, %s, %s, %s)"""
-            values = (user_id, book_id, datetime.now().date(), due_date)
-            try:
-                cursor.execute(query, values)
-                # Decrement available copies
-                cursor.execute("UPDATE books SET available_copies = available_copies - 1 WHERE book_id = %s", (book_id,))
-                connection.commit()
-                messagebox.showinfo("Success", "Book issued successfully.")
-            except mysql.connector.Error as err:
-                print(f"Error: {err}")
-        else:
-            messagebox.showerror("Error","Book is not available.")
-        cursor.close()
-        connection.close()
+    result = _run_transaction(_issue_book, user_id, book_id)
+    # Even a refusal means the cached copy count may be stale
+    book_cache.invalidate(book_id)
+    return result
+
+def _return_book(connection, cursor, transaction_id):
+    return_date = datetime.now().date()
+    # Charge whatever the nightly fine run has not charged yet, before the loan is closed
+    fine = accrue_transaction_fine(cursor, transaction_id, return_date)
+    # Only the first of two concurrent returns of the same loan gets a row back
+    cursor.execute("UPDATE transactions SET return_date = %s WHERE transaction_id = %s AND return_date IS NULL",
+                   (return_date, transaction_id))
+    if cursor.rowcount != 1:
+        connection.rollback()
+        return _result(NOT_FOUND)
 
+    cursor.execute("SELECT book_id, user_id, due_date FROM transactions WHERE transaction_id = %s", (transaction_id,))
+    book_id, user_id, due_date = cursor.fetchone()
+    # The copy goes to the next hold in the queue, or back on the shelf
+    promoted = release_copies(cursor, book_id, 1, return_date)
+    connection.commit()
+    event_log.record(event_log.LOAN_RETURNED, user_id, book_id, transaction_id, copies=0 if promoted else 1, amount=fine)
+    return _returned(book_id, user_id, due_date, return_date, fine, promoted[0] if promoted else None)
+
+def _returned(book_id, user_id, due_date, return_date, fine, promoted):
+    days_late = (return_date - due_date).days
+    message = None
+    if fine > 0:
+        message = f"Book returned with a fine of {fine}."
+    elif days_late > 0:
+        # The nightly fine run already charged the days it was late
+        message = f"Book returned {days_late} days late."
+    hold = None
+    if promoted:
+        hold = {'reservation_id': promoted[0], 'user_id': promoted[1]}
+        message = f"{message or RESULT_MESSAGES[RETURNED]} Keep it for the hold of user {hold['user_id']}."
+    return _result(RETURNED, message, book_id=book_id, user_id=user_id, fine=fine, hold=hold)
+
+@timed
 def return_book(transaction_id):
     """
     Returns a book given its transaction_id.
 
+    The loan is closed with a conditional UPDATE, so a loan can only be
+    returned once even if two desks return it at the same time. Shows no
+    dialogs; the caller reports the returned message.
+
     :param transaction_id: The unique id of the transaction.
-    :return: None
+    :return: A dictionary with the keys status (RETURNED, NOT_FOUND or DB_ERROR) and message,
+             plus book_id, user_id, fine (the part of the loan's fine charged on return,
+             see fines.accrue_fines) and hold (reservation_id and user_id of the hold the
+             copy was set aside for, or None) when the book was returned
     """
+    result = _run_transaction(_return_book, transaction_id)
+    if result['status'] == RETURNED:
+        book_cache.invalidate(result['book_id'])
+        user_fine_cache.invalidate(result['user_id'])
+    return result
 
-    connection = create_connection()
-    if connection:
-        cursor = connection.cursor()
-        # Get book_id from transaction
-        cursor.execute("SELECT book_id, due_date FROM transactions WHERE transaction_id = %s AND return_date IS NULL", (transaction_id,))
-        result = cursor.fetchone()
-        if result:
-            book_id, due_date = result
-            return_date = datetime.now().date()
-            # Update transaction
-            cursor.execute("UPDATE transactions SET return_date = %s WHERE transaction_id = %s", (return_date, transaction_id))
-            # Increment available copies
-            cursor.execute("UPDATE books SET available_copies = available_copies + 1 WHERE book_id = %s", (book_id,))
-            # Get user membership
-            cursor.execute("SELECT membership FROM users WHERE user_id = (SELECT user_id FROM transactions WHERE transaction_id = %s)", (transaction_id,))
-            membership = cursor.fetchone()[0]
-            # Calculate fines if any and if user membership is not staff
-            if return_date > due_date and membership != 'staff':
-                days_over = (return_date - due_date).days
-                fine = days_over * (10 if membership == 'public' else 5)  # Assume 10 rupees per day for public 5 rupees for student
-                cursor.execute("SELECT user_id FROM transactions WHERE transaction_id = %s", (transaction_id,))
-                user_id = cursor.fetchone()[0]
-                cursor.execute("UPDATE users SET fines = fines + %s WHERE user_id = %s", (fine, user_id))
-                messagebox.showinfo("Success", f"Book returned with a fine of ${fine}.")
-            else:
-                messagebox.showinfo("Success", "Book returned on time.")
-            connection.commit()
+def _placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+def _issue_books(connection, cursor, user_id, book_ids):
+    cursor.execute("SELECT fines FROM users WHERE user_id = %s FOR UPDATE", (user_id,))
+    row = cursor.fetchone()
+    if row is None or row[0] > 0:
+        connection.rollback()
+        status, message = (NOT_FOUND, "User not found.") if row is None else (OUTSTANDING_FINES, None)
+        return [_result(status, message, book_id=book_id) for book_id in book_ids]
+
+    distinct = sorted(set(book_ids))
+    cursor.execute(f"""SELECT book_id, reservation_id FROM reservations
+                       WHERE user_id = %s AND book_id IN ({_placeholders(distinct)})
+                       AND status = 'active' AND hold_expires IS NOT NULL FOR UPDATE""", [user_id] + distinct)
+    held = dict(cursor.fetchall())
+    # Locked in a fixed order, so two sessions with the same books cannot deadlock
+    cursor.execute(f"SELECT book_id, available_copies FROM books WHERE book_id IN ({_placeholders(distinct)}) ORDER BY book_id FOR UPDATE",
+                   distinct)
+    available = dict(cursor.fetchall())
+
+    # Decide every item against the locked counts, then write them all at once
+    items, collected, taken = [], [], {}
+    # ids of the items issued from a held copy, which leave available_copies as it is
+    from_hold = set()
+    for book_id in book_ids:
+        if book_id not in available:
+            items.append(_result(NOT_FOUND, "Book not found.", book_id=book_id))
+        elif book_id in held and held[book_id] not in collected:
+            # A copy set aside for the user's hold is not counted in available_copies
+            collected.append(held[book_id])
+            items.append(_result(ISSUED, book_id=book_id))
+            from_hold.add(id(items[-1]))
+        elif available[book_id] - taken.get(book_id, 0) > 0:
+            taken[book_id] = taken.get(book_id, 0) + 1
+            items.append(_result(ISSUED, book_id=book_id))
         else:
-            messagebox.showerror("Error","Transaction not found or book already returned.")
+            items.append(_result(NOT_AVAILABLE, book_id=book_id))
+
+    issued = [item for item in items if item['status'] == ISSUED]
+    if not issued:
+        connection.rollback()
+        return items
+    if collected:
+        cursor.execute(f"UPDATE reservations SET status = 'completed' WHERE reservation_id IN ({_placeholders(collected)})", collected)
+    if taken:
+        cursor.execute(f"""UPDATE books SET available_copies = available_copies - CASE book_id {" ".join(["WHEN %s THEN %s"] * len(taken))} END
+                           WHERE book_id IN ({_placeholders(taken)})""",
+                       [value for pair in taken.items() for value in pair] + list(taken))
+    issue_date = datetime.now().date()
+    due_date = issue_date + timedelta(days=LOAN_PERIOD_DAYS)
+    cursor.execute(f"INSERT INTO transactions (user_id, book_id, issue_date, due_date) VALUES {', '.join(['(%s, %s, %s, %s)'] * len(issued))}",
+                   [value for item in issued for value in (user_id, item['book_id'], issue_date, due_date)])
+    # The ids of a multi-row insert are not reported by every backend, so read
+    # them back: the newest open loans of each book are the ones just inserted
+    issued_books = sorted({item['book_id'] for item in issued})
+    cursor.execute(f"""SELECT transaction_id, book_id FROM transactions
+                       WHERE user_id = %s AND return_date IS NULL AND issue_date = %s AND book_id IN ({_placeholders(issued_books)})
+                       ORDER BY transaction_id DESC""", [user_id, issue_date] + issued_books)
+    newest = {}
+    for transaction_id, book_id in cursor.fetchall():
+        newest.setdefault(book_id, []).append(transaction_id)
+    new_ids = {book_id: sorted(ids[:sum(1 for item in issued if item['book_id'] == book_id)]) for book_id, ids in newest.items()}
+    for item in issued:
+        item.update(transaction_id=new_ids[item['book_id']].pop(0), due_date=due_date)
+    connection.commit()
+    event_log.record_many({'type': event_log.LOAN_ISSUED, 'user_id': user_id, 'book_id': item['book_id'],
+                           'ref_id': item['transaction_id'], 'copies': 0 if id(item) in from_hold else -1} for item in issued)
+    return items
+
+@timed
+def issue_books(user_id, book_ids):
+    """
+    Issues several books to a user in one database transaction, e.g. a
+    barcode-scanner session at the desk.
+
+    The user's fines, held copies and the books' available copies are read
+    and locked once for the whole session, and the loans are written with
+    one statement each, so a session takes a handful of round trips
+    whatever its size. A book scanned twice is issued twice if two copies
+    are available.
+
+    :param user_id: The ID of the user
+    :param book_ids: The IDs of the books, in scan order
+    :return: A dictionary with the keys status (ISSUED if any book was issued, otherwise the status
+             of the first item, or DB_ERROR), message, issued (count) and items (one result per
+             book_id in scan order, as returned by issue_book plus book_id)
+    """
+    book_ids = list(book_ids)
+    if not book_ids:
+        return _result(NOT_FOUND, "No books scanned.", issued=0, items=[])
+    items = _run_transaction(_issue_books, user_id, book_ids)
+    for book_id in set(book_ids):
+        book_cache.invalidate(book_id)
+    if isinstance(items, dict):
+        return dict(items, issued=0, items=[])
+    issued = sum(1 for item in items if item['status'] == ISSUED)
+    status = ISSUED if issued else items[0]['status']
+    return _result(status, f"Issued {issued} of {len(items)} books.", issued=issued, items=items)
+
+def _return_books(connection, cursor, transaction_ids):
+    distinct = sorted(set(transaction_ids))
+    cursor.execute(f"""SELECT transaction_id, book_id, user_id, due_date FROM transactions
+                       WHERE transaction_id IN ({_placeholders(distinct)}) AND return_date IS NULL
+                       ORDER BY transaction_id FOR UPDATE""", distinct)
+    loans = {row[0]: row for row in cursor.fetchall()}
+    return_date = datetime.now().date()
+    fines, promoted = {}, {}
+    if loans:
+        # Charge whatever the nightly fine run has not charged yet, before the loans are closed
+        fines = accrue_transaction_fines(cursor, list(loans), return_date)
+        cursor.execute(f"UPDATE transactions SET return_date = %s WHERE transaction_id IN ({_placeholders(loans)})",
+                       [return_date] + list(loans))
+        copies = {}
+        for _, book_id, _, _ in loans.values():
+            copies[book_id] = copies.get(book_id, 0) + 1
+        # The copies go to the next holds in their queues, or back on the shelf
+        promoted = release_book_copies(cursor, copies, return_date)
+        connection.commit()
+
+    items, events = [], []
+    for transaction_id in transaction_ids:
+        loan = loans.pop(transaction_id, None)
+        if loan is None:
+            items.append(_result(NOT_FOUND, transaction_id=transaction_id))
+            continue
+        _, book_id, user_id, due_date = loan
+        holds = promoted.get(book_id)
+        hold = holds.pop(0) if holds else None
+        item = _returned(book_id, user_id, due_date, return_date, fines.get(transaction_id, 0), hold)
+        item['transaction_id'] = transaction_id
+        items.append(item)
+        events.append({'type': event_log.LOAN_RETURNED, 'user_id': user_id, 'book_id': book_id, 'ref_id': transaction_id,
+                       'copies': 0 if hold else 1, 'amount': item['fine']})
+    event_log.record_many(events)
+    return items
+
+@timed
+def return_books(transaction_ids):
+    """
+    Returns several books in one database transaction, e.g. a book drop
+    emptied at the desk.
+
+    The loans are locked, charged their fines, closed and their copies
+    handed to waiting holds or shelved with one statement each, so a
+    session takes a handful of round trips whatever its size.
+
+    :param transaction_ids: The IDs of the loans, in scan order
+    :return: A dictionary with the keys status (RETURNED if any book was returned, otherwise
+             NOT_FOUND, or DB_ERROR), message, returned (count), total_fine, fines_by_user
+             (fine charged by user_id) and items (one result per transaction_id in scan order,
+             as returned by return_book plus transaction_id)
+    """
+    transaction_ids = list(transaction_ids)
+    if not transaction_ids:
+        return _result(NOT_FOUND, "No books scanned.", returned=0, total_fine=0, fines_by_user={}, items=[])
+    items = _run_transaction(_return_books, transaction_ids)
+    if isinstance(items, dict):
+        return dict(items, returned=0, total_fine=0, fines_by_user={}, items=[])
+    fines_by_user = {}
+    returned = [item for item in items if item['status'] == RETURNED]
+    for item in returned:
+        fines_by_user[item['user_id']] = fines_by_user.get(item['user_id'], 0) + item['fine']
+        book_cache.invalidate(item['book_id'])
+        user_fine_cache.invalidate(item['user_id'])
+    total_fine = sum(fines_by_user.values())
+    message = f"Returned {len(returned)} of {len(items)} books."
+    if total_fine > 0:
+        message = f"{message} Fines charged: {total_fine}."
+    return _result(RETURNED if returned else NOT_FOUND, message, returned=len(returned), total_fine=total_fine,
+                   fines_by_user=fines_by_user, items=items)
+
+def _place_hold(connection, cursor, user_id, book_id):
+    # Locks the book against a concurrent return, see holds.release_copies
+    cursor.execute("SELECT available_copies FROM books WHERE book_id = %s FOR UPDATE", (book_id,))
+    row = cursor.fetchone()
+    if row is None:
+        connection.rollback()
+        return _result(NOT_FOUND, "Book not found.")
+    if row[0] > 0:
+        connection.rollback()
+        return _result(BOOK_AVAILABLE)
+    cursor.execute("SELECT COUNT(*) FROM reservations WHERE user_id = %s AND book_id = %s AND status = 'active'",
+                   (user_id, book_id))
+    if cursor.fetchone()[0]:
+        connection.rollback()
+        return _result(ALREADY_HELD)
+
+    cursor.execute(f"""INSERT INTO reservations (user_id, book_id, reservation_date, status, priority)
+                       SELECT user_id, %s, %s, 'active', {priority_sql('membership_category')}
+                       FROM users WHERE user_id = %s""", (book_id, datetime.now().date(), user_id))
+    if cursor.rowcount != 1:
+        connection.rollback()
+        return _result(NOT_FOUND, "User not found.")
+    reservation_id = cursor.lastrowid
+    hold = get_hold(cursor, reservation_id)
+    connection.commit()
+    event_log.record(event_log.HOLD_PLACED, user_id, book_id, reservation_id)
+    return _result(HOLD_PLACED, f"Hold placed, number {hold['position']} in line.", **hold)
+
+@timed
+def place_hold(user_id, book_id):
+    """
+    Places a hold on a book that has no copy available.
+
+    Holds on a book are served first by membership category (see
+    holds.HOLD_PRIORITIES) and then in the order they were placed. When a
+    copy comes back it is set aside for the first hold, which the user
+    collects with issue_book.
+
+    :param user_id: The ID of the user
+    :param book_id: The ID of the book
+    :return: A dictionary with the keys status (HOLD_PLACED, BOOK_AVAILABLE, ALREADY_HELD, NOT_FOUND
+             or DB_ERROR) and message, plus the keys of holds.get_user_holds when the hold was placed
+    """
+    return _run_transaction(_place_hold, user_id, book_id)
+
+def _cancel_hold(connection, cursor, reservation_id):
+    cursor.execute("SELECT book_id, hold_expires, user_id FROM reservations WHERE reservation_id = %s AND status = 'active' FOR UPDATE",
+                   (reservation_id,))
+    row = cursor.fetchone()
+    if row is None:
+        connection.rollback()
+        return _result(NOT_FOUND, "Reservation not found or no longer active.")
+    book_id, hold_expires, user_id = row
+    cursor.execute("UPDATE reservations SET status = 'cancelled' WHERE reservation_id = %s", (reservation_id,))
+    promoted = []
+    if hold_expires is not None:
+        # The copy set aside for this hold passes to the next one
+        promoted = release_copies(cursor, book_id, 1)
+    connection.commit()
+    # The copy set aside goes back on the shelf unless the next hold takes it
+    event_log.record(event_log.HOLD_CANCELLED, user_id, book_id, reservation_id,
+                     copies=1 if hold_expires is not None and not promoted else 0)
+    return _result(HOLD_CANCELLED, book_id=book_id,
+                   hold={'reservation_id': promoted[0][0], 'user_id': promoted[0][1]} if promoted else None)
+
+@timed
+def cancel_hold(reservation_id):
+    """
+    Cancels a hold. If a copy was set aside for it, the copy passes to the next hold.
+
+    :param reservation_id: The ID of the reservation
+    :return: A dictionary with the keys status (HOLD_CANCELLED, NOT_FOUND or DB_ERROR) and message,
+             plus book_id and hold (the hold the copy was passed to, or None) when cancelled
+    """
+    result = _run_transaction(_cancel_hold, reservation_id)
+    if result['status'] == HOLD_CANCELLED:
+        book_cache.invalidate(result['book_id'])
+    return result
+
+@timed
+def get_loan_owners(transaction_ids):
+    """
+    Returns who borrowed each of the given loans, so callers can check who may return them.
+
+    :param transaction_ids: The IDs of the loans
+    :return: A dictionary of user ID by transaction ID, leaving out loans that do not exist,
+             or None if the database could not be reached
+    """
+    with get_connection() as connection:
+        if not connection:
+            return None
+        cursor = connection.cursor()
+        cursor.execute(f"SELECT transaction_id, user_id FROM transactions WHERE transaction_id IN ({_placeholders(transaction_ids)})",
+                       tuple(transaction_ids))
+        owners = dict(cursor.fetchall())
+        cursor.close()
+    return owners
+
+@timed
+def get_hold_owner(reservation_id):
+    """
+    Returns who placed a hold, so callers can check who may cancel it.
+
+    :param reservation_id: The ID of the reservation
+    :return: The user ID, or None if there is no such hold or the database could not be reached
+    """
+    with get_connection() as connection:
+        if not connection:
+            return None
+        cursor = connection.cursor()
+        cursor.execute("SELECT user_id FROM reservations WHERE reservation_id = %s", (reservation_id,))
+        row = cursor.fetchone()
         cursor.close()
-        connection.close()
+    return row[0] if row else None
@@ -1,37 +1,531 @@
+import functools
+import itertools
 import os
-import mysql.connector
-from mysql.connector import Error
+import threading
+import time
+from contextlib import contextmanager
 
-#Load .env file manually to load env secerts
+#Load .env file manually to load env secerts. Variables already set in the
+#environment win, so tools like benchmark.py can point the app elsewhere.
+#Only the file is read here; modules such as metrics and cache read their
+#settings from the environment when they are imported, so it must come first.
 if os.path.exists('.env'):
     for line in open('.env'):
         var = line.strip().split('=')
         if len(var) == 2:
-            os.environ[var[0]] = var[1]
+            os.environ.setdefault(var[0], var[1])
 
-# Check if secrets are loaded
-if not os.environ.get('DB_HOST') or not os.environ.get('DB_USER') or not os.environ.get('DB_PASSWORD'):
-    raise Exception("Missing environment variables. Please add .env file with DB_HOST, DB_USER, and DB_PASSWORD. Example: DB_HOST=127.0.0.1\nDB_USER=root\nDB_PASSWORD=password")
+import metrics
 
-def create_connection():
+# Backend, driver and pool settings are resolved by configure() on first
+# use, so importing this module does not import the database driver.
+# Reading one of these names from the module configures it.
+_CONFIGURED_NAMES = ('Error', 'DB_BACKEND', 'DB_PATH', 'POOL_SIZE', 'POOL_TIMEOUT', 'POOL_RECYCLE', 'POOL_PING_INTERVAL',
+                     'REPLICAS', 'REPLICA_SELECTION', 'REPLICA_MAX_LAG', 'REPLICA_CHECK_INTERVAL', 'REPLICA_LAG_QUERY')
+_configured = False
+_configure_lock = threading.Lock()
+
+def configure():
+    """
+    Resolves the storage backend and pool settings from the environment and
+    imports the database driver, once per process.
+
+    Storage backend: DB_BACKEND 'mysql' (default) or 'sqlite' for an
+    embedded database file. Pool settings are DB_POOL_SIZE,
+    DB_POOL_TIMEOUT, DB_POOL_RECYCLE and DB_POOL_PING_INTERVAL. Read
+    replicas are DB_REPLICAS, see get_connection().
+    """
+    global _configured, Error, DB_BACKEND, DB_PATH, POOL_SIZE, POOL_TIMEOUT, POOL_RECYCLE, POOL_PING_INTERVAL
+    global REPLICAS, REPLICA_SELECTION, REPLICA_MAX_LAG, REPLICA_CHECK_INTERVAL, REPLICA_LAG_QUERY
+    global sqlite_backend, mysql
+    if _configured:
+        return
+    with _configure_lock:
+        if _configured:
+            return
+        backend = (os.environ.get('DB_BACKEND') or 'mysql').lower()
+        if backend == 'sqlite':
+            import sqlite_backend
+            # Modules catch this instead of a driver specific error so they run on either backend
+            from sqlite_backend import Error
+            DB_PATH = os.environ.get('DB_PATH') or 'library_management.db'
+        elif backend == 'mysql':
+            import mysql.connector
+            from mysql.connector import Error
+            # Check if secrets are loaded
+            if not os.environ.get('DB_HOST') or not os.environ.get('DB_USER') or not os.environ.get('DB_PASSWORD'):
+                raise Exception("Missing environment variables. Please add .env file with DB_HOST, DB_USER, and DB_PASSWORD. Example: DB_HOST=127.0.0.1\nDB_USER=root\nDB_PASSWORD=password")
+        else:
+            raise Exception(f"Unknown DB_BACKEND '{backend}'. Use 'mysql' or 'sqlite'.")
+        DB_BACKEND = backend
+
+        # Pool settings, overridable from .env
+        POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 5)
+        POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT') or 10)
+        POOL_RECYCLE = float(os.environ.get('DB_POOL_RECYCLE') or 1800)
+        POOL_PING_INTERVAL = float(os.environ.get('DB_POOL_PING_INTERVAL') or 30)
+
+        # Read replicas: comma-separated host[:port] for MySQL, sharing the primary's
+        # user, password and database, or database files for SQLite stand-ins
+        REPLICAS = [name.strip() for name in (os.environ.get('DB_REPLICAS') or '').split(',') if name.strip()]
+        # 'round_robin' spreads reads evenly, 'least_latency' prefers the fastest replica
+        REPLICA_SELECTION = (os.environ.get('DB_REPLICA_SELECTION') or 'round_robin').lower()
+        if REPLICA_SELECTION not in ('round_robin', 'least_latency'):
+            raise Exception(f"Unknown DB_REPLICA_SELECTION '{REPLICA_SELECTION}'. Use 'round_robin' or 'least_latency'.")
+        # Replicas further behind than this many seconds are not read from
+        REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG') or 5)
+        # Seconds between lag and latency checks of the replicas
+        REPLICA_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL') or 5)
+        # Query returning a replica's lag in seconds, instead of SHOW REPLICA STATUS, e.g. for a heartbeat table
+        REPLICA_LAG_QUERY = os.environ.get('DB_REPLICA_LAG_QUERY')
+        _configured = True
+
+def __getattr__(name):
+    if name in _CONFIGURED_NAMES:
+        configure()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def create_connection(replica=None):
     """
-    Creates a connection to the MySQL database using environment variables.
+    Creates a connection to the configured database, or to one of its read replicas.
 
-    The connection is configured to the 'library_management' database if no
-    'DB_NAME' environment variable is set.
+    For MySQL the connection uses the DB_HOST, DB_USER and DB_PASSWORD
+    environment variables and is configured to the 'library_management'
+    database if no 'DB_NAME' environment variable is set. For SQLite the
+    database file is DB_PATH, 'library_management.db' by default.
+
+    A replica is named as in DB_REPLICAS: host[:port] for MySQL, which
+    replaces DB_HOST, or a database file for SQLite.
 
     Returns the connection object if successful, otherwise None.
     """
+    configure()
+    if DB_BACKEND == 'sqlite':
+        try:
+            return sqlite_backend.connect(replica or DB_PATH)
+        except Error as e:
+            print(f"Error: {e}")
+            return None
+    host, port = os.environ.get('DB_HOST'), None
+    if replica:
+        host, _, port = replica.partition(':')
     try:
         connection = mysql.connector.connect(
-            host=os.environ.get('DB_HOST'),
+            host=host,
+            port=int(port) if port else 3306,
             database=os.environ.get('DB_NAME') or 'library_management',
             user=os.environ.get('DB_USER'),
             password=os.environ.get('DB_PASSWORD')
         )
         if connection.is_connected():
-            print("Connected to MySQL database")
+            print(f"Connected to MySQL replica {replica}" if replica else "Connected to MySQL database")
             return connection
     except Error as e:
         print(f"Error: {e}")
         return None
+
+class PoolTimeoutError(Exception):
+    """
+    Raised when no pooled connection could be checked out before the timeout.
+    """
+
+class ConnectionPool:
+    """
+    A thread-safe, size-bounded pool of database connections.
+
+    Connections are opened lazily up to `size`. Idle connections are pinged
+    before reuse once they have been idle for `ping_interval` seconds, and
+    connections older than `recycle` seconds are closed and replaced.
+    """
+
+    def __init__(self, factory, size=None, timeout=None, recycle=None, ping_interval=None):
+        # Settings left out default to the configured DB_POOL_* values
+        configure()
+        self.factory = factory
+        self.size = size or POOL_SIZE
+        self.timeout = timeout or POOL_TIMEOUT
+        self.recycle = recycle or POOL_RECYCLE
+        self.ping_interval = ping_interval or POOL_PING_INTERVAL
+        self._idle = []
+        self._created_at = {}
+        self._open = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """
+        Checks a connection out of the pool.
+
+        Parameters:
+        timeout (float): Seconds to wait for a free connection, defaults to the pool timeout.
+
+        Returns:
+        connection: A healthy connection, or None if a new connection could not be opened.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    connection, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError(f"No database connection available after {timeout} seconds.")
+                self._condition.wait(remaining)
+
+        now = time.monotonic()
+        if connection is not None:
+            if now - self._created_at.get(id(connection), now) > self.recycle:
+                self._close(connection)
+                connection = None
+            elif now - last_used > self.ping_interval and not self._is_healthy(connection):
+                self._close(connection)
+                connection = None
+
+        if connection is None:
+            connection = self.factory()
+            if connection is None:
+                with self._condition:
+                    self._open -= 1
+                    self._condition.notify()
+                return None
+            self._created_at[id(connection)] = time.monotonic()
+        return connection
+
+    def release(self, connection):
+        """
+        Returns a connection to the pool, rolling back any unfinished transaction.
+
+        Parameters:
+        connection: A connection previously checked out with acquire().
+        """
+        if self._closed:
+            self._discard(connection)
+            return
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+        except Error:
+            self._discard(connection)
+            return
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    def prefill(self, count):
+        """
+        Opens connections until `count` are idle or the pool is full, so the
+        first callers do not pay for connection setup, e.g. while a login
+        form is shown.
+
+        Returns:
+        int: Number of connections opened
+        """
+        opened = []
+        while True:
+            with self._condition:
+                if len(self._idle) + len(opened) >= count or self._open >= self.size:
+                    break
+                self._open += 1
+            connection = self.factory()
+            if connection is None:
+                with self._condition:
+                    self._open -= 1
+                    self._condition.notify()
+                break
+            self._created_at[id(connection)] = time.monotonic()
+            opened.append(connection)
+        for connection in opened:
+            self.release(connection)
+        return len(opened)
+
+    def close(self):
+        """
+        Closes all idle connections. Connections currently checked out are
+        closed when they are released.
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for connection, _ in idle:
+            self._close(connection)
+
+    def _discard(self, connection):
+        self._close(connection)
+        with self._condition:
+            self._open -= 1
+            self._condition.notify()
+
+    def _close(self, connection):
+        self._created_at.pop(id(connection), None)
+        try:
+            connection.close()
+        except Error:
+            pass
+
+    def _is_healthy(self, connection):
+        try:
+            connection.ping(reconnect=False)
+            return True
+        except Error:
+            return False
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    Returns the process-wide connection pool, creating it on first use.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(create_connection)
+                metrics.start_exporter()
+    return _pool
+
+class Replica:
+    """
+    A read replica with its own connection pool, and the lag and check
+    latency measured by the last check.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.pool = ConnectionPool(functools.partial(create_connection, name))
+        # Seconds behind the primary, None until checked or while replication is stopped
+        self.lag = None
+        # Moving average of the check's round trip, in seconds
+        self.latency = None
+        self.error = None
+
+    def check(self):
+        """
+        Measures the replica's lag and round-trip time with one query.
+        """
+        started = time.perf_counter()
+        try:
+            connection = self.pool.acquire()
+        except PoolTimeoutError as err:
+            self.lag, self.error = None, f"{err}"
+            return
+        if connection is None:
+            self.lag, self.error = None, "Could not connect."
+            return
+        try:
+            lag = _replica_lag(connection)
+            elapsed = time.perf_counter() - started
+            self.latency = elapsed if self.latency is None else 0.7 * self.latency + 0.3 * elapsed
+            self.lag, self.error = lag, None if lag is not None else "Replication is not running."
+        except Error as err:
+            self.lag, self.error = None, f"{err}"
+        finally:
+            self.pool.release(connection)
+
+    def stats(self):
+        """
+        Returns the replica's name, lag, latency, error and pool usage.
+        """
+        return {"name": self.name, "lag": self.lag, "latency_ms": round(self.latency * 1000, 2) if self.latency is not None else None,
+                "error": self.error, "open": self.pool._open}
+
+def _replica_lag(connection):
+    cursor = connection.cursor(dictionary=REPLICA_LAG_QUERY is None)
+    try:
+        if REPLICA_LAG_QUERY:
+            cursor.execute(REPLICA_LAG_QUERY)
+            row = cursor.fetchone()
+            return float(row[0]) if row and row[0] is not None else None
+        if DB_BACKEND == 'sqlite':
+            # A stand-in file is never behind unless DB_REPLICA_LAG_QUERY says so
+            return 0.0
+        try:
+            cursor.execute("SHOW REPLICA STATUS")
+        except Error:
+            # Before MySQL 8.0.22
+            cursor.execute("SHOW SLAVE STATUS")
+        rows = cursor.fetchall()
+        if not rows:
+            # A server that is not replicating, e.g. a stand-in, is treated as current
+            return 0.0
+        lag = rows[0].get('Seconds_Behind_Source', rows[0].get('Seconds_Behind_Master'))
+        return float(lag) if lag is not None else None
+    finally:
+        cursor.close()
+        connection.commit()
+
+class ReplicaRouter:
+    """
+    Picks the replica a read-only block runs on. Replicas are checked every
+    REPLICA_CHECK_INTERVAL seconds on a daemon thread; those that cannot be
+    reached or are more than REPLICA_MAX_LAG seconds behind are skipped, and
+    reads go to the primary if none is left.
+    """
+
+    def __init__(self, names, selection=None):
+        self.replicas = [Replica(name) for name in names]
+        self.selection = selection or REPLICA_SELECTION
+        self._next = itertools.count()
+        self._monitor = None
+        self._lock = threading.Lock()
+
+    def usable(self):
+        """
+        Returns the replicas reads may currently go to.
+        """
+        return [replica for replica in self.replicas if replica.lag is not None and replica.lag <= REPLICA_MAX_LAG]
+
+    def choose(self):
+        """
+        Returns the replica for the next read, or None to read from the primary.
+        """
+        self.start_monitor()
+        usable = self.usable()
+        if not usable:
+            return None
+        if self.selection == 'least_latency':
+            return min(usable, key=lambda replica: replica.latency)
+        return usable[next(self._next) % len(usable)]
+
+    def check(self):
+        """
+        Checks every replica once. A replica whose check fails in an
+        unexpected way is skipped until a later check succeeds.
+        """
+        for replica in self.replicas:
+            try:
+                replica.check()
+            except Exception as err:
+                # Anything, so one bad replica neither stops the monitor nor keeps stale lag
+                replica.lag, replica.error = None, f"{err}"
+                print(f"Error: Checking replica {replica.name} failed: {err}")
+
+    def _run_monitor(self):
+        while True:
+            try:
+                self.check()
+            except Exception as err:
+                for replica in self.replicas:
+                    replica.lag, replica.error = None, f"{err}"
+                print(f"Error: {err}")
+            time.sleep(REPLICA_CHECK_INTERVAL)
+
+    def start_monitor(self):
+        """
+        Starts checking the replicas on a daemon thread, once per router.
+        """
+        if self._monitor is None:
+            with self._lock:
+                if self._monitor is None:
+                    self._monitor = threading.Thread(target=self._run_monitor, name="replica-monitor", daemon=True)
+                    self._monitor.start()
+
+    def stats(self):
+        """
+        Returns the stats of every replica.
+        """
+        return [replica.stats() for replica in self.replicas]
+
+_router = None
+
+def get_router():
+    """
+    Returns the process-wide replica router, or None if no replicas are configured.
+    """
+    global _router
+    configure()
+    if _router is None and REPLICAS:
+        with _pool_lock:
+            if _router is None:
+                _router = ReplicaRouter(REPLICAS)
+    return _router
+
+# When this thread, and any thread of the process, last committed on the primary
+_writes = threading.local()
+_last_write_any = 0.0
+
+def _mark_write():
+    global _last_write_any
+    _writes.at = _last_write_any = time.monotonic()
+
+def wrote_recently(any_thread=False):
+    """
+    Returns whether this thread, or with any_thread any thread of the
+    process, committed on the primary within the last REPLICA_MAX_LAG
+    seconds, so a replica may not have its changes yet.
+    """
+    configure()
+    last = _last_write_any if any_thread else getattr(_writes, 'at', 0.0)
+    return time.monotonic() - last < REPLICA_MAX_LAG
+
+class _TrackedConnection:
+    """
+    Wraps a primary connection to note when it commits, see wrote_recently().
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def commit(self):
+        result = self._connection.commit()
+        _mark_write()
+        return result
+
+@contextmanager
+def get_connection(readonly=False):
+    """
+    Context manager that checks a connection out of the shared pool and
+    returns it when the block exits.
+
+    With readonly, the block runs on a read replica if DB_REPLICAS are
+    configured and one is no more than REPLICA_MAX_LAG seconds behind,
+    chosen by REPLICA_SELECTION. So a thread reads its own writes, its
+    read-only blocks stay on the primary for REPLICA_MAX_LAG seconds after
+    it commits. Use it only for blocks that neither write nor depend on
+    changes made by other threads moments ago.
+
+    The connection is instrumented by the metrics module, which also
+    records how long the checkout waited.
+
+    Yields the connection object, or None if no connection could be opened.
+    """
+    router = get_router()
+    replica = router.choose() if router and readonly and not wrote_recently() else None
+    connection = None
+    started = time.perf_counter_ns()
+    if replica is not None:
+        try:
+            connection = replica.pool.acquire()
+        except PoolTimeoutError:
+            connection = None
+        if connection is None:
+            # Skipped until the next check finds it reachable again
+            replica.lag, replica.error = None, "Could not connect."
+            replica = None
+    pool = replica.pool if replica is not None else get_pool()
+    if replica is None:
+        connection = pool.acquire()
+    metrics.record_acquire(time.perf_counter_ns() - started, replica.name if replica is not None else 'pool')
+    instrumented = metrics.instrument(connection)
+    try:
+        if router is not None and replica is None and connection is not None:
+            yield _TrackedConnection(instrumented)
+        else:
+            yield instrumented
+    finally:
+        if connection is not None:
+            if instrumented is not connection:
+                instrumented.finish()
+            pool.release(connection)
@@ -0,0 +1,110 @@
+# db_executor.py
+import os
+import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of worker threads running database calls, overridable from .env
+WORKERS = int(os.environ.get('DB_EXECUTOR_WORKERS') or 4)
+# How often the Tk thread checks for finished calls, in milliseconds
+POLL_INTERVAL_MS = 25
+
+_executor = None
+
+def get_executor():
+    """
+    Returns the process-wide worker pool, creating it on first use.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="db-worker")
+    return _executor
+
+class BackgroundTask:
+    """
+    A database call running on a worker thread.
+
+    The result is delivered on the Tk thread by polling the future with
+    widget.after(), because Tk widgets must only be touched from the thread
+    that created them.
+    """
+
+    def __init__(self, widget, future, on_success=None, on_error=None):
+        self.widget = widget
+        self.future = future
+        self.on_success = on_success
+        self.on_error = on_error
+        self.cancelled = False
+        self._poll()
+
+    def cancel(self):
+        """
+        Cancels the task. The call is dropped if it has not started yet,
+        otherwise it runs to completion but its result is discarded.
+        """
+        self.cancelled = True
+        self.future.cancel()
+
+    def _poll(self):
+        if self.cancelled:
+            return
+        if not self.future.done():
+            try:
+                self.widget.after(POLL_INTERVAL_MS, self._poll)
+            except tk.TclError:
+                # The window was closed while the call was running
+                self.cancelled = True
+            return
+        try:
+            result = self.future.result()
+        except Exception as err:
+            if self.on_error:
+                self.on_error(err)
+            else:
+                print(f"Error: {err}")
+            return
+        if self.on_success:
+            self.on_success(result)
+
+def run_in_background(widget, func, *args, on_success=None, on_error=None, **kwargs):
+    """
+    Runs func(*args, **kwargs) on a worker thread and hands its result back
+    to the Tk thread.
+
+    Parameters:
+    widget: Any widget of the window waiting for the result, used to schedule polling
+    func (callable): The blocking call to run, e.g. catalog_management.search_books
+    on_success (callable): Called on the Tk thread with the return value of func
+    on_error (callable): Called on the Tk thread with the exception raised by func
+
+    Returns:
+    BackgroundTask: The running task
+    """
+    future = get_executor().submit(func, *args, **kwargs)
+    return BackgroundTask(widget, future, on_success, on_error)
+
+class LatestTask:
+    """
+    Runs background calls of which only the latest one matters, such as
+    searches. Starting a new call cancels the one still in flight, so a
+    superseded result is never shown.
+    """
+
+    def __init__(self):
+        self.task = None
+
+    def run(self, widget, func, *args, on_success=None, on_error=None, **kwargs):
+        """
+        Cancels the current task, if any, and starts a new one. Takes the same
+        parameters as run_in_background.
+        """
+        self.cancel()
+        self.task = run_in_background(widget, func, *args, on_success=on_success, on_error=on_error, **kwargs)
+        return self.task
+
+    def cancel(self):
+        """
+        Cancels the task in flight, if any.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
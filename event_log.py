@@ -0,0 +1,581 @@
+# event_log.py
+import argparse
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from datetime import datetime
+from decimal import Decimal
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks (e.g. on Windows) only one process may write the log at a time
+    fcntl = None
+
+from db_config import get_connection, Error
+from cache import book_cache, user_fine_cache
+
+# Where segments and snapshots are written, overridable from .env
+EVENT_LOG_DIR = os.environ.get('EVENT_LOG_DIR') or 'events'
+# Set to 0 to stop recording events
+ENABLED = (os.environ.get('EVENT_LOG_ENABLED') or '1') not in ('0', 'false', 'no')
+# Size at which a segment is sealed and a new one started
+SEGMENT_BYTES = int(os.environ.get('EVENT_LOG_SEGMENT_BYTES') or 64 * 1024 * 1024)
+# Set to 1 to fsync every append. Off by default: the database stays the record of truth
+FSYNC = (os.environ.get('EVENT_LOG_FSYNC') or '0') not in ('0', 'false', 'no')
+# Seconds between checks for new events when tailing
+POLL_INTERVAL = 0.5
+# Events returned per read
+READ_BATCH = 10000
+
+# Event types. `copies` is the change to the book's available copies and
+# `amount` the change to the user's fines, except for FINE_SET where it is the new balance.
+LOAN_ISSUED = 'loan_issued'
+LOAN_RETURNED = 'loan_returned'
+HOLD_PLACED = 'hold_placed'
+HOLD_CANCELLED = 'hold_cancelled'
+HOLD_EXPIRED = 'hold_expired'
+FINE_CHARGED = 'fine_charged'
+FINE_PAID = 'fine_paid'
+FINE_SET = 'fine_set'
+COPIES_ADDED = 'copies_added'
+EVENT_TYPES = (LOAN_ISSUED, LOAN_RETURNED, HOLD_PLACED, HOLD_CANCELLED, HOLD_EXPIRED,
+               FINE_CHARGED, FINE_PAID, FINE_SET, COPIES_ADDED)
+# Codes are stored in the log, so new types are only ever appended
+_TYPE_CODES = {event_type: code for code, event_type in enumerate(EVENT_TYPES, 1)}
+_FINE_SIGNS = {FINE_CHARGED: 1, LOAN_RETURNED: 1, FINE_PAID: -1}
+
+# Events are fixed-size little-endian records, so event n of a segment is at
+# offset n * RECORD_SIZE: seq, time, type code, copies, user_id, book_id,
+# ref_id (loan or reservation, 0 for none), amount in cents, and a CRC-32 of
+# the preceding bytes that finds records torn by a crash.
+_BODY = struct.Struct('<QdB3xiqqqq4x')
+_CRC = struct.Struct('<I')
+RECORD_SIZE = _BODY.size + _CRC.size
+SEGMENT_RECORDS = max(1, SEGMENT_BYTES // RECORD_SIZE)
+# Snapshots: magic, seq, time, number of books, number of users, then the
+# book ids, available copies, user ids and fines in cents as int64 arrays, then a CRC-32
+_SNAPSHOT_HEADER = struct.Struct('<8sQdQQ')
+_SNAPSHOT_MAGIC = b'LIBSNAP1'
+
+def _cents(value):
+    return int(round((value or 0) * 100))
+
+def _segment_name(first_seq):
+    return f"{first_seq:020d}.log"
+
+def _snapshot_name(seq):
+    return f"snapshot-{seq:020d}.bin"
+
+def _decode(buffer, offset):
+    body = buffer[offset:offset + _BODY.size]
+    if zlib.crc32(body) != _CRC.unpack_from(buffer, offset + _BODY.size)[0]:
+        return None
+    seq, at, code, copies, user_id, book_id, ref_id, cents = _BODY.unpack(body)
+    return {
+        'seq': seq,
+        'time': datetime.fromtimestamp(at),
+        'type': EVENT_TYPES[code - 1],
+        'user_id': user_id or None,
+        'book_id': book_id or None,
+        'ref_id': ref_id or None,
+        'copies': copies,
+        'amount': Decimal(cents).scaleb(-2),
+    }
+
+class EventLog:
+    """
+    An append-only log of circulation and fine changes, in segment files
+    of fixed-size binary records named after the sequence number of their
+    first event. Events are only ever appended, and read through read-only
+    memory maps, so readers never block writers.
+
+    Appends from several processes on the same machine are serialized with
+    an exclusive lock on a lock file, and sequence numbers follow from the
+    size of the last segment, so each process can write the log directly.
+    """
+
+    def __init__(self, directory=EVENT_LOG_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._lock_file = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def segments(self):
+        """
+        Returns the first sequence numbers of the segments, in order.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-4]) for name in names if name.endswith('.log') and name[:-4].isdigit())
+
+    def _acquire(self):
+        # Called with self._lock held
+        if self._lock_file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._lock_file = open(self._path('.lock'), 'a+b')
+        if fcntl is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def _release(self):
+        if fcntl is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _end(self, truncate=False):
+        # The last segment and its number of whole records. A trailing partial record,
+        # torn by a crash or still being written, is not counted. It is cut off only
+        # with truncate, which needs the file lock so a write in progress is not cut.
+        segments = self.segments()
+        if not segments:
+            return 1, 0
+        first = segments[-1]
+        path = self._path(_segment_name(first))
+        size = os.path.getsize(path)
+        if truncate and size % RECORD_SIZE:
+            os.truncate(path, size - size % RECORD_SIZE)
+        return first, size // RECORD_SIZE
+
+    def last_seq(self):
+        """
+        Returns the sequence number of the newest whole event, 0 if there is none.
+        """
+        first, count = self._end()
+        return first + count - 1
+
+    def append(self, events):
+        """
+        Appends events, dicts with the keys type and optionally user_id,
+        book_id, ref_id, copies and amount, and numbers them.
+
+        Returns:
+        int: Sequence number of the last event appended, or None if there were none
+        """
+        events = list(events)
+        if not events:
+            return None
+        at = time.time()
+        sealed = []
+        with self._lock:
+            self._acquire()
+            try:
+                first, count = self._end(truncate=True)
+                while events:
+                    if count >= SEGMENT_RECORDS:
+                        sealed.append(first + count - 1)
+                        first, count = first + count, 0
+                    chunk, events = events[:SEGMENT_RECORDS - count], events[SEGMENT_RECORDS - count:]
+                    data = bytearray()
+                    for offset, event in enumerate(chunk):
+                        body = _BODY.pack(first + count + offset, at, _TYPE_CODES[event['type']], event.get('copies') or 0,
+                                          event.get('user_id') or 0, event.get('book_id') or 0, event.get('ref_id') or 0,
+                                          _cents(event.get('amount')))
+                        data += body + _CRC.pack(zlib.crc32(body))
+                    with open(self._path(_segment_name(first)), 'ab') as segment:
+                        segment.write(data)
+                        segment.flush()
+                        if FSYNC:
+                            os.fsync(segment.fileno())
+                    count += len(chunk)
+            finally:
+                self._release()
+        if sealed:
+            start_snapshot(sealed[-1])
+        return first + count - 1
+
+    def read(self, after_seq=0, limit=READ_BATCH):
+        """
+        Returns up to `limit` events with a sequence number above after_seq,
+        oldest first. Reading stops at a record torn by a crash.
+
+        Returns:
+        list: Dictionaries with the keys seq, time, type, user_id, book_id, ref_id, copies and amount
+        """
+        events = []
+        segments = self.segments()
+        for index, first in enumerate(segments):
+            if index + 1 < len(segments) and segments[index + 1] <= after_seq + 1:
+                continue
+            path = self._path(_segment_name(first))
+            count = os.path.getsize(path) // RECORD_SIZE
+            start = max(0, after_seq + 1 - first)
+            if start >= count:
+                continue
+            with open(path, 'rb') as segment, mmap.mmap(segment.fileno(), count * RECORD_SIZE, access=mmap.ACCESS_READ) as view:
+                for record in range(start, count):
+                    event = _decode(view, record * RECORD_SIZE)
+                    if event is None:
+                        return events
+                    events.append(event)
+                    if len(events) >= limit:
+                        return events
+        return events
+
+    def tail(self, after_seq=0, poll_interval=POLL_INTERVAL, stop=None):
+        """
+        Yields events as they are appended, starting after after_seq, until
+        stop (a threading.Event) is set or forever, e.g. for a consumer
+        keeping derived state up to date without polling the database.
+        """
+        while stop is None or not stop.is_set():
+            events = self.read(after_seq)
+            for event in events:
+                yield event
+                after_seq = event['seq']
+            if not events:
+                if stop is not None:
+                    stop.wait(poll_interval)
+                else:
+                    time.sleep(poll_interval)
+
+class CirculationState:
+    """
+    Available copies by book_id and fines in cents by user_id, as of the
+    event numbered `seq`, rebuilt by applying events to a snapshot.
+    """
+
+    def __init__(self, seq=0, copies=None, fines=None):
+        self.seq = seq
+        self.copies = copies or {}
+        self.fines = fines or {}
+
+    def apply(self, event):
+        """
+        Applies one event read from the log.
+        """
+        if event['copies'] and event['book_id']:
+            self.copies[event['book_id']] = self.copies.get(event['book_id'], 0) + event['copies']
+        if event['user_id']:
+            cents = _cents(event['amount'])
+            if event['type'] == FINE_SET:
+                self.fines[event['user_id']] = cents
+            elif cents and event['type'] in _FINE_SIGNS:
+                self.fines[event['user_id']] = self.fines.get(event['user_id'], 0) + _FINE_SIGNS[event['type']] * cents
+        self.seq = event['seq']
+
+    def save(self, path):
+        """
+        Writes the state to a snapshot file, replacing it atomically.
+        """
+        books, users = sorted(self.copies), sorted(self.fines)
+        data = bytearray(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, self.seq, time.time(), len(books), len(users)))
+        for values in (books, [self.copies[book_id] for book_id in books], users, [self.fines[user_id] for user_id in users]):
+            data += array('q', values).tobytes() if sys.byteorder == 'little' else _swapped(values)
+        data += _CRC.pack(zlib.crc32(data))
+        temporary = f"{path}.tmp"
+        with open(temporary, 'wb') as snapshot:
+            snapshot.write(data)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a snapshot file.
+
+        Raises:
+        ValueError: If the file is not a snapshot or is damaged
+        """
+        with open(path, 'rb') as snapshot:
+            data = snapshot.read()
+        if len(data) < _SNAPSHOT_HEADER.size + _CRC.size or zlib.crc32(data[:-_CRC.size]) != _CRC.unpack_from(data, len(data) - _CRC.size)[0]:
+            raise ValueError(f"{path} is damaged.")
+        magic, seq, _, books, users = _SNAPSHOT_HEADER.unpack_from(data)
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a snapshot.")
+        columns, offset = [], _SNAPSHOT_HEADER.size
+        for length in (books, books, users, users):
+            column = array('q')
+            column.frombytes(data[offset:offset + length * 8])
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column)
+            offset += length * 8
+        return cls(seq, dict(zip(columns[0], columns[1])), dict(zip(columns[2], columns[3])))
+
+def _swapped(values):
+    column = array('q', values)
+    column.byteswap()
+    return column.tobytes()
+
+event_log = EventLog()
+
+def record(event_type, user_id=None, book_id=None, ref_id=None, copies=0, amount=0):
+    """
+    Appends one event to the shared log, after the change it describes was
+    committed. A failed write is printed, never raised, so it cannot undo a
+    loan or a payment.
+    """
+    record_many([{'type': event_type, 'user_id': user_id, 'book_id': book_id, 'ref_id': ref_id,
+                  'copies': copies, 'amount': amount}])
+
+def record_many(events):
+    """
+    Like record for several events, with one write.
+    """
+    if not ENABLED:
+        return
+    try:
+        event_log.append(events)
+    except OSError as err:
+        print(f"Error: {err}")
+
+def _snapshots(log=event_log):
+    try:
+        names = os.listdir(log.directory)
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[9:-4]) for name in names if name.startswith('snapshot-') and name.endswith('.bin'))
+
+def replay(until_seq=None, log=event_log):
+    """
+    Rebuilds the circulation state from the newest snapshot at or before
+    until_seq and the events after it, without reading the database.
+
+    Returns:
+    CirculationState: The state, or None if there is no snapshot to start from
+    """
+    for seq in reversed(_snapshots(log)):
+        if until_seq is not None and seq > until_seq:
+            continue
+        try:
+            state = CirculationState.load(log._path(_snapshot_name(seq)))
+        except (OSError, ValueError) as err:
+            print(f"Error: {err}")
+            continue
+        while until_seq is None or state.seq < until_seq:
+            events = log.read(state.seq, READ_BATCH if until_seq is None else min(READ_BATCH, until_seq - state.seq))
+            if not events:
+                break
+            for event in events:
+                state.apply(event)
+        return state
+    return None
+
+def _read_state(cursor):
+    state = CirculationState()
+    cursor.execute("SELECT book_id, available_copies FROM books")
+    state.copies = {book_id: copies for book_id, copies in cursor.fetchall()}
+    cursor.execute("SELECT user_id, fines FROM users")
+    state.fines = {user_id: _cents(fines) for user_id, fines in cursor.fetchall()}
+    return state
+
+def take_snapshot(until_seq=None, log=event_log):
+    """
+    Writes a snapshot of the circulation state as of until_seq (default:
+    the newest event) so later replays start from it.
+
+    The first snapshot is read from the database, with appends held off
+    while it is read. A change committed but not yet appended at that
+    moment would be counted twice, so take it while the desks are quiet,
+    e.g. before the nightly jobs. Later snapshots are built from the
+    previous one and the log alone.
+
+    Returns:
+    int: Sequence number of the snapshot, or None if it could not be taken
+    """
+    state = replay(until_seq, log)
+    if state is None:
+        with log._lock:
+            log._acquire()
+            try:
+                with get_connection() as connection:
+                    if not connection:
+                        return None
+                    cursor = connection.cursor()
+                    try:
+                        state = _read_state(cursor)
+                        connection.commit()
+                    except Error as err:
+                        print(f"Error: {err}")
+                        return None
+                    finally:
+                        cursor.close()
+                state.seq = log.last_seq()
+            finally:
+                log._release()
+    state.save(log._path(_snapshot_name(state.seq)))
+    return state.seq
+
+def start_snapshot(until_seq):
+    """
+    Takes a snapshot on a daemon thread when a segment is sealed, if there
+    is an earlier snapshot to build it from.
+    """
+    if _snapshots():
+        threading.Thread(target=take_snapshot, args=(until_seq,), name="event-log-snapshot", daemon=True).start()
+
+def check(log=event_log):
+    """
+    Compares the replayed state with the database.
+
+    Returns:
+    dict: Dictionary with the keys seq, books and users (number of rows that differ), or None if there is no snapshot
+    """
+    state = replay(log=log)
+    if state is None:
+        return None
+    with get_connection() as connection:
+        if not connection:
+            return None
+        cursor = connection.cursor()
+        try:
+            current = _read_state(cursor)
+        finally:
+            cursor.close()
+    return {
+        'seq': state.seq,
+        'books': sum(1 for book_id, copies in current.copies.items() if state.copies.get(book_id, 0) != copies),
+        'users': sum(1 for user_id, fines in current.fines.items() if state.fines.get(user_id, 0) != fines),
+    }
+
+_follower = None
+_follower_lock = threading.Lock()
+
+def _follow_caches(stop, after):
+    for event in event_log.tail(after, stop=stop):
+        if event['copies'] and event['book_id']:
+            book_cache.invalidate(event['book_id'])
+        if event['type'] in _FINE_SIGNS or event['type'] == FINE_SET:
+            user_fine_cache.invalidate(event['user_id'])
+
+def start_cache_follower():
+    """
+    Tails the log on a daemon thread, once per process, dropping the
+    cached books and fines that other processes changed, instead of
+    waiting for their cache entries to expire.
+    """
+    global _follower
+    with _follower_lock:
+        if _follower is None:
+            _follower = threading.Thread(target=_follow_caches, args=(threading.Event(), event_log.last_seq()), name="event-log-follower",
+                                         daemon=True)
+            _follower.start()
+
+_index_follower = None
+
+def _index_books(book_ids):
+    # Imported here as these modules import this one
+    from typeahead import typeahead_index
+    from fuzzy_search import trigram_index
+    from facets import facet_index
+    # Read from the primary, a replica may not have the books yet
+    with get_connection() as connection:
+        if not connection:
+            return
+        cursor = connection.cursor(dictionary=True)
+        try:
+            cursor.execute(f"""SELECT book_id, title, author, subject_tags, total_copies, genre, language, publication_year,
+                                      dewey_decimal, available_copies
+                               FROM books WHERE book_id IN ({', '.join(['%s'] * len(book_ids))})""", list(book_ids))
+            books = cursor.fetchall()
+        except Error as err:
+            print(f"Error: {err}")
+            return
+        finally:
+            cursor.close()
+    for book in books:
+        typeahead_index.add(book['book_id'], book['title'], book['author'], book['total_copies'])
+        trigram_index.add_book(book)
+        facet_index.add(book)
+
+def _follow_indexes(stop, after):
+    from facets import facet_index
+    # With a snapshot, available copies are replayed from the log and need no
+    # database read; without one, changed books are re-read before the next count
+    state = replay(after)
+    if state is not None and state.seq != after:
+        state = None
+    while not stop.is_set():
+        events = event_log.read(after)
+        if not events:
+            stop.wait(POLL_INTERVAL)
+            continue
+        new_books = set()
+        for event in events:
+            book_id = event['book_id']
+            if state is not None:
+                state.apply(event)
+            if event['type'] == COPIES_ADDED and not facet_index.has_book(book_id):
+                new_books.add(book_id)
+            elif event['copies'] and book_id:
+                if state is not None and book_id in state.copies:
+                    facet_index.set_available(book_id, state.copies[book_id] > 0)
+                else:
+                    facet_index.mark_stale(book_id)
+        if new_books:
+            _index_books(new_books)
+        after = events[-1]['seq']
+
+def start_index_follower():
+    """
+    Tails the log on a daemon thread, once per process, keeping the search
+    indexes up to date with other processes: books they add to the catalog
+    are added to the typeahead, typo and facet indexes, and the facet
+    availability of the books they lend or take back is updated.
+    """
+    global _index_follower
+    with _follower_lock:
+        if _index_follower is None:
+            # Events from here on are applied, the indexes being built read the books as of about now
+            _index_follower = threading.Thread(target=_follow_indexes, args=(threading.Event(), event_log.last_seq()),
+                                               name="event-log-index-follower", daemon=True)
+            _index_follower.start()
+
+def _print_event(event):
+    fields = [f"{key}={event[key]}" for key in ('user_id', 'book_id', 'ref_id') if event[key]]
+    if event['copies']:
+        fields.append(f"copies={event['copies']:+d}")
+    if event['amount']:
+        fields.append(f"amount={event['amount']}")
+    print(f"{event['seq']} {event['time']:%Y-%m-%d %H:%M:%S} {event['type']} {' '.join(fields)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect the circulation event log and take snapshots of it.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    show = commands.add_parser("show", help="Print events")
+    show.add_argument("--after", type=int, default=0, help="Print events after this sequence number")
+    show.add_argument("--follow", action="store_true", help="Keep printing events as they are appended")
+    commands.add_parser("snapshot", help="Write a snapshot of the state as of the newest event")
+    commands.add_parser("check", help="Compare the state replayed from the newest snapshot with the database")
+    args = parser.parse_args()
+
+    if args.command == "show":
+        if args.follow:
+            for event in event_log.tail(args.after):
+                _print_event(event)
+        else:
+            after = args.after
+            while True:
+                events = event_log.read(after)
+                if not events:
+                    break
+                for event in events:
+                    _print_event(event)
+                after = events[-1]['seq']
+    elif args.command == "snapshot":
+        started = time.monotonic()
+        seq = take_snapshot()
+        if seq is None:
+            sys.exit(1)
+        print(f"Wrote the snapshot as of event {seq} in {time.monotonic() - started:.1f}s.")
+    else:
+        differences = check()
+        if differences is None:
+            print("No snapshot yet, run: python3 event_log.py snapshot")
+            sys.exit(1)
+        print(f"Replayed to event {differences['seq']}: {differences['books']} books and {differences['users']} users differ from the database.")
+        if differences['books'] or differences['users']:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
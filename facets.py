@@ -0,0 +1,407 @@
+# facets.py
+import os
+import threading
+import time
+
+from db_config import get_connection, wrote_recently, Error
+from cache import book_cache, CACHE_TTL
+
+# Facets search results can be narrowed by
+FACETS = ('genre', 'language', 'publication_year', 'dewey_class', 'availability')
+AVAILABLE = 'available'
+UNAVAILABLE = 'checked_out'
+# Values listed per facet, most frequent first
+FACET_VALUE_LIMIT = 20
+# Matching books counted for facets, overridable from .env
+FACET_RESULT_CAP = int(os.environ.get('FACET_RESULT_CAP') or 100000)
+# Seconds before availability is read again in full, to pick up changes made by other desks
+AVAILABILITY_TTL = CACHE_TTL
+# Rows fetched per round trip while building
+BUILD_FETCH_SIZE = 5000
+
+_COLUMNS = "book_id, genre, language, publication_year, dewey_decimal, available_copies"
+
+def dewey_class(dewey_decimal):
+    """
+    Returns the Dewey class of a classification number, e.g. "800" for "823.914", or None.
+    """
+    value = (dewey_decimal or "").strip()
+    if not value[:1].isdigit():
+        return None
+    return f"{value[0]}00"
+
+def normalize_filters(filters):
+    """
+    Checks facet filters and converts their values to the form the index
+    uses, e.g. from query string values.
+
+    Raises:
+    ValueError: If a facet is unknown or a value is malformed
+    """
+    normalized = {}
+    for facet, value in (filters or {}).items():
+        if facet not in FACETS:
+            raise ValueError(f"Unknown facet {facet}.")
+        if facet == 'publication_year':
+            value = int(value)
+        elif facet == 'dewey_class':
+            value = dewey_class(str(value))
+            if value is None:
+                raise ValueError("dewey_class must be a class number such as 800.")
+        elif facet == 'availability' and value not in (AVAILABLE, UNAVAILABLE):
+            raise ValueError(f"availability must be {AVAILABLE} or {UNAVAILABLE}.")
+        normalized[facet] = value
+    return normalized
+
+def filter_conditions(filters, alias="b"):
+    """
+    Builds the SQL conditions restricting books to facet values.
+
+    Parameters:
+    filters (dict): Value by facet name, as returned by normalize_filters
+    alias (str): Alias of the books table in the query
+
+    Returns:
+    tuple: (list of condition strings, list of parameters)
+    """
+    conditions, params = [], []
+    for facet, value in filters.items():
+        if facet == 'dewey_class':
+            conditions.append(f"{alias}.dewey_decimal LIKE %s")
+            params.append(f"{value[0]}%")
+        elif facet == 'availability':
+            conditions.append(f"{alias}.available_copies > 0" if value == AVAILABLE else f"{alias}.available_copies = 0")
+        else:
+            conditions.append(f"{alias}.{facet} = %s")
+            params.append(value)
+    return conditions, params
+
+def bitmap(book_ids):
+    """
+    Returns a bitmap, an int with bit n set for book n, of book ids.
+    """
+    book_ids = list(book_ids)
+    if not book_ids:
+        return 0
+    bits = bytearray(max(book_ids) // 8 + 1)
+    for book_id in book_ids:
+        bits[book_id >> 3] |= 1 << (book_id & 7)
+    return int.from_bytes(bits, 'little')
+
+if hasattr(int, 'bit_count'):
+    _popcount = int.bit_count
+else:
+    def _popcount(value):
+        return bin(value).count("1")
+
+class FacetIndex:
+    """
+    Precomputed facet bitmaps: for each facet value, an int with a bit set
+    for every book that has it. The facet counts of a result set are the
+    number of bits its bitmap shares with each value's bitmap, so no
+    GROUP BY runs on search.
+
+    Books are added as they are added to the catalog. Availability is the
+    only facet that changes afterwards; the books whose entries the book
+    cache drops are re-read in one query before the next count. Added
+    books and availability changes are queued and applied together before
+    the next read, one combined mask per value, since every change to a
+    bitmap copies the whole int. The whole
+    of it is re-read in the background every AVAILABILITY_TTL seconds, see
+    start_facet_build(), so changes made by other desks are picked up
+    without a search waiting for it.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._bitmaps = {facet: {} for facet in FACETS}
+        self._all = 0
+        self._stale = set()
+        # Changes not yet in the bitmaps: books added, and availability by book_id
+        self._added = []
+        self._availability = {}
+        # Books added while load() builds a replacement, replayed into it before the swap
+        self._pending = None
+        self._reread = threading.Event()
+        self.ready = False
+
+    def _apply_changes(self):
+        # Called with the lock held
+        if self._added:
+            added, self._added = self._added, []
+            self._all |= bitmap(book['book_id'] for book in added)
+            for facet, values in self._collect(added).items():
+                bitmaps = self._bitmaps[facet]
+                for value, book_ids in values.items():
+                    bitmaps[value] = bitmaps.get(value, 0) | bitmap(book_ids)
+        if self._availability:
+            available = bitmap(book_id for book_id, flag in self._availability.items() if flag) & self._all
+            unavailable = bitmap(book_id for book_id, flag in self._availability.items() if not flag) & self._all
+            self._availability = {}
+            values = self._bitmaps['availability']
+            values[AVAILABLE] = (values.get(AVAILABLE, 0) & ~unavailable) | available
+            values[UNAVAILABLE] = (values.get(UNAVAILABLE, 0) & ~available) | unavailable
+
+    def add(self, book):
+        """
+        Adds a book, a dict keyed by books column name.
+        """
+        with self._lock:
+            # The added book's own availability is newer than any change queued for it
+            self._availability.pop(book['book_id'], None)
+            self._added.append(book)
+            if self._pending is not None:
+                self._pending.append(book)
+
+    def load(self, books):
+        """
+        Replaces the index with books, an iterable of dicts keyed by
+        column name. Counts keep using the old index until the new one is
+        complete, and books added meanwhile are carried over to it.
+        """
+        with self._lock:
+            self._pending = []
+        try:
+            staging = self._build(books)
+            with self._lock:
+                # The scan may or may not have seen these books; adding one twice is harmless
+                staging._added = self._pending
+                staging._apply_changes()
+                # Books marked stale and availability changes queued meanwhile are kept,
+                # the scan may have read those books first
+                self._bitmaps, self._all, self._added = staging._bitmaps, staging._all, []
+                self.ready = True
+        finally:
+            with self._lock:
+                self._pending = None
+
+    @staticmethod
+    def _collect(books):
+        # Bits are collected per value and combined once, since or-ing into a large int copies it
+        ids = {facet: {} for facet in FACETS}
+        for book in books:
+            for facet in ('genre', 'language', 'publication_year'):
+                if book.get(facet) not in (None, ''):
+                    ids[facet].setdefault(book[facet], []).append(book['book_id'])
+            category = dewey_class(book.get('dewey_decimal'))
+            if category:
+                ids['dewey_class'].setdefault(category, []).append(book['book_id'])
+            availability = AVAILABLE if (book.get('available_copies') or 0) > 0 else UNAVAILABLE
+            ids['availability'].setdefault(availability, []).append(book['book_id'])
+        return ids
+
+    def _build(self, books):
+        staging = FacetIndex()
+        for facet, values in self._collect(books).items():
+            staging._bitmaps[facet] = {value: bitmap(book_ids) for value, book_ids in values.items()}
+        # Every book has an availability
+        staging._all = 0
+        for mask in staging._bitmaps['availability'].values():
+            staging._all |= mask
+        return staging
+
+    def has_book(self, book_id):
+        """
+        Returns whether a book is in the index.
+        """
+        with self._lock:
+            self._apply_changes()
+            return bool(self._all >> book_id & 1)
+
+    def mark_stale(self, book_id):
+        """
+        Notes that a book's availability may have changed, or every book's if book_id is None.
+        """
+        if book_id is None:
+            self._reread.set()
+            return
+        with self._lock:
+            self._stale.add(book_id)
+
+    def set_available(self, book_id, available):
+        """
+        Records whether a book has a copy on the shelf, e.g. from a loan in
+        the event log. Books not in the index are ignored.
+        """
+        with self._lock:
+            self._availability[book_id] = bool(available)
+
+    def _refresh_stale(self, cursor):
+        with self._lock:
+            stale = list(self._stale)
+            self._stale = set()
+        if stale:
+            cursor.execute(f"SELECT book_id, available_copies FROM books WHERE book_id IN ({', '.join(['%s'] * len(stale))})",
+                           stale)
+            rows = cursor.fetchall()
+            with self._lock:
+                for book_id, available_copies in rows:
+                    self._availability[book_id] = available_copies > 0
+                self._apply_changes()
+
+    def _reread_availability(self, cursor):
+        cursor.execute("SELECT book_id FROM books WHERE available_copies > 0")
+        available = bitmap(row[0] for row in cursor.fetchall())
+        with self._lock:
+            self._apply_changes()
+            self._bitmaps['availability'] = {AVAILABLE: available & self._all, UNAVAILABLE: self._all & ~available}
+
+    def _with_cursor(self, func):
+        # Books are marked stale by this process's own loans, which a replica may not have yet
+        with get_connection(readonly=not wrote_recently(any_thread=True)) as connection:
+            if connection:
+                cursor = connection.cursor()
+                try:
+                    func(cursor)
+                except Error as err:
+                    print(f"Error: {err}")
+                finally:
+                    cursor.close()
+
+    def refresh(self):
+        """
+        Re-reads the availability of the books marked stale, a single query by primary key.
+        """
+        with self._lock:
+            if not self._stale:
+                return
+        self._with_cursor(self._refresh_stale)
+
+    def reread_availability(self):
+        """
+        Re-reads the availability of every book.
+        """
+        self._with_cursor(self._reread_availability)
+
+    def wait_for_reread(self, timeout):
+        """
+        Waits until every book is marked stale or timeout seconds have passed.
+        """
+        self._reread.wait(timeout)
+        self._reread.clear()
+
+    def narrow(self, results, filters):
+        """
+        Returns the results bitmap restricted to the books with the given facet values.
+        """
+        with self._lock:
+            self._apply_changes()
+            for facet, value in filters.items():
+                results &= self._bitmaps[facet].get(value, 0)
+        return results
+
+    def counts(self, results, limit=FACET_VALUE_LIMIT):
+        """
+        Counts the books of a result set with each facet value.
+
+        Parameters:
+        results (int): Bitmap of the books in the result set, see bitmap()
+        limit (int): Values listed per facet
+
+        Returns:
+        dict: For each facet, a list of (value, count) tuples, most frequent first
+        """
+        with self._lock:
+            self._apply_changes()
+            bitmaps = {facet: list(values.items()) for facet, values in self._bitmaps.items()}
+        counts = {}
+        for facet, values in bitmaps.items():
+            found = [(value, _popcount(results & mask)) for value, mask in values]
+            found = [(value, count) for value, count in found if count]
+            found.sort(key=lambda item: (-item[1], str(item[0])))
+            counts[facet] = found[:limit]
+        return counts
+
+    def stats(self):
+        """
+        Returns the number of books and values per facet.
+        """
+        with self._lock:
+            self._apply_changes()
+            stats = {facet: len(values) for facet, values in self._bitmaps.items()}
+            stats.update(books=_popcount(self._all), ready=self.ready)
+            return stats
+
+facet_index = FacetIndex()
+# Availability changes go through the book cache, see FacetIndex
+book_cache.add_listener(facet_index.mark_stale)
+
+def _stream_books(fetch_size):
+    with get_connection(readonly=True) as connection:
+        if not connection:
+            return
+        cursor = connection.cursor(dictionary=True, buffered=False)
+        finished = False
+        try:
+            cursor.execute(f"SELECT {_COLUMNS} FROM books")
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    finished = True
+                    break
+                yield from rows
+        finally:
+            if not finished and connection.unread_result:
+                connection.consume_results()
+            cursor.close()
+
+def build_facet_index(fetch_size=BUILD_FETCH_SIZE):
+    """
+    Builds the shared facet index from a streaming scan of the books table.
+
+    Returns:
+    float: Seconds the build took
+    """
+    started = time.monotonic()
+    try:
+        facet_index.load(_stream_books(fetch_size))
+    except Error as err:
+        print(f"Error: {err}")
+    return time.monotonic() - started
+
+def _maintain_facet_index():
+    while True:
+        if facet_index.ready:
+            facet_index.reread_availability()
+        else:
+            # Also retried after a failed build, e.g. if the database was down at startup
+            build_facet_index()
+        facet_index.wait_for_reread(AVAILABILITY_TTL)
+
+_build_thread = None
+_build_lock = threading.Lock()
+
+def start_facet_build():
+    """
+    Builds the shared facet index on a daemon thread, once per process.
+    The thread then re-reads availability every AVAILABILITY_TTL seconds.
+    """
+    global _build_thread
+    with _build_lock:
+        if _build_thread is None:
+            _build_thread = threading.Thread(target=_maintain_facet_index, name="facet-build", daemon=True)
+            _build_thread.start()
+
+def facets_ready():
+    """
+    Returns whether the shared facet index can count results, starting its build if needed.
+    """
+    start_facet_build()
+    return facet_index.ready
+
+def facet_counts(book_ids, filters=None):
+    """
+    Returns the facet counts of a result set, after narrowing it to the
+    given facet values. Check facets_ready() first; counts are empty
+    while the index is being built.
+
+    Parameters:
+    book_ids (iterable): IDs of the matching books
+    filters (dict): Value by facet name the results are narrowed to, as returned by normalize_filters
+
+    Returns:
+    tuple: (number of books left after narrowing, counts as returned by FacetIndex.counts)
+    """
+    facet_index.refresh()
+    results = facet_index.narrow(bitmap(book_ids), filters or {})
+    return _popcount(results), facet_index.counts(results)
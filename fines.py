@@ -0,0 +1,177 @@
+# fines.py
+from db_config import get_connection, Error
+from cache import user_fine_cache
+from metrics import timed
+import event_log
+import argparse
+import time
+from datetime import date, datetime
+
+# Fine per overdue day by membership category
+FINE_RATES = {'public': 10, 'student': 5, 'staff': 0}
+# Transaction ids processed per transaction by accrue_fines()
+DEFAULT_CHUNK_SIZE = 50000
+
+def _rate_sql():
+    cases = " ".join(f"WHEN '{category}' THEN {rate}" for category, rate in FINE_RATES.items())
+    return f"CASE u.membership_category {cases} ELSE 0 END"
+
+def _accrue_query(ids_sql):
+    # Charges every open, overdue loan whose transaction_id matches ids_sql
+    # for the days it has been overdue as of a date that the ledger has not
+    # charged yet. Running it again for the same date finds nothing left to
+    # charge, and IGNORE skips a loan that a concurrent return charged for
+    # the same date.
+    return f"""INSERT IGNORE INTO fine_ledger (transaction_id, user_id, accrual_date, days, amount)
+               SELECT t.transaction_id, t.user_id, %s,
+                      DATEDIFF(%s, t.due_date) - COALESCE(charged.days, 0),
+                      (DATEDIFF(%s, t.due_date) - COALESCE(charged.days, 0)) * {_rate_sql()}
+               FROM transactions t
+               JOIN users u ON u.user_id = t.user_id
+               LEFT JOIN (SELECT transaction_id, SUM(days) AS days FROM fine_ledger
+                          WHERE transaction_id {ids_sql}
+                          GROUP BY transaction_id) charged ON charged.transaction_id = t.transaction_id
+               WHERE t.transaction_id {ids_sql}
+               AND t.return_date IS NULL
+               AND t.due_date < %s
+               AND DATEDIFF(%s, t.due_date) > COALESCE(charged.days, 0)
+               AND {_rate_sql()} > 0"""
+
+ACCRUE_QUERY = _accrue_query("BETWEEN %s AND %s")
+
+def _charge(cursor, as_of, ids_sql, ids):
+    ids = list(ids)
+    cursor.execute(_accrue_query(ids_sql), [as_of, as_of, as_of] + ids + ids + [as_of, as_of])
+    return cursor.rowcount
+
+def _post(cursor, ids_sql, ids):
+    # Adds the unposted ledger rows of the matching loans to users.fines
+    ids = list(ids)
+    cursor.execute(f"""UPDATE users SET fines = fines +
+                           (SELECT SUM(amount) FROM fine_ledger f
+                            WHERE f.user_id = users.user_id AND f.posted = FALSE AND f.transaction_id {ids_sql})
+                       WHERE user_id IN (SELECT user_id FROM fine_ledger
+                                         WHERE posted = FALSE AND transaction_id {ids_sql})""",
+                   ids + ids)
+    cursor.execute(f"UPDATE fine_ledger SET posted = TRUE WHERE posted = FALSE AND transaction_id {ids_sql}", ids)
+
+def _accrue_range(cursor, as_of, first_id, last_id):
+    """
+    Charges and posts the fines of a transaction_id range. The caller owns
+    the database transaction, so the ledger rows and the users.fines
+    update are committed together.
+
+    Returns a (loans charged, amount charged by user_id) tuple.
+    """
+    ids_sql = "BETWEEN %s AND %s"
+    charged = _charge(cursor, as_of, ids_sql, (first_id, last_id))
+    if charged <= 0:
+        return 0, {}
+
+    cursor.execute("""SELECT user_id, SUM(amount) FROM fine_ledger
+                      WHERE posted = FALSE AND transaction_id BETWEEN %s AND %s
+                      GROUP BY user_id""", (first_id, last_id))
+    amounts = dict(cursor.fetchall())
+    _post(cursor, ids_sql, (first_id, last_id))
+    return charged, amounts
+
+def accrue_transaction_fine(cursor, transaction_id, as_of=None):
+    """
+    Charges the fine an open loan has accrued up to a date that the nightly
+    run has not charged yet, e.g. when the book is returned. The caller owns
+    the database transaction.
+
+    Parameters:
+    cursor: Cursor of the connection to write with
+    transaction_id (int): The loan to charge
+    as_of (date): Date to charge up to, defaults to today
+
+    Returns:
+    The amount charged
+    """
+    return sum(_accrue_range(cursor, as_of or datetime.now().date(), transaction_id, transaction_id)[1].values())
+
+def accrue_transaction_fines(cursor, transaction_ids, as_of=None):
+    """
+    Like accrue_transaction_fine for several loans at once, with one
+    statement per step whatever the number of loans.
+
+    Returns:
+    dict: Amount charged by transaction_id, for the loans charged anything
+    """
+    transaction_ids = list(transaction_ids)
+    if not transaction_ids:
+        return {}
+    ids_sql = f"IN ({', '.join(['%s'] * len(transaction_ids))})"
+    if _charge(cursor, as_of or datetime.now().date(), ids_sql, transaction_ids) <= 0:
+        return {}
+    cursor.execute(f"""SELECT transaction_id, SUM(amount) FROM fine_ledger
+                       WHERE posted = FALSE AND transaction_id {ids_sql}
+                       GROUP BY transaction_id""", transaction_ids)
+    amounts = dict(cursor.fetchall())
+    _post(cursor, ids_sql, transaction_ids)
+    return amounts
+
+@timed
+def accrue_fines(as_of=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Charges fines for every open overdue loan, in set-based passes over
+    chunks of the transactions table.
+
+    Each chunk adds one fine_ledger row per loan with the days it became
+    overdue since it was last charged, and adds the amounts to users.fines,
+    in one database transaction. The ledger's unique (transaction_id,
+    accrual_date) key and its per-loan running total of charged days make
+    the run idempotent: running it again for the same date charges nothing,
+    and a missed day is caught up by the next run.
+
+    Parameters:
+    as_of (date): Date to charge fines up to, defaults to today
+    chunk_size (int): Number of transaction ids processed per database transaction
+
+    Returns:
+    dict: Dictionary with the keys loans (loans charged), amount (total charged) and elapsed (seconds)
+    """
+    as_of = as_of or datetime.now().date()
+    stats = {"loans": 0, "amount": 0, "elapsed": 0.0}
+    started = time.monotonic()
+
+    with get_connection() as connection:
+        if not connection:
+            return stats
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT MIN(transaction_id), MAX(transaction_id) FROM transactions WHERE return_date IS NULL AND due_date < %s",
+                           (as_of,))
+            first_id, last_id = cursor.fetchone()
+            connection.commit()
+            if first_id is not None:
+                for chunk_start in range(first_id, last_id + 1, chunk_size):
+                    loans, amounts = _accrue_range(cursor, as_of, chunk_start, min(chunk_start + chunk_size - 1, last_id))
+                    connection.commit()
+                    stats["loans"] += loans
+                    stats["amount"] += sum(amounts.values())
+                    if loans:
+                        event_log.record_many({'type': event_log.FINE_CHARGED, 'user_id': user_id, 'amount': amount}
+                                              for user_id, amount in amounts.items())
+                        user_fine_cache.clear()
+        except Error as err:
+            connection.rollback()
+            print(f"Error: {err}")
+        finally:
+            cursor.close()
+
+    stats["elapsed"] = time.monotonic() - started
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Charge fines for all overdue loans. Safe to run more than once a day.")
+    parser.add_argument("--as-of", type=date.fromisoformat, help="Charge fines up to this date (YYYY-MM-DD), defaults to today")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Transaction ids processed per database transaction")
+    args = parser.parse_args()
+
+    stats = accrue_fines(args.as_of, args.chunk_size)
+    print(f"Charged {stats['loans']} overdue loans a total of {stats['amount']} in {stats['elapsed']:.1f}s.")
+
+if __name__ == "__main__":
+    main()
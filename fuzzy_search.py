@@ -0,0 +1,272 @@
+# fuzzy_search.py
+import math
+import os
+import threading
+import time
+from array import array
+
+from db_config import get_connection, Error
+from catalog_management import tokenize
+from metrics import timed
+
+# Columns whose words are matched with typos
+FUZZY_FIELDS = ('title', 'author', 'subject_tags')
+# Trigram similarity (Jaccard) a word needs to count as a match, overridable from .env
+MIN_SIMILARITY = float(os.environ.get('FUZZY_MIN_SIMILARITY') or 0.3)
+# Catalog words a query word is expanded to
+MAX_EXPANSIONS = 5
+# Query words shorter than this are only matched exactly, they have too few trigrams to compare
+MIN_FUZZY_LENGTH = 4
+# Books returned by a fuzzy search
+FUZZY_RESULT_LIMIT = 50
+# Rows fetched per round trip while building
+BUILD_FETCH_SIZE = 5000
+
+def trigrams(term):
+    """
+    Returns the set of character trigrams of a term, padded like pg_trgm
+    so the start and end of the word count as trigrams of their own.
+    """
+    padded = f"  {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TrigramIndex:
+    """
+    A character-trigram index over the words of the catalog, for matching
+    misspelled query words to the words books are indexed under.
+
+    Each distinct word gets an id, and each trigram a posting list of the
+    ids of the words containing it, in ascending order. A query word is
+    compared only with words that share enough of its trigrams: a word
+    with a Jaccard similarity of at least s to a query word with n
+    trigrams shares at least ceil(s * n) of them, so it must appear in at
+    least one of the n - ceil(s * n) + 1 shortest posting lists of the
+    query's trigrams, and the longer lists are never read. Candidates are
+    then ranked by their exact similarity.
+
+    The index holds the vocabulary rather than the books, so its size
+    grows with the number of distinct words, not with the catalog.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._term_ids = {}
+        self._terms = []
+        # Number of books each word occurs in, to prefer common words on ties
+        self._book_counts = array('i')
+        self._postings = {}
+        # Words added while load() builds a replacement, replayed into it before the swap
+        self._pending = None
+        self.ready = False
+
+    def _add_terms(self, terms):
+        for term in terms:
+            term_id = self._term_ids.get(term)
+            if term_id is not None:
+                self._book_counts[term_id] += 1
+                continue
+            term_id = len(self._terms)
+            self._term_ids[term] = term_id
+            self._terms.append(term)
+            self._book_counts.append(1)
+            for gram in trigrams(term):
+                posting = self._postings.get(gram)
+                if posting is None:
+                    self._postings[gram] = array('i', [term_id])
+                else:
+                    # Ids only grow, so appending keeps the list sorted
+                    posting.append(term_id)
+
+    def add_book(self, book):
+        """
+        Adds the words of a book, a dict keyed by column name.
+        """
+        terms = {term for field in FUZZY_FIELDS for term in tokenize(book.get(field))}
+        with self._lock:
+            self._add_terms(terms)
+            if self._pending is not None:
+                self._pending.append(terms)
+
+    def load(self, books):
+        """
+        Replaces the index with the words of books, an iterable of dicts
+        keyed by column name. Lookups keep using the old index until the
+        new one is complete, and words added meanwhile are carried over to it.
+        """
+        with self._lock:
+            self._pending = []
+        try:
+            staging = TrigramIndex()
+            for book in books:
+                staging._add_terms({term for field in FUZZY_FIELDS for term in tokenize(book.get(field))})
+            with self._lock:
+                for terms in self._pending:
+                    staging._add_terms(terms)
+                self._term_ids, self._terms = staging._term_ids, staging._terms
+                self._book_counts, self._postings = staging._book_counts, staging._postings
+                self.ready = True
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def similar(self, word, limit=MAX_EXPANSIONS, min_similarity=MIN_SIMILARITY):
+        """
+        Finds the catalog words most similar to a query word.
+
+        Parameters:
+        word (str): Normalized query word, e.g. from tokenize()
+        limit (int): Maximum number of words returned
+        min_similarity (float): Smallest Jaccard similarity of trigram sets returned
+
+        Returns:
+        list: (word, similarity) tuples, most similar first
+        """
+        query_grams = trigrams(word)
+        # Fewest shared trigrams a match can have, see the class docstring
+        needed = max(1, math.ceil(min_similarity * len(query_grams)))
+        with self._lock:
+            postings = sorted((self._postings.get(gram, ()) for gram in query_grams), key=len)
+            candidates = set()
+            for posting in postings[:len(query_grams) - needed + 1]:
+                candidates.update(posting)
+
+            matches = []
+            for term_id in candidates:
+                term = self._terms[term_id]
+                term_grams = trigrams(term)
+                shared = len(query_grams & term_grams)
+                similarity = shared / (len(query_grams) + len(term_grams) - shared)
+                if similarity >= min_similarity:
+                    matches.append((similarity, self._book_counts[term_id], term))
+        matches.sort(reverse=True)
+        return [(term, similarity) for similarity, _, term in matches[:limit]]
+
+    def stats(self):
+        """
+        Returns the number of words and trigrams indexed.
+        """
+        with self._lock:
+            return {"terms": len(self._terms), "trigrams": len(self._postings), "ready": self.ready}
+
+trigram_index = TrigramIndex()
+
+def _stream_books(fetch_size):
+    with get_connection(readonly=True) as connection:
+        if not connection:
+            return
+        cursor = connection.cursor(dictionary=True, buffered=False)
+        finished = False
+        try:
+            cursor.execute(f"SELECT {', '.join(FUZZY_FIELDS)} FROM books")
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    finished = True
+                    break
+                yield from rows
+        finally:
+            if not finished and connection.unread_result:
+                connection.consume_results()
+            cursor.close()
+
+def build_trigram_index(fetch_size=BUILD_FETCH_SIZE):
+    """
+    Builds the shared trigram index from a streaming scan of the books table.
+
+    Returns:
+    float: Seconds the build took
+    """
+    started = time.monotonic()
+    try:
+        trigram_index.load(_stream_books(fetch_size))
+    except Error as err:
+        print(f"Error: {err}")
+    return time.monotonic() - started
+
+_build_thread = None
+_build_lock = threading.Lock()
+
+def start_trigram_build():
+    """
+    Builds the shared trigram index on a daemon thread, once per process.
+    """
+    global _build_thread
+    with _build_lock:
+        if _build_thread is None:
+            _build_thread = threading.Thread(target=build_trigram_index, name="trigram-build", daemon=True)
+            _build_thread.start()
+
+def fuzzy_ready():
+    """
+    Returns whether the shared trigram index can expand keywords, starting its build if needed.
+    """
+    start_trigram_build()
+    return trigram_index.ready
+
+def expand_keyword(keyword):
+    """
+    Maps the words of a keyword to the catalog words they may be
+    misspellings of. Short words and numbers are kept as they are.
+
+    Returns:
+    dict: Similarity by catalog word, the highest if several query words
+    expand to it. Empty while the trigram index is being built, see fuzzy_ready()
+    """
+    # Searches do not wait for the index, they find no close matches until it is built
+    if not fuzzy_ready():
+        return {}
+    expansions = {}
+    for word in dict.fromkeys(tokenize(keyword)):
+        if len(word) < MIN_FUZZY_LENGTH or word.isdigit():
+            matches = [(word, 1.0)]
+        else:
+            matches = trigram_index.similar(word)
+        for term, similarity in matches:
+            if similarity > expansions.get(term, 0):
+                expansions[term] = similarity
+    return expansions
+
+@timed
+def fuzzy_search_books(keyword, limit=FUZZY_RESULT_LIMIT):
+    """
+    Searches the catalog allowing for typos, e.g. for when search_books
+    finds nothing.
+
+    Each query word is expanded to the most similar words in titles,
+    authors and subject tags with the trigram index, and books are looked
+    up under those words in the book_search_terms index. A book's score is
+    the weight of each matching word times its similarity to the query
+    word, so exact and close matches rank first. Finds nothing while the
+    trigram index is being built, see fuzzy_ready().
+
+    Parameters:
+    keyword (str): Keyword to search for
+    limit (int): Maximum number of results
+
+    Returns:
+    list: List of dictionaries containing the book details and their score, best match first
+    """
+    expansions = expand_keyword(keyword)
+    if not expansions:
+        return []
+    terms = list(expansions)
+    cases = " ".join("WHEN %s THEN %s" for _ in terms)
+    case_params = [value for term in terms for value in (term, round(expansions[term], 3))]
+    query = f"""SELECT b.*, s.score FROM books b
+                JOIN (SELECT book_id, SUM(weight * CASE term {cases} ELSE 0 END) AS score FROM book_search_terms
+                      WHERE term IN ({', '.join(['%s'] * len(terms))})
+                      GROUP BY book_id) s ON s.book_id = b.book_id
+                ORDER BY s.score DESC, b.book_id
+                LIMIT %s"""
+
+    with get_connection(readonly=True) as connection:
+        if connection:
+            cursor = connection.cursor(dictionary=True)
+            try:
+                cursor.execute(query, case_params + terms + [limit])
+                return cursor.fetchall()
+            except Error as err:
+                print(f"Error: {err}")
+            finally:
+                cursor.close()
+    return []
@@ -0,0 +1,311 @@
+# holds.py
+from db_config import get_connection, Error
+from cache import book_cache
+from metrics import timed
+import event_log
+import argparse
+import time
+from datetime import date, datetime, timedelta
+
+# Hold queue priority by membership category, lower is served first. Holds
+# of the same priority are served in the order they were placed.
+HOLD_PRIORITIES = {'staff': 0, 'student': 1, 'public': 2}
+DEFAULT_PRIORITY = 2
+# Days a returned copy is kept for the holder before it passes to the next hold
+HOLD_PICKUP_DAYS = 7
+# Expired holds processed per transaction by expire_holds()
+EXPIRY_CHUNK_SIZE = 1000
+
+# An active reservation is either waiting for a copy (hold_expires IS NULL)
+# or has a copy set aside until hold_expires. Collected holds become
+# 'completed', cancelled and expired ones 'cancelled'.
+
+def priority_sql(column):
+    """
+    Returns an SQL expression mapping a membership category column to its hold priority.
+    """
+    cases = " ".join(f"WHEN '{category}' THEN {priority}" for category, priority in HOLD_PRIORITIES.items())
+    return f"CASE {column} {cases} ELSE {DEFAULT_PRIORITY} END"
+
+# The next waiting holds of a book, read from the front of idx_reservations_hold_queue
+NEXT_HOLDS_QUERY = """SELECT reservation_id, user_id, book_id FROM reservations
+                      WHERE book_id = %s AND status = 'active' AND hold_expires IS NULL
+                      ORDER BY priority, reservation_id
+                      LIMIT %s FOR UPDATE"""
+
+# Holds whose pickup window has passed, read from idx_reservations_hold_expiry
+EXPIRED_HOLDS_QUERY = """SELECT reservation_id, book_id, user_id FROM reservations
+                         WHERE status = 'active' AND hold_expires < %s
+                         ORDER BY hold_expires, reservation_id
+                         LIMIT %s FOR UPDATE"""
+
+def release_copies(cursor, book_id, copies, as_of=None):
+    """
+    Hands copies of a book that came back (a return, a cancelled or expired
+    hold) to the next waiting holds, and puts the rest back on the shelf.
+    The caller owns the database transaction.
+
+    Parameters:
+    cursor: Cursor of the connection to write with
+    book_id (int): The book
+    copies (int): Number of copies that came back
+    as_of (date): Date the copies came back, defaults to today
+
+    Returns:
+    list: (reservation_id, user_id) of the holds the copies were set aside for
+    """
+    return release_book_copies(cursor, {book_id: copies}, as_of).get(book_id, [])
+
+def release_book_copies(cursor, copies_by_book, as_of=None):
+    """
+    Like release_copies for several books at once, e.g. a batch of returns.
+
+    Parameters:
+    cursor: Cursor of the connection to write with
+    copies_by_book (dict): Number of copies that came back by book_id
+    as_of (date): Date the copies came back, defaults to today
+
+    Returns:
+    dict: (reservation_id, user_id) of the holds the copies were set aside for, by book_id
+    """
+    as_of = as_of or datetime.now().date()
+    book_ids = sorted(copies_by_book)
+    placeholders = ", ".join(["%s"] * len(book_ids))
+    # Lock the books first, in a fixed order, so a hold placed concurrently
+    # is either seen here or sees the copy
+    cursor.execute(f"SELECT book_id FROM books WHERE book_id IN ({placeholders}) ORDER BY book_id FOR UPDATE", book_ids)
+    cursor.fetchall()
+    if len(book_ids) == 1:
+        # Reads only the front of the queue
+        cursor.execute(NEXT_HOLDS_QUERY, (book_ids[0], copies_by_book[book_ids[0]]))
+    else:
+        # One read of the books' queues instead of one per book; most books have none
+        cursor.execute(f"""SELECT reservation_id, user_id, book_id FROM reservations
+                           WHERE book_id IN ({placeholders}) AND status = 'active' AND hold_expires IS NULL
+                           ORDER BY book_id, priority, reservation_id FOR UPDATE""", book_ids)
+    promoted = {}
+    for reservation_id, user_id, book_id in cursor.fetchall():
+        holds = promoted.setdefault(book_id, [])
+        if len(holds) < copies_by_book[book_id]:
+            holds.append((reservation_id, user_id))
+
+    reservation_ids = [reservation_id for holds in promoted.values() for reservation_id, _ in holds]
+    if reservation_ids:
+        cursor.execute(f"UPDATE reservations SET hold_expires = %s WHERE reservation_id IN ({', '.join(['%s'] * len(reservation_ids))})",
+                       [as_of + timedelta(days=HOLD_PICKUP_DAYS)] + reservation_ids)
+    shelved = [(book_id, copies - len(promoted.get(book_id, []))) for book_id, copies in sorted(copies_by_book.items())]
+    shelved = [(book_id, copies) for book_id, copies in shelved if copies > 0]
+    if shelved:
+        cases = " ".join("WHEN %s THEN %s" for _ in shelved)
+        cursor.execute(f"""UPDATE books SET available_copies = available_copies + CASE book_id {cases} END
+                           WHERE book_id IN ({', '.join(['%s'] * len(shelved))})""",
+                       [value for pair in shelved for value in pair] + [book_id for book_id, _ in shelved])
+    return promoted
+
+def collect_hold(cursor, user_id, book_id):
+    """
+    Marks the copy set aside for a user's hold on a book as collected, if
+    there is one and the user owes nothing. The caller owns the database
+    transaction and records the loan.
+
+    Returns:
+    bool: True if a held copy was collected
+    """
+    cursor.execute("""UPDATE reservations SET status = 'completed'
+                      WHERE user_id = %s AND book_id = %s AND status = 'active' AND hold_expires IS NOT NULL
+                      AND NOT EXISTS (SELECT 1 FROM users WHERE user_id = %s AND fines > 0)""",
+                   (user_id, book_id, user_id))
+    return cursor.rowcount > 0
+
+def estimate_wait(due_dates, ahead, today):
+    """
+    Estimates the days until a waiting hold gets a copy.
+
+    The holds ahead take the copies in the order their loans are due; once
+    every loan has come back once, each copy comes back again one loan
+    period later.
+
+    Parameters:
+    due_dates (list): (issue_date, due_date) of the book's open loans, soonest due first
+    ahead (int): Number of waiting holds ahead of this one
+    today (date): Date to count from
+
+    Returns:
+    int: Estimated days, or None if no copy is on loan to estimate from
+    """
+    if not due_dates:
+        return None
+    issue_date, due_date = due_dates[ahead % len(due_dates)]
+    due_date += (ahead // len(due_dates)) * max(due_date - issue_date, timedelta(days=1))
+    return max((due_date - today).days, 0)
+
+def _open_loan_dates(cursor, book_ids):
+    placeholders = ", ".join(["%s"] * len(book_ids))
+    cursor.execute(f"""SELECT book_id, issue_date, due_date FROM transactions
+                       WHERE book_id IN ({placeholders}) AND return_date IS NULL
+                       ORDER BY due_date""", list(book_ids))
+    dates = {}
+    for book_id, issue_date, due_date in cursor.fetchall():
+        dates.setdefault(book_id, []).append((issue_date, due_date))
+    return dates
+
+# Counts the waiting holds ahead of a hold from idx_reservations_hold_queue,
+# without touching the table rows
+_AHEAD_SQL = """(SELECT COUNT(*) FROM reservations q
+                 WHERE q.book_id = r.book_id AND q.status = 'active' AND q.hold_expires IS NULL
+                 AND (q.priority < r.priority OR (q.priority = r.priority AND q.reservation_id < r.reservation_id)))"""
+
+def _holds(cursor, condition, params):
+    cursor.execute(f"""SELECT r.reservation_id, r.user_id, r.book_id, r.reservation_date, r.hold_expires,
+                              b.title, b.author, {_AHEAD_SQL} AS ahead
+                       FROM reservations r
+                       JOIN books b ON b.book_id = r.book_id
+                       WHERE {condition} AND r.status = 'active'
+                       ORDER BY r.reservation_id""", params)
+    rows = cursor.fetchall()
+    today = datetime.now().date()
+    waiting = {row[2] for row in rows if row[4] is None}
+    loan_dates = _open_loan_dates(cursor, waiting) if waiting else {}
+
+    holds = []
+    for reservation_id, user_id, book_id, reservation_date, hold_expires, title, author, ahead in rows:
+        ready = hold_expires is not None
+        holds.append({
+            'reservation_id': reservation_id,
+            'user_id': user_id,
+            'book_id': book_id,
+            'title': title,
+            'author': author,
+            'reservation_date': reservation_date,
+            'ready': ready,
+            'hold_expires': hold_expires,
+            'position': None if ready else ahead + 1,
+            'estimated_wait_days': 0 if ready else estimate_wait(loan_dates.get(book_id), ahead, today),
+        })
+    return holds
+
+def get_hold(cursor, reservation_id):
+    """
+    Returns an active hold with its queue position and estimated wait, see get_user_holds, or None.
+    """
+    holds = _holds(cursor, "r.reservation_id = %s", (reservation_id,))
+    return holds[0] if holds else None
+
+@timed
+def get_user_holds(user_id):
+    """
+    Returns a user's active holds.
+
+    Parameters:
+    user_id (int): The user ID.
+
+    Returns:
+    list: One dictionary per hold, oldest first, with the keys reservation_id, user_id, book_id,
+          title, author, reservation_date, ready (a copy is set aside), hold_expires (last day
+          to collect it), position (1 is next in line, None when ready) and estimated_wait_days
+          (None if it cannot be estimated)
+    """
+    with get_connection() as connection:
+        if not connection:
+            return []
+        cursor = connection.cursor()
+        try:
+            return _holds(cursor, "r.user_id = %s", (user_id,))
+        finally:
+            cursor.close()
+
+@timed
+def get_queue_length(book_id):
+    """
+    Returns the number of holds waiting for a copy of a book.
+    """
+    with get_connection() as connection:
+        if not connection:
+            return 0
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM reservations WHERE book_id = %s AND status = 'active' AND hold_expires IS NULL",
+                       (book_id,))
+        length = cursor.fetchone()[0]
+        cursor.close()
+    return length
+
+@timed
+def expire_holds(as_of=None, chunk_size=EXPIRY_CHUNK_SIZE):
+    """
+    Cancels every hold whose copy was not collected in time and passes the
+    copies on, in chunks of expired holds.
+
+    Each chunk cancels its holds with one UPDATE and then sets the freed
+    copies aside for the next waiting holds of their books or puts them
+    back on the shelf, with a few statements for the whole chunk, in one
+    database transaction. Copies set aside by this run
+    expire HOLD_PICKUP_DAYS later, so running it again for the same date
+    changes nothing.
+
+    Parameters:
+    as_of (date): Holds whose hold_expires is before this date expire, defaults to today
+    chunk_size (int): Number of expired holds processed per database transaction
+
+    Returns:
+    dict: Dictionary with the keys expired, promoted (holds given a copy), shelved (copies
+          put back on the shelf) and elapsed (seconds)
+    """
+    as_of = as_of or datetime.now().date()
+    stats = {"expired": 0, "promoted": 0, "shelved": 0, "elapsed": 0.0}
+    started = time.monotonic()
+
+    with get_connection() as connection:
+        if not connection:
+            return stats
+        cursor = connection.cursor()
+        try:
+            while True:
+                cursor.execute(EXPIRED_HOLDS_QUERY, (as_of, chunk_size))
+                expired = cursor.fetchall()
+                if not expired:
+                    connection.commit()
+                    break
+                placeholders = ", ".join(["%s"] * len(expired))
+                cursor.execute(f"UPDATE reservations SET status = 'cancelled' WHERE reservation_id IN ({placeholders})",
+                               [reservation_id for reservation_id, _, _ in expired])
+                freed = {}
+                for _, book_id, _ in expired:
+                    freed[book_id] = freed.get(book_id, 0) + 1
+                promoted_by_book = release_book_copies(cursor, freed, as_of)
+                promoted = sum(len(holds) for holds in promoted_by_book.values())
+                stats["promoted"] += promoted
+                stats["shelved"] += len(expired) - promoted
+                connection.commit()
+                # Of each book's freed copies, those no waiting hold took went back on the shelf
+                shelved = {book_id: copies - len(promoted_by_book.get(book_id, [])) for book_id, copies in freed.items()}
+                events = []
+                for reservation_id, book_id, user_id in expired:
+                    events.append({'type': event_log.HOLD_EXPIRED, 'user_id': user_id, 'book_id': book_id,
+                                   'ref_id': reservation_id, 'copies': 1 if shelved[book_id] > 0 else 0})
+                    shelved[book_id] -= 1
+                event_log.record_many(events)
+                stats["expired"] += len(expired)
+                book_cache.clear()
+                if len(expired) < chunk_size:
+                    break
+        except Error as err:
+            connection.rollback()
+            print(f"Error: {err}")
+        finally:
+            cursor.close()
+
+    stats["elapsed"] = time.monotonic() - started
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Expire uncollected holds and pass their copies on. Safe to run more than once a day.")
+    parser.add_argument("--as-of", type=date.fromisoformat, help="Expire holds not collected before this date (YYYY-MM-DD), defaults to today")
+    parser.add_argument("--chunk-size", type=int, default=EXPIRY_CHUNK_SIZE, help="Expired holds processed per database transaction")
+    args = parser.parse_args()
+
+    stats = expire_holds(args.as_of, args.chunk_size)
+    print(f"Expired {stats['expired']} holds, passed {stats['promoted']} copies to the next holds "
+          f"and shelved {stats['shelved']} in {stats['elapsed']:.1f}s.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+# http_api.py
+import argparse
+import asyncio
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from urllib.parse import urlsplit, parse_qs
+
+import db_config
+import library_service
+import metrics
+from cache import cache_stats
+from fuzzy_search import start_trigram_build
+from facets import start_facet_build, FACETS
+from event_log import start_cache_follower, start_index_follower
+from circulation import (ISSUED, RETURNED, NOT_AVAILABLE, OUTSTANDING_FINES, NOT_FOUND, DB_ERROR,
+                         HOLD_PLACED, HOLD_CANCELLED, ALREADY_HELD, BOOK_AVAILABLE)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+# Largest request body accepted, in bytes
+MAX_BODY_SIZE = 64 * 1024
+# Seconds an idle keep-alive connection is kept open
+KEEP_ALIVE_TIMEOUT = 15
+
+# HTTP status of each service result code
+HTTP_STATUSES = {
+    library_service.OK: 200,
+    ISSUED: 201,
+    RETURNED: 200,
+    library_service.INVALID: 400,
+    NOT_FOUND: 404,
+    NOT_AVAILABLE: 409,
+    OUTSTANDING_FINES: 409,
+    HOLD_PLACED: 201,
+    HOLD_CANCELLED: 200,
+    ALREADY_HELD: 409,
+    BOOK_AVAILABLE: 409,
+    library_service.CONFLICT: 409,
+    library_service.UNAUTHORIZED: 401,
+    library_service.FORBIDDEN: 403,
+    DB_ERROR: 503,
+}
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+def encode_cursor(cursor):
+    """
+    Encodes a search_books_page keyset cursor as an opaque "score:book_id" string.
+    """
+    if cursor is None:
+        return None
+    return f"{cursor[0]}:{cursor[1]}"
+
+def decode_cursor(value):
+    """
+    Decodes a cursor made by encode_cursor, raising HTTPError 400 if it is malformed.
+    """
+    if not value:
+        return None
+    try:
+        score, book_id = value.split(":")
+        return Decimal(score), int(book_id)
+    except (ValueError, InvalidOperation):
+        raise HTTPError(400, "Malformed cursor.")
+
+def _int(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise HTTPError(400, f"{name} must be an integer.")
+
+def _search(query, body, session):
+    page = library_service.search(query.get('q', [''])[0],
+                                  page_size=_int(query.get('page_size', [library_service.SEARCH_PAGE_SIZE])[0], 'page_size'),
+                                  after=decode_cursor(query.get('after', [None])[0]),
+                                  fuzzy=query.get('fuzzy', ['0'])[0] in ('1', 'true'),
+                                  filters={facet: query[facet][0] for facet in FACETS if facet in query},
+                                  with_facets=query.get('facets', ['0'])[0] in ('1', 'true'))
+    if 'next_cursor' in page:
+        page['next_cursor'] = encode_cursor(page['next_cursor'])
+    return page
+
+def _int_list(value, name):
+    if not isinstance(value, list):
+        raise HTTPError(400, f"{name} must be a list of integers.")
+    return [_int(item, name) for item in value]
+
+def _register(query, body, session):
+    return library_service.register(session, body.get('username'), body.get('password'), body.get('full_name'),
+                                    body.get('email'), body.get('phone'), body.get('membership_category'))
+
+def _pay_fine(query, body, session, user_id):
+    try:
+        amount = Decimal(str(body.get('amount')))
+    except InvalidOperation:
+        raise HTTPError(400, "amount must be a number.")
+    if not amount.is_finite():
+        raise HTTPError(400, "amount must be a number.")
+    return library_service.pay_fine(session, _int(user_id, 'user_id'), amount)
+
+def _bearer_token(headers):
+    scheme, _, token = headers.get('authorization', '').partition(' ')
+    return token.strip() if scheme.lower() == 'bearer' else None
+
+# (method, path pattern, handler). Handlers take the query string, JSON body
+# and session (None without a valid bearer token) followed by the path
+# parameters, and run on a worker thread.
+ROUTES = [
+    ('GET', r'/health', lambda query, body, session: {'status': library_service.OK}),
+    ('GET', r'/stats', lambda query, body, session: {'status': library_service.OK, 'caches': cache_stats(),
+                                                          'replicas': db_config.get_router().stats() if db_config.get_router() else [],
+                                                          'metrics': metrics.snapshot()}),
+    ('GET', r'/books', _search),
+    ('GET', r'/books/(\d+)', lambda query, body, session, book_id: library_service.get_book(int(book_id))),
+    ('GET', r'/users/(\d+)/loans', lambda query, body, session, user_id: library_service.list_loans(session, int(user_id))),
+    ('POST', r'/loans', lambda query, body, session: library_service.issue(session, _int(body.get('user_id'), 'user_id'),
+                                                                            _int(body.get('book_id'), 'book_id'))),
+    ('POST', r'/loans/batch', lambda query, body, session: library_service.issue_many(session, _int(body.get('user_id'), 'user_id'),
+                                                                                       _int_list(body.get('book_ids'), 'book_ids'))),
+    ('POST', r'/returns', lambda query, body, session: library_service.return_many(session, _int_list(body.get('transaction_ids'),
+                                                                                                       'transaction_ids'))),
+    ('POST', r'/loans/(\d+)/return', lambda query, body, session, transaction_id: library_service.return_loan(session, int(transaction_id))),
+    ('GET', r'/users/(\d+)/holds', lambda query, body, session, user_id: library_service.list_holds(session, int(user_id))),
+    ('POST', r'/holds', lambda query, body, session: library_service.hold(session, _int(body.get('user_id'), 'user_id'),
+                                                                           _int(body.get('book_id'), 'book_id'))),
+    ('POST', r'/holds/(\d+)/cancel', lambda query, body, session, reservation_id: library_service.cancel(session, int(reservation_id))),
+    ('POST', r'/sessions', lambda query, body, session: library_service.login(body.get('username') or '', body.get('password') or '')),
+    ('DELETE', r'/sessions', lambda query, body, session: library_service.logout(session and session['token'])),
+    ('POST', r'/users', _register),
+    ('POST', r'/users/(\d+)/fine-payments', _pay_fine),
+]
+ROUTES = [(method, re.compile(pattern + '$'), handler) for method, pattern, handler in ROUTES]
+
+def route(method, path):
+    """
+    Finds the handler of a request.
+
+    Returns:
+    tuple: (handler, path parameters)
+    """
+    allowed = False
+    for route_method, pattern, handler in ROUTES:
+        match = pattern.match(path)
+        if match:
+            if route_method == method:
+                return handler, match.groups()
+            allowed = True
+    if allowed:
+        raise HTTPError(405, "Method not allowed.")
+    raise HTTPError(404, "No such endpoint.")
+
+class LibraryServer:
+    """
+    An asyncio HTTP/1.1 server exposing library_service as a JSON API.
+
+    Connections are handled by the event loop, so thousands of idle or
+    slow clients cost no threads. Service calls, which block on the
+    database, run on a thread pool the size of the connection pool and
+    share its connections.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, workers=None):
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=workers or db_config.POOL_SIZE, thread_name_prefix="api-worker")
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line.strip():
+                    break
+                keep_alive = await self.handle_request(request_line, reader, writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, request_line, reader, writer):
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            await self.respond(writer, 400, {'status': library_service.INVALID, 'message': "Malformed request line."}, False)
+            return False
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+        # Until the body has been read the stream is not at the next request,
+        # so a request that fails before then closes the connection
+        body_read = False
+        try:
+            length = _int(headers.get('content-length', 0), 'Content-Length')
+            if length < 0:
+                raise HTTPError(400, "Content-Length must not be negative.")
+            if length > MAX_BODY_SIZE:
+                raise HTTPError(413, "Request body too large.")
+            raw_body = await reader.readexactly(length) if length else b''
+            body_read = True
+            try:
+                body = json.loads(raw_body) if raw_body else {}
+            except ValueError:
+                raise HTTPError(400, "Body must be JSON.")
+            if not isinstance(body, dict):
+                raise HTTPError(400, "Body must be a JSON object.")
+
+            url = urlsplit(target)
+            handler, params = route(method.upper(), url.path.rstrip('/') or '/')
+            loop = asyncio.get_running_loop()
+            session = library_service.get_session(_bearer_token(headers))
+            result = await loop.run_in_executor(self.executor, lambda: handler(parse_qs(url.query), body, session, *params))
+            status = HTTP_STATUSES.get(result.get('status'), 200)
+        except HTTPError as err:
+            status, result = err.status, {'status': library_service.INVALID, 'message': err.message}
+        except db_config.PoolTimeoutError as err:
+            status, result = 503, {'status': DB_ERROR, 'message': f"{err}"}
+        except Exception as err:
+            print(f"Error: {err}")
+            status, result = 500, {'status': DB_ERROR, 'message': "Internal server error."}
+        if not body_read:
+            keep_alive = False
+
+        await self.respond(writer, status, result, keep_alive)
+        return keep_alive
+
+    async def respond(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload, default=_json_default).encode()
+        challenge = "WWW-Authenticate: Bearer\r\n" if status == 401 else ""
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"{challenge}"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + body)
+        await writer.drain()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_client, self.host, self.port, backlog=1024)
+        print(f"Library API listening on http://{self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the library as a local JSON/HTTP API.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--workers", type=int, help="Threads running database calls, defaults to DB_POOL_SIZE")
+    args = parser.parse_args()
+    start_trigram_build()
+    start_facet_build()
+    start_cache_follower()
+    start_index_follower()
+    try:
+        asyncio.run(LibraryServer(args.host, args.port, args.workers).serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+# library_service.py
+import os
+import secrets
+import threading
+import time
+from decimal import Decimal
+
+from catalog_management import search_books_page, get_book_by_id, SEARCH_PAGE_SIZE
+from circulation import (get_loan_dashboard, issue_book, return_book, issue_books, return_books, place_hold, cancel_hold,
+                         get_loan_owners, get_hold_owner, DB_ERROR, NOT_FOUND)
+from holds import get_user_holds
+from user_management import authenticate_user, register_member, get_user_id, pay_user_fine
+
+# Result codes of the service functions, in addition to those of circulation
+OK = 'ok'
+INVALID = 'invalid'
+CONFLICT = 'conflict'
+UNAUTHORIZED = 'unauthorized'
+FORBIDDEN = 'forbidden'
+
+# Largest page a client may ask for
+MAX_PAGE_SIZE = 200
+# Most items one checkout or return session may scan
+MAX_BATCH_SIZE = 100
+MEMBERSHIP_CATEGORIES = ('student', 'staff', 'public')
+# Roles that may act for any borrower, take fine payments and register student and staff members
+STAFF_ROLES = ('admin', 'librarian')
+# Seconds a session token stays valid after login
+SESSION_TTL = float(os.environ.get('API_SESSION_TTL') or 8 * 3600)
+
+# Session by token. Kept in memory, so tokens are valid only in the process that issued them.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def _result(status, message=None, **details):
+    result = {'status': status}
+    if message:
+        result['message'] = message
+    result.update(details)
+    return result
+
+def _authorize(session, user_id=None, staff_only=False):
+    """
+    Checks that a session may act for a user. Staff may act for anyone,
+    borrowers only for themselves.
+
+    Returns:
+    dict: An UNAUTHORIZED or FORBIDDEN result, or None if the session is allowed
+    """
+    if session is None:
+        return _result(UNAUTHORIZED, "A valid session token is required.")
+    if session['role'] in STAFF_ROLES:
+        return None
+    if staff_only or session['user_id'] != user_id:
+        return _result(FORBIDDEN, "Not allowed for this user.")
+    return None
+
+def search(keyword, page_size=SEARCH_PAGE_SIZE, after=None, fuzzy=False, filters=None, with_facets=False):
+    """
+    Searches the catalog one page at a time.
+
+    Parameters:
+    keyword (str): Keyword to search for
+    page_size (int): Results per page, at most MAX_PAGE_SIZE
+    after (tuple): The next_cursor of the previous page, or None for the first page
+    fuzzy (bool): Whether a keyword that matches nothing is searched again allowing for typos
+    filters (dict): Facet values to narrow the results to, see facets.FACETS
+    with_facets (bool): Whether to count the matches of the first page per facet value
+
+    Returns:
+    dict: status OK with the keys of catalog_management.search_books_page, or INVALID
+    """
+    if not keyword or not keyword.strip():
+        return _result(INVALID, "A search keyword is required.")
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        return _result(INVALID, f"page_size must be between 1 and {MAX_PAGE_SIZE}.")
+    try:
+        page = search_books_page(keyword, page_size=page_size, after=after, fuzzy=fuzzy, filters=filters, with_facets=with_facets)
+    except ValueError as err:
+        return _result(INVALID, str(err))
+    return _result(OK, **page)
+
+def get_book(book_id):
+    """
+    Returns a book's details.
+
+    Returns:
+    dict: status OK with the key book, or NOT_FOUND
+    """
+    book = get_book_by_id(book_id)
+    if book is None:
+        return _result(NOT_FOUND, "Book not found.")
+    return _result(OK, book=book)
+
+def list_loans(session, user_id):
+    """
+    Returns a user's active loans and outstanding fines.
+
+    Returns:
+    dict: status OK with the keys of circulation.get_loan_dashboard, UNAUTHORIZED, FORBIDDEN or DB_ERROR
+    """
+    denied = _authorize(session, user_id)
+    if denied:
+        return denied
+    dashboard = get_loan_dashboard(user_id)
+    if dashboard is None:
+        return _result(DB_ERROR, "Could not connect to the database.")
+    return _result(OK, **dashboard)
+
+def issue(session, user_id, book_id):
+    """
+    Issues a book to a user.
+
+    Returns:
+    dict: The result of circulation.issue_book, UNAUTHORIZED or FORBIDDEN
+    """
+    denied = _authorize(session, user_id)
+    if denied:
+        return denied
+    return issue_book(user_id, book_id)
+
+def _authorize_returns(session, transaction_ids):
+    denied = _authorize(session, staff_only=True)
+    if denied and denied['status'] == FORBIDDEN:
+        # A borrower may return only their own loans
+        owners = get_loan_owners(transaction_ids)
+        if owners is None:
+            return _result(DB_ERROR, "Could not connect to the database.")
+        if all(owner == session['user_id'] for owner in owners.values()):
+            return None
+    return denied
+
+def return_loan(session, transaction_id):
+    """
+    Returns a borrowed book.
+
+    Returns:
+    dict: The result of circulation.return_book, UNAUTHORIZED, FORBIDDEN or DB_ERROR
+    """
+    denied = _authorize_returns(session, [transaction_id])
+    if denied:
+        return denied
+    return return_book(transaction_id)
+
+def issue_many(session, user_id, book_ids):
+    """
+    Issues several books to a user in one transaction.
+
+    Returns:
+    dict: The result of circulation.issue_books, UNAUTHORIZED, FORBIDDEN, or INVALID if there
+          are no or too many books
+    """
+    denied = _authorize(session, user_id)
+    if denied:
+        return denied
+    if not book_ids or len(book_ids) > MAX_BATCH_SIZE:
+        return _result(INVALID, f"Between 1 and {MAX_BATCH_SIZE} books are required.")
+    return issue_books(user_id, book_ids)
+
+def return_many(session, transaction_ids):
+    """
+    Returns several borrowed books in one transaction.
+
+    Returns:
+    dict: The result of circulation.return_books, UNAUTHORIZED, FORBIDDEN, DB_ERROR, or INVALID
+          if there are no or too many loans
+    """
+    if session is None:
+        return _authorize(session)
+    if not transaction_ids or len(transaction_ids) > MAX_BATCH_SIZE:
+        return _result(INVALID, f"Between 1 and {MAX_BATCH_SIZE} loans are required.")
+    denied = _authorize_returns(session, transaction_ids)
+    if denied:
+        return denied
+    return return_books(transaction_ids)
+
+def list_holds(session, user_id):
+    """
+    Returns a user's active holds with their queue positions and estimated waits.
+
+    Returns:
+    dict: status OK with the key holds (see holds.get_user_holds), UNAUTHORIZED or FORBIDDEN
+    """
+    denied = _authorize(session, user_id)
+    if denied:
+        return denied
+    return _result(OK, holds=get_user_holds(user_id))
+
+def hold(session, user_id, book_id):
+    """
+    Places a hold on a book.
+
+    Returns:
+    dict: The result of circulation.place_hold, UNAUTHORIZED or FORBIDDEN
+    """
+    denied = _authorize(session, user_id)
+    if denied:
+        return denied
+    return place_hold(user_id, book_id)
+
+def cancel(session, reservation_id):
+    """
+    Cancels a hold.
+
+    Returns:
+    dict: The result of circulation.cancel_hold, UNAUTHORIZED or FORBIDDEN
+    """
+    denied = _authorize(session, staff_only=True)
+    if denied and denied['status'] == FORBIDDEN:
+        # A borrower may cancel only their own holds; unknown holds are reported by cancel_hold
+        owner = get_hold_owner(reservation_id)
+        if owner is None or owner == session['user_id']:
+            denied = None
+    if denied:
+        return denied
+    return cancel_hold(reservation_id)
+
+def login(username, password):
+    """
+    Checks a user's credentials and opens a session.
+
+    Returns:
+    dict: status OK with the keys user (without the password hash), token (to send as
+          "Authorization: Bearer <token>") and expires_in (seconds), or INVALID
+    """
+    user = authenticate_user(username, password)
+    if not user:
+        return _result(INVALID, "Invalid credentials.")
+    user = dict(user)
+    user.pop('password', None)
+    token = secrets.token_urlsafe(32)
+    now = time.monotonic()
+    with _sessions_lock:
+        for expired in [key for key, session in _sessions.items() if session['expires'] <= now]:
+            del _sessions[expired]
+        _sessions[token] = {'token': token, 'user_id': user['user_id'], 'role': user['role'], 'expires': now + SESSION_TTL}
+    return _result(OK, user=user, token=token, expires_in=int(SESSION_TTL))
+
+def get_session(token):
+    """
+    Looks up the session of a token issued by login.
+
+    Returns:
+    dict: The session with the keys token, user_id and role, or None if the token is unknown or expired
+    """
+    if not token:
+        return None
+    with _sessions_lock:
+        session = _sessions.get(token)
+        if session is not None and session['expires'] <= time.monotonic():
+            del _sessions[token]
+            session = None
+    return session
+
+def logout(token):
+    """
+    Ends the session of a token.
+
+    Returns:
+    dict: status OK, or UNAUTHORIZED if the token is unknown or expired
+    """
+    with _sessions_lock:
+        session = _sessions.pop(token, None)
+    if session is None or session['expires'] <= time.monotonic():
+        return _result(UNAUTHORIZED, "A valid session token is required.")
+    return _result(OK)
+
+def register(session, username, password, full_name, email, phone, membership_category):
+    """
+    Registers a new borrower. Anyone may register a public member; student
+    and staff members must be registered by library staff.
+
+    Returns:
+    dict: status OK with the key user_id, INVALID if a field is missing, FORBIDDEN if a
+          borrower or anonymous caller registers a student or staff member, CONFLICT if the
+          username is taken, or DB_ERROR
+    """
+    if not all([username, password, full_name, email, phone, membership_category]):
+        return _result(INVALID, "All fields are required.")
+    if membership_category not in MEMBERSHIP_CATEGORIES:
+        return _result(INVALID, f"membership_category must be one of {', '.join(MEMBERSHIP_CATEGORIES)}.")
+    if membership_category != 'public' and (session is None or session['role'] not in STAFF_ROLES):
+        return _result(FORBIDDEN, "Student and staff members must be registered by library staff.")
+    if get_user_id(username):
+        return _result(CONFLICT, "Username is already taken.")
+    if not register_member(username, password, 'borrower', full_name, email, phone, membership_category):
+        return _result(DB_ERROR, "Registration failed.")
+    return _result(OK, user_id=get_user_id(username))
+
+def pay_fine(session, user_id, amount):
+    """
+    Records a fine payment taken by library staff.
+
+    Returns:
+    dict: status OK with the key remaining_fines, UNAUTHORIZED, FORBIDDEN, or INVALID if the
+          amount is not a positive number or more than the user owes
+    """
+    denied = _authorize(session, staff_only=True)
+    if denied:
+        return denied
+    if amount is None or not Decimal(amount).is_finite() or amount <= 0:
+        return _result(INVALID, "The amount must be positive.")
+    remaining = pay_user_fine(user_id, amount)
+    if remaining is None:
+        return _result(INVALID, "User not found or the amount is more than the outstanding fine.")
+    return _result(OK, remaining_fines=remaining)
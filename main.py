@@ -1,9 +1,9 @@
 # main.py
+import startup
 import tkinter as tk
-from tkinter import messagebox
-from user_management import get_user_fine, get_user_id, register_member, authenticate_user, update_user_fine
-from circulation import issue_book, get_transactions, return_book
-from catalog_management import search_books, get_book_by_id
+from tkinter import messagebox, ttk
+# The domain modules are imported by the windows that use them, so the login form is shown
+# without waiting for the database driver; startup.warm_up() imports them in the background.
 
 def show_login_window():
     """
@@ -23,26 +23,51 @@ def show_login_window():
     password_entry = tk.Entry(login_window, show="*")
     password_entry.grid(row=1, column=1, padx=10, pady=10)
 
+    status_label = tk.Label(login_window, text="")
+    status_label.grid(row=4, column=0, columnspan=2, pady=5)
+
     def login():
+        # Imported here rather than with the window, the warm-up has usually done it by the first click
+        from user_management import authenticate_user
+        from db_executor import run_in_background
+
         username = username_entry.get()
         password = password_entry.get()
-        user = authenticate_user(username, password)
-        if user:
-            messagebox.showinfo("Login Success", f"Welcome {user['full_name']}!")
-            login_window.destroy()
-            show_main_window(user)
-        else:
-            messagebox.showerror("Login Failed", "Invalid credentials.")
+        login_button.config(state="disabled")
+        status_label.config(text="Logging in...")
+
+        def on_success(user):
+            login_button.config(state="normal")
+            status_label.config(text="")
+            if user:
+                messagebox.showinfo("Login Success", f"Welcome {user['full_name']}!")
+                login_window.destroy()
+                show_main_window(user)
+            else:
+                messagebox.showerror("Login Failed", "Invalid credentials.")
 
-    tk.Button(login_window, text="Login", command=login).grid(row=2, column=0, columnspan=2, pady=10)
+        def on_error(err):
+            login_button.config(state="normal")
+            status_label.config(text="")
+            messagebox.showerror("Login Failed", f"Could not reach the database: {err}")
+
+        run_in_background(login_window, authenticate_user, username, password, on_success=on_success, on_error=on_error)
+
+    login_button = tk.Button(login_window, text="Login", command=login)
+    login_button.grid(row=2, column=0, columnspan=2, pady=10)
     tk.Button(login_window, text="Register", command=lambda: [login_window.destroy(), show_register_window()]).grid(row=3, column=0, columnspan=2, pady=5)
-    
+    # Time to interactive: the first time the form has been drawn
+    login_window.after_idle(startup.mark, 'interactive')
+
     login_window.mainloop()
 
 def show_register_window():
     """
     A window for registering a new user. The user is asked to fill out a form with their username, password, full name, email, phone, and membership category. If the user is a student or staff, they must then confirm their registration with an admin/librarian username and password. After confirming their registration, the window will be destroyed, and the user will be logged in and shown the main window.
     """
+    from user_management import authenticate_user, register_member
+    from db_executor import run_in_background
+
     register_window = tk.Tk()
     register_window.title("Register New Member")
 
@@ -66,14 +91,20 @@ def show_register_window():
         phone = entries["Phone"].get()
         membership_category = entries["Membership Category: (student/public/staff)"].get()
         
-        register_window.destroy()
-
         if not all([username, password, full_name, email, phone, membership_category]):
             messagebox.showerror("Error", "All fields are required.")
             return
-        
+
+        def registered(success):
+            if not success:
+                messagebox.showerror("Error", "Registration failed.")
+            else:
+                messagebox.showinfo("Success", "Registration successful.")
+            show_login_window()
+
          # Ask for an admin/librarian confimermation to confirm registration for students and staff
         if membership_category in ["student", "staff"]:
+            register_window.destroy()
 
             staff_register_window = tk.Tk()
             staff_register_window.title("Confirm Registration")
@@ -86,42 +117,48 @@ def show_register_window():
             staff_password_entry = tk.Entry(staff_register_window, show="*")
             staff_password_entry.grid(row=1, column=1, padx=10, pady=5)
 
+            def confirm_and_register(staff_username, staff_password):
+                # Runs on a worker thread: None if the staff credentials are not valid
+                staff = authenticate_user(staff_username, staff_password)
+                if not staff or staff['role'] not in ['admin', 'librarian']:
+                    return None
+                return register_member(username, password, 'borrower', full_name, email, phone, membership_category)
+
             def authenticate_staff():
                 """
                 Authenticates the staff member for confirming registration. If the staff credentials are valid, the registration is confirmed, and the user is logged in and shown the main window. Otherwise, an error message is shown.
                 """
-                staff_username = staff_username_entry.get()
-                staff_password = staff_password_entry.get()
+                confirm_button.config(state="disabled")
 
-                staff = authenticate_user(staff_username, staff_password)
-                if staff and staff['role'] in ['admin', 'librarian']:
-                    messagebox.showinfo("Success", "Registration confirmed.")
-                    register_window.destroy()
-                    success = register_member(username, password, 'borrower', full_name, email, phone, membership_category)
-
-                    if not success:
-                        messagebox.showerror("Error", "Registration failed.")
-                    else:
-                        messagebox.showinfo("Success", "Registration successful.")
-        
+                def on_done(success):
+                    if success is None:
+                        confirm_button.config(state="normal")
+                        messagebox.showerror("Error", "Invalid staff credentials.")
+                        return
                     staff_register_window.destroy()
-                    show_login_window()
-                else:
-                    messagebox.showerror("Error", "Invalid staff credentials.")
+                    registered(success)
+
+                def on_error(err):
+                    confirm_button.config(state="normal")
+                    messagebox.showerror("Error", f"Could not reach the database: {err}")
+
+                run_in_background(staff_register_window, confirm_and_register, staff_username_entry.get(), staff_password_entry.get(),
+                                  on_success=on_done, on_error=on_error)
 
-            tk.Button(staff_register_window, text="Confirm Registration", command=authenticate_staff).grid(row=len(labels)+2, column=0, columnspan=2, pady=10)
+            confirm_button = tk.Button(staff_register_window, text="Confirm Registration", command=authenticate_staff)
+            confirm_button.grid(row=len(labels)+2, column=0, columnspan=2, pady=10)
         else:
-            
-            success = register_member(username, password, 'borrower', full_name, email, phone, membership_category)
+            register_button.config(state="disabled")
 
-            if not success:
-                messagebox.showerror("Error", "Registration failed.")
-            else:
-                messagebox.showinfo("Success", "Registration successful.")
-            
-            show_login_window()
+            def on_done(success):
+                register_window.destroy()
+                registered(success)
+
+            run_in_background(register_window, register_member, username, password, 'borrower', full_name, email, phone,
+                              membership_category, on_success=on_done, on_error=lambda err: on_done(False))
 
-    tk.Button(register_window, text="Register", command=register).grid(row=len(labels), column=0, columnspan=2, pady=10)
+    register_button = tk.Button(register_window, text="Register", command=register)
+    register_button.grid(row=len(labels), column=0, columnspan=2, pady=10)
     register_window.mainloop()
 
 def show_main_window(user):
@@ -131,21 +168,56 @@ def show_main_window(user):
     If the user is an admin or librarian, they can add books and pay fines.
     All users can search for books.
     """
+    from circulation import get_loan_dashboard
+    from holds import get_user_holds
+    from db_executor import run_in_background
 
     main_window = tk.Tk()
     main_window.title("Library Management System")
 
     tk.Label(main_window, text=f"Welcome, {user['full_name']}!", font=("Helvetica", 16)).pack(pady=20)
     tk.Label(main_window, text=f"Username: {user['username']}. Role: {user['role']}. Membership: {user['membership_category']}").pack(pady=10)
-    # Get list of borrowed books
-    transactions = get_transactions(user['user_id'])
-
-    if transactions:
-        tk.Label(main_window, text="Your borrowed books:").pack(pady=30)
-        for transaction in transactions:
-            # Get book by id
-            book = get_book_by_id(transaction['book_id'])
-            tk.Label(main_window, text=f"{book['title']} by {book['author']} ({book['isbn']}) - Due: {transaction['due_date']}").pack(pady=5)
+    # Loans, fines and holds are filled in once they have been read
+    summary_frame = tk.Frame(main_window)
+    summary_frame.pack()
+    loading_label = tk.Label(summary_frame, text="Loading your loans...")
+    loading_label.pack(pady=10)
+
+    def load_summary():
+        # Get borrowed books along with their details in one query
+        return get_loan_dashboard(user['user_id']), get_user_holds(user['user_id'])
+
+    def show_summary(summary):
+        dashboard, holds = summary
+        loading_label.destroy()
+        if dashboard is None:
+            tk.Label(summary_frame, text="Could not load your loans.").pack(pady=10)
+            return
+        if dashboard['outstanding_fines']:
+            tk.Label(summary_frame, text=f"Outstanding fines: {dashboard['outstanding_fines']}").pack(pady=10)
+        if dashboard['loans']:
+            tk.Label(summary_frame, text="Your borrowed books:").pack(pady=30)
+            for loan in dashboard['loans']:
+                status = ""
+                if loan['overdue']:
+                    status = f" (OVERDUE by {loan['days_overdue']} days, fine so far: {loan['accrued_fine']})"
+                elif loan['due_soon']:
+                    status = " (due soon)"
+                tk.Label(summary_frame, text=f"{loan['title']} by {loan['author']} ({loan['isbn']}) - Due: {loan['due_date']}{status}").pack(pady=5)
+        if holds:
+            tk.Label(summary_frame, text="Your holds:").pack(pady=10)
+            for hold in holds:
+                if hold['ready']:
+                    status = f"ready, collect by {hold['hold_expires']}"
+                else:
+                    wait = f", about {hold['estimated_wait_days']} days" if hold['estimated_wait_days'] is not None else ""
+                    status = f"number {hold['position']} in line{wait}"
+                tk.Label(summary_frame, text=f"{hold['title']} by {hold['author']} - {status}").pack(pady=5)
+
+    def summary_failed(err):
+        loading_label.config(text=f"Could not load your loans: {err}")
+
+    run_in_background(main_window, load_summary, on_success=show_summary, on_error=summary_failed)
     tk.Label(main_window, text="What would you like to do?").pack(pady=50)
     # Depending on user role, show different functionalities
     if user['role'] in ['admin', 'librarian']:
@@ -168,7 +240,9 @@ def show_add_book_window():
     message will be shown, and the window will be closed. If there is an error, an
     error message will be shown.
     """
-    
+    from catalog_management import add_book
+    from db_executor import run_in_background
+
     add_book_window = tk.Tk()
     add_book_window.title("Add New Book")
 
@@ -181,7 +255,8 @@ def show_add_book_window():
         entry.grid(row=idx, column=1, padx=10, pady=5)
         entries[label] = entry
 
-    from catalog_management import add_book
+    status_label = tk.Label(add_book_window, text="")
+    status_label.grid(row=len(labels)+1, column=0, columnspan=2, pady=5)
 
     def add_book_to_db():
         try:
@@ -198,13 +273,28 @@ def show_add_book_window():
                 "subject_tags": entries["Subject Tags"].get(),
                 "total_copies": int(entries["Total Copies"].get())
             }
-            add_book(**data)
-            messagebox.showinfo("Success", "Book added successfully.")
-            add_book_window.destroy()
         except ValueError:
             messagebox.showerror("Error", "Please enter valid data.")
+            return
+
+        def on_done(book_id):
+            add_button.config(state="normal")
+            status_label.config(text="")
+            if book_id:
+                messagebox.showinfo("Success", "Book added successfully.")
+                add_book_window.destroy()
+            else:
+                messagebox.showerror("Error", "The book could not be added.")
+
+        def on_error(err):
+            on_done(None)
+
+        add_button.config(state="disabled")
+        status_label.config(text="Saving...")
+        run_in_background(add_book_window, add_book, **data, on_success=on_done, on_error=on_error)
 
-    tk.Button(add_book_window, text="Add Book", command=add_book_to_db).grid(row=len(labels), column=0, columnspan=2, pady=10)
+    add_button = tk.Button(add_book_window, text="Add Book", command=add_book_to_db)
+    add_button.grid(row=len(labels), column=0, columnspan=2, pady=10)
     add_book_window.mainloop()
 
 def show_return_book_window(user):
@@ -215,35 +305,78 @@ def show_return_book_window(user):
     If the book is returned successfully, a success message is shown, and the window is closed.
     If there is an error, an error message is shown.
     """
+    from circulation import get_loan_dashboard, return_book, RETURNED
+    from db_executor import run_in_background
 
     return_book_window = tk.Tk()
     return_book_window.title("Return Book")
 
-    transactions = get_transactions(user['user_id'])
-    if not transactions:
-        tk.Label(return_book_window, text="You have no borrowed books.").pack(pady=10)
-        return_book_window.mainloop()
-        return
+    status_label = tk.Label(return_book_window, text="Loading your loans...")
+    status_label.pack(pady=10)
 
-    tk.Label(return_book_window, text="Select a book to return:").pack(pady=10)
-    for transaction in transactions:
-        book = get_book_by_id(transaction['book_id'])   
-        tk.Button(return_book_window, text=f"{book['title']} by {book['author']}", command=lambda t=transaction: return_book(t['transaction_id'])).pack(pady=5)
+    def return_loan(loan, button):
+        button.config(state="disabled")
 
+        def on_done(result):
+            if result['status'] == RETURNED:
+                messagebox.showinfo("Success", result['message'])
+                button.destroy()
+            else:
+                messagebox.showerror("Error", result['message'])
+                button.config(state="normal")
+
+        run_in_background(return_book_window, return_book, loan['transaction_id'],
+                          on_success=on_done, on_error=lambda err: on_done({'status': None, 'message': f"{err}"}))
+
+    def show_loans(dashboard):
+        if dashboard is None:
+            status_label.config(text="Could not load your loans.")
+            return
+        if not dashboard['loans']:
+            status_label.config(text="You have no borrowed books.")
+            return
+        status_label.config(text="Select a book to return:")
+        for loan in dashboard['loans']:
+            button = tk.Button(return_book_window, text=f"{loan['title']} by {loan['author']}")
+            button.config(command=lambda t=loan, b=button: return_loan(t, b))
+            button.pack(pady=5)
+
+    run_in_background(return_book_window, get_loan_dashboard, user['user_id'], on_success=show_loans,
+                      on_error=lambda err: status_label.config(text=f"Could not load your loans: {err}"))
     return_book_window.mainloop()
 
+# Milliseconds of no typing before suggestions are looked up
+SUGGEST_DELAY_MS = 150
+# Names of the facets search results can be narrowed by, as shown
+FACET_LABELS = {'genre': "Genre", 'language': "Language", 'publication_year': "Year",
+                'dewey_class': "Dewey class", 'availability': "Availability"}
+# Result rows drawn at once. Only these rows exist, however many books match; scrolling redraws them
+RESULT_ROWS = 20
+# Results fetched per request while scrolling, and at most per request when jumping far ahead
+RESULT_FETCH_SIZE = 200
+RESULT_FETCH_MAX = 5000
+# Book details shown, as (label, column)
+BOOK_DETAIL_FIELDS = [("Title", 'title'), ("Author", 'author'), ("ISBN", 'isbn'), ("Publisher", 'publisher'),
+                      ("Edition", 'edition'), ("Genre", 'genre'), ("Language", 'language'),
+                      ("Publication Year", 'publication_year'), ("Dewey Decimal", 'dewey_decimal'),
+                      ("Subject Tags", 'subject_tags')]
+
 def show_search_books_window(user):
   
     """
     Displays a window for searching books in the library catalog.
 
     The user can enter a keyword to search for books by title, author, ISBN, genre, language, or publication year.
-    The search results, if any, are displayed in a new window, where each result is shown as a button with the
-    book's title and author. Clicking on a result button shows more details about the book. If no results are found,
-    a message is displayed.
+    The search results, if any, are displayed in a new window as a scrolling list, next to a pane with the details
+    of the selected book. The list only draws the rows in view and fetches further results as it is scrolled,
+    so large result sets open as quickly as small ones. If no results are found, a message is displayed.
 
     :param user: The user performing the search, used for accessing user-specific functionalities.
     """
+    from catalog_management import search_books_page, get_book_by_id
+    from typeahead import suggest
+    from db_executor import run_in_background, LatestTask
+
     search_window = tk.Tk()
     search_window.title("Search Books")
 
@@ -251,62 +384,353 @@ def show_search_books_window(user):
     keyword_entry = tk.Entry(search_window)
     keyword_entry.grid(row=0, column=1, padx=10, pady=10)
 
+    # Suggestions as the user types, from the in-memory typeahead index
+    suggestion_list = tk.Listbox(search_window, height=6, width=50)
+    suggestions = []
+    pending_suggest = None
+
+    def show_suggestions():
+        nonlocal pending_suggest
+        pending_suggest = None
+        suggestions[:] = suggest(keyword_entry.get())
+        suggestion_list.delete(0, tk.END)
+        for _, label in suggestions:
+            suggestion_list.insert(tk.END, label)
+        if suggestions:
+            suggestion_list.grid(row=1, column=1, padx=10)
+        else:
+            suggestion_list.grid_remove()
 
-    def search():
-        keyword = keyword_entry.get()
-        results = search_books(keyword)
+    def on_key(event):
+        # Wait for a pause in typing rather than looking up every keystroke
+        nonlocal pending_suggest
+        if event.keysym == "Return":
+            search()
+            return
+        if pending_suggest is not None:
+            search_window.after_cancel(pending_suggest)
+        pending_suggest = search_window.after(SUGGEST_DELAY_MS, show_suggestions)
+
+    # Suggestions all open in the same details window
+    details_window = None
+    show_details = None
+
+    def open_details(book):
+        nonlocal details_window, show_details
+        if details_window is None or not details_window.winfo_exists():
+            details_window, show_details = show_book_details_window(user, search_window)
+        show_details(book)
+        details_window.lift()
+
+    def open_suggestion(event):
+        selection = suggestion_list.curselection()
+        if not selection:
+            return
+        book_id = suggestions[selection[0]][0]
+        suggestion_list.grid_remove()
+        run_in_background(search_window, get_book_by_id, book_id,
+                          on_success=lambda book: open_details(book) if book else None,
+                          on_error=show_error)
+
+    keyword_entry.bind("<KeyRelease>", on_key)
+    suggestion_list.bind("<<ListboxSelect>>", open_suggestion)
+
+    status_label = tk.Label(search_window, text="")
+    status_label.grid(row=4, column=0, columnspan=2, pady=5)
+    # Only the latest search is shown, pressing Search again cancels the one in flight
+    latest_search = LatestTask()
+
+    def show_results(keyword, page, filters):
+        status_label.config(text="")
         results_window = tk.Toplevel(search_window)
         results_window.title("Search Results")
-        tk.Label(results_window, text=f"Search results for '{keyword}':").grid(row=2, column=0, padx=10, pady=10)
-
-        for idx, book in enumerate(results):
-            tk.Button(results_window, text=f"{book['title']} by {book['author']}", command=lambda book=book: show_book_details_window(book, user, results_window)).grid(row=idx+4, column=0, padx=10, pady=5)
+        total = page["total_estimate"] if page["total_is_exact"] else f"{page['total_estimate']}+"
+        heading = f"Close matches for '{keyword}'" if page["fuzzy"] else f"Search results for '{keyword}'"
+        if filters:
+            heading += " (" + ", ".join(f"{FACET_LABELS[facet]}: {value}" for facet, value in filters.items()) + ")"
+        tk.Label(results_window, text=f"{heading} ({total} found):").grid(row=0, column=0, columnspan=3, padx=10, pady=10)
+
+        # Narrowing by a facet value searches again with it added to the filters
+        facet_frame = tk.Frame(results_window)
+        facet_frame.grid(row=1, column=2, padx=10, pady=10, sticky="n")
+        for facet, values in (page["facets"] or {}).items():
+            if not values or facet in filters:
+                continue
+            choices = {f"{value} ({count})": value for value, count in values}
+            tk.Label(facet_frame, text=FACET_LABELS[facet]).pack(anchor="w")
+            choice = tk.StringVar(facet_frame, value="Any")
+            tk.OptionMenu(facet_frame, choice, *choices,
+                          command=lambda label, facet=facet, choices=choices: refine(facet, choices[label])).pack(anchor="w", fill="x")
+
+        def refine(facet, value):
+            results_window.destroy()
+            search(dict(filters, **{facet: value}))
 
         # If no results are found, show a message
-        if len(results) == 0:
-            tk.Label(results_window, text="No results found.").grid(row=5, column=0, padx=10, pady=10)
-            
-        tk.Button(results_window, text="Close", command=results_window.destroy).grid(row=len(results)+5, column=0, padx=10, pady=10)
+        if len(page["results"]) == 0:
+            message = "No results found. Close matches are not available yet, try again shortly." if page["fuzzy_pending"] else "No results found."
+            tk.Label(results_window, text=message).grid(row=1, column=0, padx=10, pady=10)
+            tk.Button(results_window, text="Close", command=results_window.destroy).grid(row=2, column=0, columnspan=3, pady=10)
+            return
+
+        # The fetched results, of which the rows from `first` on are drawn
+        books = list(page["results"])
+        next_cursor = page["next_cursor"]
+        first = 0
+        selected = None
+        fetching = False
+
+        list_frame = tk.Frame(results_window)
+        list_frame.grid(row=1, column=0, padx=10, pady=10, sticky="n")
+        tree = ttk.Treeview(list_frame, columns=("author", "year", "copies"), height=RESULT_ROWS, selectmode="browse")
+        tree.heading("#0", text="Title")
+        tree.heading("author", text="Author")
+        tree.heading("year", text="Year")
+        tree.heading("copies", text="Available")
+        tree.column("#0", width=300)
+        tree.column("author", width=180)
+        tree.column("year", width=60, anchor="e")
+        tree.column("copies", width=70, anchor="e")
+        tree.grid(row=0, column=0)
+        scrollbar = tk.Scrollbar(list_frame, orient="vertical", command=lambda *args: on_scroll(*args))
+        scrollbar.grid(row=0, column=1, sticky="ns")
+        rows = [tree.insert("", tk.END, text="") for _ in range(RESULT_ROWS)]
+
+        details_frame = tk.Frame(results_window)
+        details_frame.grid(row=1, column=1, padx=10, pady=10, sticky="n")
+
+        def on_borrowed(book):
+            # Shows the book's new number of available copies in the list
+            for index in range(len(books)):
+                if books[index]['book_id'] == book['book_id']:
+                    books[index] = book
+            draw()
+
+        show_selected = create_book_details_pane(details_frame, user, on_change=on_borrowed)
+
+        def row_count():
+            # Rows the list scrolls over: every match if the count is exact, otherwise what is known so far
+            if next_cursor is None:
+                return len(books)
+            return max(len(books) + 1, page["total_estimate"] or 0)
+
+        def draw():
+            for offset, row in enumerate(rows):
+                index = first + offset
+                if index < len(books):
+                    book = books[index]
+                    tree.item(row, text=book['title'], values=(book['author'], book['publication_year'], book['available_copies']))
+                    tree.move(row, "", offset)
+                elif index < row_count():
+                    tree.item(row, text="Loading...", values=("", "", ""))
+                    tree.move(row, "", offset)
+                else:
+                    tree.detach(row)
+            if selected is not None and first <= selected < first + RESULT_ROWS:
+                tree.selection_set(rows[selected - first])
+            else:
+                tree.selection_set(())
+            count = row_count()
+            scrollbar.set(first / count, min(1.0, (first + RESULT_ROWS) / count))
+            fetch_more()
+
+        def fetch_more():
+            # Keeps a page of rows beyond the view fetched, more when the view jumped ahead
+            nonlocal fetching
+            wanted = first + 2 * RESULT_ROWS
+            if fetching or next_cursor is None or wanted <= len(books):
+                return
+            fetching = True
+            page_size = min(max(RESULT_FETCH_SIZE, wanted - len(books)), RESULT_FETCH_MAX)
+            run_in_background(results_window, search_books_page, keyword, page_size=page_size, after=next_cursor,
+                              filters=filters, on_success=add_page, on_error=fetch_failed)
+
+        def add_page(next_page):
+            nonlocal fetching, next_cursor
+            fetching = False
+            books.extend(next_page["results"])
+            next_cursor = next_page["next_cursor"]
+            draw()
+
+        def fetch_failed(err):
+            nonlocal fetching, next_cursor
+            fetching = False
+            next_cursor = None
+            show_error(err)
+            draw()
+
+        def scroll_to(index):
+            nonlocal first
+            first = max(0, min(index, row_count() - RESULT_ROWS))
+            draw()
+
+        def on_scroll(action, amount, unit=None):
+            if action == "moveto":
+                scroll_to(int(float(amount) * row_count()))
+            elif unit == "pages":
+                scroll_to(first + int(amount) * RESULT_ROWS)
+            else:
+                scroll_to(first + int(amount))
+
+        def on_wheel(event):
+            if event.num == 4 or event.delta > 0:
+                scroll_to(first - 3)
+            else:
+                scroll_to(first + 3)
+            return "break"
+
+        def select(index):
+            # Selects a result, scrolling it into view
+            nonlocal selected
+            index = max(0, min(index, len(books) - 1))
+            if index < first:
+                scroll_to(index)
+            elif index >= first + RESULT_ROWS:
+                scroll_to(index - RESULT_ROWS + 1)
+            if index != selected:
+                selected = index
+                show_selected(books[index])
+            draw()
+
+        def on_select(event):
+            selection = tree.selection()
+            if selection:
+                index = first + rows.index(selection[0])
+                if index < len(books) and index != selected:
+                    select(index)
+
+        def on_arrow(step):
+            select(first if selected is None else selected + step)
+            return "break"
+
+        tree.bind("<<TreeviewSelect>>", on_select)
+        tree.bind("<Up>", lambda event: on_arrow(-1))
+        tree.bind("<Down>", lambda event: on_arrow(1))
+        tree.bind("<Prior>", lambda event: on_arrow(-RESULT_ROWS))
+        tree.bind("<Next>", lambda event: on_arrow(RESULT_ROWS))
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            tree.bind(sequence, on_wheel)
+
+        tk.Button(results_window, text="Close", command=results_window.destroy).grid(row=2, column=0, columnspan=3, pady=10)
+        draw()
+        tree.focus_set()
+
+    def show_error(err):
+        status_label.config(text="")
+        messagebox.showerror("Error", f"Search failed: {err}")
+
+    def search(filters=None):
+        keyword = keyword_entry.get()
+        filters = filters or {}
+        status_label.config(text="Searching...")
+        latest_search.run(search_window, search_books_page, keyword, fuzzy=True, filters=filters, with_facets=True,
+                          on_success=lambda page: show_results(keyword, page, filters), on_error=show_error)
+
     tk.Button(search_window, text="Search", command=search).grid(row=3, column=0, columnspan=2, pady=10)
     search_window.mainloop()
 
-def show_book_details_window(book, user ,results_window):
+def create_book_details_pane(parent, user, on_change=None):
     """
-    Opens a window to view more details about a book in the catalog.
+    Adds a pane showing a book's details to a window, with buttons to borrow the book or place a hold on it.
 
-    The window will have labels for each of the book's attributes, and a button
-    to borrow the book. When the book is borrowed successfully, a success message
-    will be shown, and the window will be closed. If there is an error, an error
-    message will be shown.
+    The pane's widgets are created once and reused for every book shown in it. After a book is borrowed, it is
+    read again so the pane shows its new number of available copies. If there is an error, an error message is shown.
 
+    :param parent: The window or frame the pane is added to.
+    :param user: The user borrowing books or placing holds.
+    :param on_change: Called with the book read again after it was borrowed, e.g. to update a list showing it.
+    :return: A function that shows a book dictionary in the pane.
     """
-    book_details_window = tk.Tk()
-    book_details_window.title("Book Details")
+    from catalog_management import get_book_by_id
+    from circulation import issue_book, place_hold, ISSUED, HOLD_PLACED
+    from db_executor import run_in_background
+
+    details = {}
+    for idx, (label, column) in enumerate(BOOK_DETAIL_FIELDS):
+        details[column] = tk.Label(parent, text="", anchor="w", justify="left", wraplength=300)
+        details[column].grid(row=idx, column=0, padx=10, pady=2, sticky="w")
+    details['title'].config(text="Select a book to see its details.")
+    copies_label = tk.Label(parent, text="")
+    copies_label.grid(row=len(BOOK_DETAIL_FIELDS), column=0, padx=10, pady=5, sticky="w")
+    borrow_button = tk.Button(parent, text="Borrow", command=lambda: borrow())
+    hold_button = tk.Button(parent, text="Place Hold", command=lambda: hold())
+    shown = None
+
+    def show(book):
+        nonlocal shown
+        shown = book
+        for label, column in BOOK_DETAIL_FIELDS:
+            details[column].config(text=f"{label}: {book[column]}")
+        # Borrow stays enabled without copies on the shelf, a copy may be set aside for the user's hold
+        borrow_button.config(text="Borrow", state="normal")
+        borrow_button.grid(row=len(BOOK_DETAIL_FIELDS) + 1, column=0, pady=10)
+        if book["available_copies"] == 0:
+            copies_label.config(text="No copies available.")
+            hold_button.config(text="Place Hold", state="normal")
+            hold_button.grid(row=len(BOOK_DETAIL_FIELDS) + 2, column=0, pady=10)
+        else:
+            copies_label.config(text=f"Copies available: {book['available_copies']}")
+            hold_button.grid_remove()
 
-    tk.Label(book_details_window, text=f"Title: {book['title']}").grid(row=0, column=0, padx=10, pady=5)
-    tk.Label(book_details_window, text=f"Author: {book['author']}").grid(row=1, column=0, padx=10, pady=5)
-    tk.Label(book_details_window, text=f"ISBN: {book['isbn']}").grid(row=2, column=0, padx=10, pady=5)
-    tk.Label(book_details_window, text=f"Publisher: {book['publisher']}").grid(row=3, column=0, padx=10, pady=5)
-    tk.Label(book_details_window, text=f"Edition: {book['edition']}").grid(row=4, column=0, padx=10, pady=5)
-    tk.Label(book_details_window, text=f"Genre: {book['genre']}").grid(row=5, column=0, padx=10, pady=5)
-    tk.Label(book_details_window, text=f"Language: {book['language']}").grid(row=6, column=0, padx=10, pady=5)
-    tk.Label(book_details_window, text=f"Publication Year: {book['publication_year']}").grid(row=7, column=0, padx=10, pady=5)
-    tk.Label(book_details_window, text=f"Dewey Decimal: {book['dewey_decimal']}").grid(row=8, column=0, padx=10, pady=5)
-    tk.Label(book_details_window, text=f"Subject Tags: {book['subject_tags']}").grid(row=9, column=0, padx=10, pady=5)
+    def reload(book_id):
+        def on_loaded(book):
+            if book and shown is not None and shown['book_id'] == book_id:
+                show(book)
+            if book and on_change:
+                on_change(book)
 
+        run_in_background(parent, get_book_by_id, book_id, on_success=on_loaded, on_error=lambda err: None)
 
     def borrow():
-        issue_book(user['user_id'], book['book_id'])
-        messagebox.showinfo("Success", "Book borrowed successfully.")
-        book_details_window.destroy()
-        results_window.destroy()
-
-    if book["available_copies"] == 0:
-        tk.Button(book_details_window, text="Borrow", state="disabled", command=borrow).grid(row=10, column=0, columnspan=2, pady=10)
-        tk.Label(book_details_window, text="No copies available.").grid(row=11, column=0, columnspan=2, pady=10)
-    else:
-        tk.Button(book_details_window, text="Borrow", command=borrow).grid(row=10, column=0, columnspan=2, pady=10)
-    book_details_window.mainloop()
+        book = shown
+        borrow_button.config(text="Borrowing...", state="disabled")
+
+        def on_done(result):
+            if result['status'] == ISSUED:
+                messagebox.showinfo("Success", f"{result['message']} Due: {result['due_date']}")
+                reload(book['book_id'])
+            else:
+                messagebox.showerror("Error", result['message'])
+                if shown is book:
+                    borrow_button.config(text="Borrow", state="normal")
+
+        run_in_background(parent, issue_book, user['user_id'], book['book_id'],
+                          on_success=on_done, on_error=lambda err: on_done({'status': None, 'message': f"{err}"}))
+
+    def hold():
+        book = shown
+        hold_button.config(text="Placing hold...", state="disabled")
+
+        def on_done(result):
+            if result['status'] == HOLD_PLACED:
+                messagebox.showinfo("Success", result['message'])
+                if shown is book:
+                    hold_button.grid_remove()
+            else:
+                messagebox.showerror("Error", result['message'])
+                if shown is book:
+                    hold_button.config(text="Place Hold", state="normal")
+
+        run_in_background(parent, place_hold, user['user_id'], book['book_id'],
+                          on_success=on_done, on_error=lambda err: on_done({'status': None, 'message': f"{err}"}))
+
+    return show
+
+def show_book_details_window(user, parent):
+    """
+    Opens a window to view more details about a book in the catalog, and to borrow it or place a hold on it.
+
+    The window is opened over the given window rather than as a new application window, and can be reused for
+    further books by calling the returned function.
+
+    :param user: The user borrowing books or placing holds.
+    :param parent: The window the details window belongs to.
+    :return: A tuple of the window and a function that shows a book dictionary in it.
+    """
+    book_details_window = tk.Toplevel(parent)
+    book_details_window.title("Book Details")
+    return book_details_window, create_book_details_pane(book_details_window, user)
+
 def show_pay_fine_window():
     """
     Displays a window to pay a fine.
@@ -316,6 +740,9 @@ def show_pay_fine_window():
     If the user is not found, an error message is shown.
 
     """
+    from user_management import get_user_id
+    from db_executor import run_in_background
+
     pay_fine_window = tk.Tk()
     pay_fine_window.title("Pay Fine")
 
@@ -326,15 +753,24 @@ def show_pay_fine_window():
 
     def get_user_name():
         user_name = user_name_entry.get()
-        
-        user_id = get_user_id(user_name)
-        if user_id:
-            pay_fine_window.destroy()
-            pay_fine(user_id)
-        else:
-            messagebox.showerror("Error", "User not found.")
+        find_button.config(text="Searching...", state="disabled")
+
+        def on_success(user_id):
+            find_button.config(text="Find User", state="normal")
+            if user_id:
+                pay_fine_window.destroy()
+                pay_fine(user_id)
+            else:
+                messagebox.showerror("Error", "User not found.")
+
+        def on_error(err):
+            find_button.config(text="Find User", state="normal")
+            messagebox.showerror("Error", f"Could not reach the database: {err}")
+
+        run_in_background(pay_fine_window, get_user_id, user_name, on_success=on_success, on_error=on_error)
 
-    tk.Button(pay_fine_window, text="Find User", command=get_user_name).grid(row=1, column=0, columnspan=2, pady=10)
+    find_button = tk.Button(pay_fine_window, text="Find User", command=get_user_name)
+    find_button.grid(row=1, column=0, columnspan=2, pady=10)
     pay_fine_window.mainloop()
 
 def pay_fine(user_id):
@@ -348,31 +784,64 @@ def pay_fine(user_id):
 
     :param user_id: The unique identifier of the user whose fine is to be paid.
     """
-    # Get fine amount
-    
-    fine_amount = get_user_fine(user_id)
-    
-    if fine_amount > 0:
-        pay_fine_window = tk.Tk()
-        tk.Label(pay_fine_window, text="Enter fine amount:").grid(row=0, column=0, padx=10, pady=10)
+    from decimal import Decimal, InvalidOperation
+    from user_management import get_user_fine, pay_user_fine
+    from db_executor import run_in_background
+
+    pay_fine_window = tk.Tk()
+    pay_fine_window.title("Pay Fine")
+    status_label = tk.Label(pay_fine_window, text="Loading fine...")
+    status_label.grid(row=0, column=0, columnspan=2, padx=10, pady=10)
+
+    def show_fine(fine_amount):
+        # Get fine amount
+        if not fine_amount > 0:
+            pay_fine_window.destroy()
+            messagebox.showerror("Error", "No fine to pay.")
+            return
+        status_label.config(text="Enter fine amount:")
+        status_label.grid(columnspan=1)
         fine_amount_entry = tk.Entry(pay_fine_window)
         fine_amount_entry.grid(row=0, column=1, padx=10, pady=10)
 
         def pay_fine():
-            fine_amount_being_paid = fine_amount_entry.get()
-            fine_amount_being_paid = int(fine_amount)
-            if (fine_amount-fine_amount_being_paid) >= 0:
-                update_user_fine(user_id, fine_amount-fine_amount_being_paid)
-                messagebox.showinfo("Success", "Fine paid successfully.")
-                pay_fine_window.destroy()
+            try:
+                fine_amount_being_paid = Decimal(fine_amount_entry.get().strip())
+            except InvalidOperation:
+                fine_amount_being_paid = None
+            if fine_amount_being_paid is not None and fine_amount_being_paid.is_finite() and 0 < fine_amount_being_paid <= fine_amount:
+                pay_button.config(state="disabled")
+
+                def on_done(remaining):
+                    # The balance is checked again by the UPDATE, in case another desk took a payment meanwhile
+                    if remaining is None:
+                        pay_button.config(state="normal")
+                        messagebox.showerror("Error", "The amount is more than the outstanding fine.")
+                        return
+                    messagebox.showinfo("Success", f"Fine paid successfully. Remaining fine: {remaining}")
+                    pay_fine_window.destroy()
+
+                def on_error(err):
+                    pay_button.config(state="normal")
+                    messagebox.showerror("Error", f"Could not reach the database: {err}")
+
+                run_in_background(pay_fine_window, pay_user_fine, user_id, fine_amount_being_paid,
+                                  on_success=on_done, on_error=on_error)
             else:
                 messagebox.showerror("Error", "Invalid fine amount.")
 
-        tk.Button(pay_fine_window, text="Pay Fine", command=pay_fine).grid(row=1, column=0, columnspan=2, pady=10)
-        pay_fine_window.mainloop()
-    else:
-        messagebox.showerror("Error", "No fine to pay.")
+        pay_button = tk.Button(pay_fine_window, text="Pay Fine", command=pay_fine)
+        pay_button.grid(row=1, column=0, columnspan=2, pady=10)
+
+    def on_error(err):
+        pay_fine_window.destroy()
+        messagebox.showerror("Error", f"Could not reach the database: {err}")
+
+    run_in_background(pay_fine_window, get_user_fine, user_id, on_success=show_fine, on_error=on_error)
+    pay_fine_window.mainloop()
 
 if __name__ == "__main__":
+    # Connects, fills caches and builds the search indexes while the login form is shown
+    startup.start_warm_up()
     while True:
         show_login_window()
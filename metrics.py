@@ -0,0 +1,380 @@
+# metrics.py
+import functools
+import inspect
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+# Instrumentation settings, overridable from .env
+METRICS_ENABLED = (os.environ.get('METRICS_ENABLED') or '1') not in ('0', 'false', 'no')
+# Statements slower than this many milliseconds are written to the slow query log
+SLOW_QUERY_MS = float(os.environ.get('METRICS_SLOW_QUERY_MS') or 200)
+SLOW_QUERY_LOG = os.environ.get('METRICS_SLOW_QUERY_LOG') or 'slow_queries.log'
+# Snapshot file written every METRICS_EXPORT_INTERVAL seconds, as Prometheus
+# text if it ends in .prom and JSON otherwise. No snapshots are written if unset.
+EXPORT_PATH = os.environ.get('METRICS_EXPORT_PATH')
+EXPORT_INTERVAL = float(os.environ.get('METRICS_EXPORT_INTERVAL') or 60)
+
+# Linear sub-buckets per power of two; 16 keeps every bucket within about 6% of its values
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+# Longest statement text kept as a metric name
+MAX_STATEMENT_LENGTH = 200
+
+class Histogram:
+    """
+    A log-linear histogram of non-negative integers in the style of
+    HdrHistogram: values are counted in buckets whose width grows with
+    the value, so quantiles have a bounded relative error whatever the
+    range, and recording is a few integer operations.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @staticmethod
+    def _bucket(value):
+        if value < 2 * SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - SUB_BUCKET_BITS - 1
+        return shift * SUB_BUCKETS + (value >> shift)
+
+    @staticmethod
+    def _bucket_value(bucket):
+        if bucket < 2 * SUB_BUCKETS:
+            return bucket
+        shift = bucket // SUB_BUCKETS - 1
+        # Midpoint of the bucket
+        return ((bucket - shift * SUB_BUCKETS) << shift) + (1 << shift) // 2
+
+    def record(self, value):
+        """
+        Counts one value.
+        """
+        value = max(int(value), 0)
+        bucket = self._bucket(value)
+        with self._lock:
+            self._counts[bucket] = self._counts.get(bucket, 0) + 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """
+        Returns the value below which a fraction q of the recorded values lie, or 0 if there are none.
+        """
+        with self._lock:
+            if not self.count:
+                return 0
+            rank = q * self.count
+            seen = 0
+            for bucket in sorted(self._counts):
+                seen += self._counts[bucket]
+                if seen >= rank:
+                    return min(self._bucket_value(bucket), self.max)
+            return self.max
+
+    def summary(self):
+        """
+        Returns the count, sum, min, max, mean and QUANTILES of the recorded values.
+        """
+        summary = {'count': self.count, 'sum': self.total, 'min': self.min or 0, 'max': self.max,
+                   'mean': self.total / self.count if self.count else 0}
+        for q in QUANTILES:
+            summary[f"p{q * 100:g}"] = self.quantile(q)
+        return summary
+
+# (kind, name) -> Histogram. Kinds are 'statement_us', 'statement_rows', 'function_us', 'pool_acquire_us',
+# and 'startup_us' and 'startup_step_us', see startup.py.
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+def histogram(kind, name):
+    """
+    Returns the histogram of a metric, creating it on first use.
+    """
+    key = (kind, name)
+    found = _histograms.get(key)
+    if found is None:
+        with _histograms_lock:
+            found = _histograms.setdefault(key, Histogram())
+    return found
+
+def reset():
+    """
+    Discards every recorded value.
+    """
+    with _histograms_lock:
+        _histograms.clear()
+
+@functools.lru_cache(maxsize=1024)
+def statement_name(query):
+    """
+    Returns the name a statement is recorded under: its text with
+    whitespace collapsed and placeholder lists shortened, so the
+    statements built for different numbers of values share a name.
+    """
+    name = re.sub(r"\s+", " ", query).strip()
+    name = re.sub(r"%s(?:\s*,\s*%s)+", "%s, ...", name)
+    name = re.sub(r"(\(%s, \.\.\.\)|\(%s\))(?:\s*,\s*\1)+", r"\1, ...", name)
+    return name[:MAX_STATEMENT_LENGTH]
+
+_slow_log_lock = threading.Lock()
+
+def _log_slow_query(name, elapsed_ms, rows):
+    line = f"{datetime.now().isoformat(timespec='milliseconds')} {elapsed_ms:.1f}ms rows={rows} {name}\n"
+    try:
+        with _slow_log_lock, open(SLOW_QUERY_LOG, 'a') as log:
+            log.write(line)
+    except OSError as err:
+        print(f"Error: {err}")
+
+def record_statement(query, elapsed_ns, rows):
+    """
+    Records the latency and row count of one statement, and logs it if it was slow.
+
+    Parameters:
+    query (str): Statement text as passed to cursor.execute
+    elapsed_ns (int): Time spent executing it, in nanoseconds
+    rows (int): Rows fetched or affected, negative if unknown
+    """
+    name = statement_name(query)
+    histogram('statement_us', name).record(elapsed_ns // 1000)
+    if rows >= 0:
+        histogram('statement_rows', name).record(rows)
+    elapsed_ms = elapsed_ns / 1e6
+    if elapsed_ms >= SLOW_QUERY_MS:
+        _log_slow_query(name, elapsed_ms, rows)
+
+class InstrumentedCursor:
+    """
+    Wraps a cursor, timing each statement and counting the rows it
+    fetches or affects. The timing covers execute and the fetches of its
+    result, since unbuffered cursors only read rows as they are fetched.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._query = None
+        self._elapsed = 0
+        # Rows fetched, None until the statement's result is first fetched
+        self._rows = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def finish(self):
+        """
+        Records the current statement, if it has not been recorded yet.
+        """
+        if self._query is not None:
+            rows = self._rows if self._rows is not None else self._cursor.rowcount
+            record_statement(self._query, self._elapsed, rows if rows is not None else -1)
+            self._query = None
+
+    def _timed(self, method, *args):
+        started = time.perf_counter_ns()
+        try:
+            return method(*args)
+        finally:
+            self._elapsed += time.perf_counter_ns() - started
+
+    def execute(self, query, params=None):
+        self.finish()
+        self._query, self._elapsed, self._rows = query, 0, None
+        return self._timed(self._cursor.execute, query, params)
+
+    def executemany(self, query, seq_of_params):
+        self.finish()
+        self._query, self._elapsed, self._rows = query, 0, None
+        return self._timed(self._cursor.executemany, query, seq_of_params)
+
+    def fetchone(self):
+        row = self._timed(self._cursor.fetchone)
+        self._rows = (self._rows or 0) + (row is not None)
+        return row
+
+    def fetchmany(self, size=1):
+        rows = self._timed(self._cursor.fetchmany, size)
+        self._rows = (self._rows or 0) + len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(self._cursor.fetchall)
+        self._rows = (self._rows or 0) + len(rows)
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def close(self):
+        self.finish()
+        return self._cursor.close()
+
+class InstrumentedConnection:
+    """
+    Wraps a connection so the cursors it opens are instrumented.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._cursors = []
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self, *args, **kwargs):
+        cursor = InstrumentedCursor(self._connection.cursor(*args, **kwargs))
+        self._cursors.append(cursor)
+        return cursor
+
+    def finish(self):
+        """
+        Records the last statement of every cursor, including those never closed.
+        """
+        for cursor in self._cursors:
+            cursor.finish()
+        self._cursors = []
+
+def instrument(connection):
+    """
+    Returns connection wrapped for instrumentation, or unchanged if metrics are disabled.
+    """
+    if not METRICS_ENABLED or connection is None:
+        return connection
+    return InstrumentedConnection(connection)
+
+def record_acquire(elapsed_ns, pool='pool'):
+    """
+    Records how long a caller waited for a pooled connection, under the
+    pool's name: 'pool' for the primary, a replica's name for its pool.
+    """
+    if METRICS_ENABLED:
+        histogram('pool_acquire_us', pool).record(elapsed_ns // 1000)
+
+def timed(function):
+    """
+    Decorator recording the latency of each call of a function under its
+    module and name. Generators are timed until they are exhausted or closed.
+    """
+    if not METRICS_ENABLED:
+        return function
+    name = f"{function.__module__}.{function.__qualname__}"
+
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def generator_wrapper(*args, **kwargs):
+            started = time.perf_counter_ns()
+            try:
+                yield from function(*args, **kwargs)
+            finally:
+                histogram('function_us', name).record((time.perf_counter_ns() - started) // 1000)
+        return generator_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter_ns()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram('function_us', name).record((time.perf_counter_ns() - started) // 1000)
+    return wrapper
+
+def snapshot():
+    """
+    Returns a summary of every histogram, grouped by kind and then by name.
+    Latencies are in microseconds.
+    """
+    with _histograms_lock:
+        items = list(_histograms.items())
+    result = {'timestamp': datetime.now().isoformat(timespec='seconds')}
+    for (kind, name), hist in sorted(items):
+        result.setdefault(kind, {})[name] = hist.summary()
+    return result
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+def prometheus_text(data=None):
+    """
+    Formats a snapshot in the Prometheus text exposition format, as one
+    summary per metric kind with seconds for latencies.
+    """
+    data = data or snapshot()
+    lines = []
+    metrics = [('statement_us', 'library_statement_seconds', 'statement', 1e-6),
+               ('statement_rows', 'library_statement_rows', 'statement', 1),
+               ('function_us', 'library_function_seconds', 'function', 1e-6),
+               ('pool_acquire_us', 'library_pool_acquire_seconds', 'pool', 1e-6),
+               ('startup_us', 'library_startup_seconds', 'milestone', 1e-6),
+               ('startup_step_us', 'library_startup_step_seconds', 'step', 1e-6)]
+    for kind, metric, label, scale in metrics:
+        if kind not in data:
+            continue
+        lines.append(f"# TYPE {metric} summary")
+        for name, summary in data[kind].items():
+            labels = f'{label}="{_label(name)}"'
+            for q in QUANTILES:
+                lines.append(f'{metric}{{{labels},quantile="{q:g}"}} {summary[f"p{q * 100:g}"] * scale:g}')
+            lines.append(f"{metric}_sum{{{labels}}} {summary['sum'] * scale:g}")
+            lines.append(f"{metric}_count{{{labels}}} {summary['count']}")
+    return "\n".join(lines) + "\n"
+
+def write_snapshot(path=None):
+    """
+    Writes a snapshot to path, as Prometheus text if it ends in .prom and
+    as JSON otherwise. The file is replaced atomically so a scraper never
+    reads a partial one.
+    """
+    path = path or EXPORT_PATH
+    data = snapshot()
+    content = prometheus_text(data) if path.endswith('.prom') else json.dumps(data, indent=2)
+    temporary = f"{path}.tmp"
+    try:
+        with open(temporary, 'w') as snapshot_file:
+            snapshot_file.write(content)
+        os.replace(temporary, path)
+    except OSError as err:
+        print(f"Error: {err}")
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+def start_exporter(path=None, interval=None):
+    """
+    Starts a daemon thread writing a snapshot every `interval` seconds.
+    Does nothing if metrics are disabled, no path is configured, or the
+    exporter is already running.
+    """
+    global _exporter
+    path = path or EXPORT_PATH
+    interval = interval or EXPORT_INTERVAL
+    if not METRICS_ENABLED or not path:
+        return
+    with _exporter_lock:
+        if _exporter is not None:
+            return
+
+        def export():
+            while True:
+                time.sleep(interval)
+                write_snapshot(path)
+
+        _exporter = threading.Thread(target=export, name="metrics-exporter", daemon=True)
+        _exporter.start()
@@ -0,0 +1,350 @@
+# migrations.py
+import argparse
+import os
+import re
+import sys
+from datetime import datetime
+
+import db_config
+from db_config import get_connection, Error
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SCHEMA_FILES = {
+    'mysql': os.path.join(BASE_DIR, 'table-creation.sql'),
+    'sqlite': os.path.join(BASE_DIR, 'table-creation-sqlite.sql'),
+}
+# Tables with at least this many rows must not be scanned in full by a shipped query
+DEFAULT_MIN_ROWS = 10000
+
+def _schema_statement(table):
+    """
+    Returns the CREATE TABLE statement of a table from the schema file of
+    the configured backend, so migrations and fresh installs share one
+    definition.
+    """
+    with open(SCHEMA_FILES[db_config.DB_BACKEND]) as schema:
+        match = re.search(rf"CREATE TABLE IF NOT EXISTS {table} \(.*?\n\)[^;]*;", schema.read(), flags=re.DOTALL)
+    return match.group(0)
+
+def _table_exists(cursor, table):
+    if db_config.DB_BACKEND == 'sqlite':
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = %s", (table,))
+    else:
+        cursor.execute("SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", (table,))
+    return cursor.fetchone()[0] > 0
+
+def _index_exists(cursor, table, index):
+    if db_config.DB_BACKEND == 'sqlite':
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND name = %s", (table, index))
+    else:
+        cursor.execute("""SELECT COUNT(*) FROM information_schema.STATISTICS
+                          WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s""", (table, index))
+    return cursor.fetchone()[0] > 0
+
+def _column_exists(cursor, table, column):
+    if db_config.DB_BACKEND == 'sqlite':
+        cursor.execute("SELECT COUNT(*) FROM pragma_table_info(%s) WHERE name = %s", (table, column))
+    else:
+        cursor.execute("""SELECT COUNT(*) FROM information_schema.COLUMNS
+                          WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s""", (table, column))
+    return cursor.fetchone()[0] > 0
+
+def _add_column(cursor, table, column, definition):
+    if not _column_exists(cursor, table, column):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def _create_table(cursor, table):
+    if _table_exists(cursor, table):
+        return False
+    cursor.execute(_schema_statement(table))
+    return True
+
+def _create_index(cursor, table, index, columns):
+    if not _index_exists(cursor, table, index):
+        cursor.execute(f"CREATE INDEX {index} ON {table} ({', '.join(columns)})")
+
+def _drop_index(cursor, table, index):
+    if _index_exists(cursor, table, index):
+        cursor.execute(f"DROP INDEX {index}" if db_config.DB_BACKEND == 'sqlite' else f"DROP INDEX {index} ON {table}")
+
+def add_search_index(cursor):
+    """
+    Adds the book_search_terms inverted index used by search_books.
+    """
+    if _create_table(cursor, 'book_search_terms'):
+        # Built after the migration commits, see migrate()
+        return 'rebuild_search_index'
+
+def add_fine_ledger(cursor):
+    """
+    Adds the fine_ledger table of the nightly fine run, and widens
+    users.fines so accrued fines on long-lost books fit.
+    """
+    if db_config.DB_BACKEND == 'mysql':
+        cursor.execute("ALTER TABLE users MODIFY fines DECIMAL(10,2) DEFAULT 0.00")
+    _create_table(cursor, 'fine_ledger')
+
+def add_workload_indexes(cursor):
+    """
+    Adds covering indexes for the queries the modules actually issue.
+
+    - transactions (user_id, return_date, due_date, book_id, issue_date):
+      a user's open loans for get_loan_dashboard and get_transactions,
+      read from the index alone.
+    - transactions (return_date, due_date, user_id): open overdue loans
+      for the nightly fine run and overdue notices.
+    - transactions (book_id, return_date): open loans of a book, for
+      availability checks and hold wait estimates.
+    - reservations (book_id, status, reservation_date): the hold queue
+      of a book in arrival order.
+    """
+    # Earlier SQLite databases were created with narrower versions of these indexes
+    if db_config.DB_BACKEND == 'sqlite':
+        for table, index in [('transactions', 'idx_transactions_user_open'), ('transactions', 'idx_transactions_open_due'),
+                             ('transactions', 'idx_transactions_book'), ('reservations', 'idx_reservations_book_status')]:
+            _drop_index(cursor, table, index)
+    _create_index(cursor, 'transactions', 'idx_transactions_user_loans', ['user_id', 'return_date', 'due_date', 'book_id', 'issue_date'])
+    _create_index(cursor, 'transactions', 'idx_transactions_due', ['return_date', 'due_date', 'user_id'])
+    _create_index(cursor, 'transactions', 'idx_transactions_book_open', ['book_id', 'return_date'])
+    _create_index(cursor, 'reservations', 'idx_reservations_queue', ['book_id', 'status', 'reservation_date'])
+
+def add_hold_queue(cursor):
+    """
+    Adds the hold queue columns to reservations: priority, from the
+    holder's membership category, and hold_expires, set while a copy is
+    kept for the holder. The queue index replaces idx_reservations_queue,
+    and is created first because MySQL needs an index on book_id for the
+    foreign key at all times. reservations (user_id, status, book_id)
+    serves a user's active holds and the already-held check; it replaces
+    the narrower idx_reservations_user SQLite databases had for the user_id
+    foreign key, while on MySQL the foreign key had an index of its own.
+    """
+    from holds import priority_sql, DEFAULT_PRIORITY
+    _add_column(cursor, 'reservations', 'priority', f"TINYINT NOT NULL DEFAULT {DEFAULT_PRIORITY}")
+    _add_column(cursor, 'reservations', 'hold_expires', "DATE")
+    cursor.execute(f"""UPDATE reservations SET priority = COALESCE(
+                           (SELECT {priority_sql('u.membership_category')} FROM users u WHERE u.user_id = reservations.user_id),
+                           {DEFAULT_PRIORITY})
+                       WHERE status = 'active'""")
+    _create_index(cursor, 'reservations', 'idx_reservations_hold_queue', ['book_id', 'status', 'hold_expires', 'priority', 'reservation_id'])
+    _create_index(cursor, 'reservations', 'idx_reservations_hold_expiry', ['status', 'hold_expires'])
+    _drop_index(cursor, 'reservations', 'idx_reservations_queue')
+    _create_index(cursor, 'reservations', 'idx_reservations_user_holds', ['user_id', 'status', 'book_id'])
+    _drop_index(cursor, 'reservations', 'idx_reservations_user')
+
+def add_notice_index(cursor):
+    """
+    Adds an index on transactions (return_date, user_id, due_date): open
+    loans in user order, so overdue notices read them grouped by user in
+    keyset chunks without sorting. It holds the same columns as
+    idx_transactions_due, which it replaces: the fine run's overdue loans
+    are one range of it either way, with due_date checked in the index.
+    """
+    _create_index(cursor, 'transactions', 'idx_transactions_open_user', ['return_date', 'user_id', 'due_date'])
+    _drop_index(cursor, 'transactions', 'idx_transactions_due')
+
+# Applied in order; a version is never reused or edited once shipped
+MIGRATIONS = [
+    (1, 'add_search_index', add_search_index),
+    (2, 'add_fine_ledger', add_fine_ledger),
+    (3, 'add_workload_indexes', add_workload_indexes),
+    (4, 'add_hold_queue', add_hold_queue),
+    (5, 'add_notice_index', add_notice_index),
+]
+
+def _ensure_migrations_table(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                          version INT PRIMARY KEY,
+                          name VARCHAR(100) NOT NULL,
+                          applied_at DATETIME NOT NULL
+                      )""")
+
+def applied_versions():
+    """
+    Returns the versions already applied to the database, or None if it could not be reached.
+    """
+    with get_connection() as connection:
+        if not connection:
+            return None
+        cursor = connection.cursor()
+        _ensure_migrations_table(cursor)
+        cursor.execute("SELECT version FROM schema_migrations")
+        versions = {row[0] for row in cursor.fetchall()}
+        connection.commit()
+        cursor.close()
+    return versions
+
+def migrate():
+    """
+    Applies every pending migration in version order.
+
+    Each migration checks for the objects it creates, so it can be
+    re-run safely on a schema that already has them (e.g. a fresh install
+    from table-creation.sql). On MySQL, DDL commits implicitly, so a
+    failed migration is left unrecorded and is retried on the next run.
+
+    Returns:
+    list: Names of the migrations applied, or None if the database could not be reached
+    """
+    applied = applied_versions()
+    if applied is None:
+        return None
+    done = []
+    for version, name, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        with get_connection() as connection:
+            if not connection:
+                return None
+            cursor = connection.cursor()
+            try:
+                follow_up = migration(cursor)
+                cursor.execute("INSERT INTO schema_migrations (version, name, applied_at) VALUES (%s, %s, %s)",
+                               (version, name, datetime.now().replace(microsecond=0)))
+                connection.commit()
+            except Error as err:
+                connection.rollback()
+                print(f"Error: migration {version} ({name}) failed: {err}")
+                break
+            finally:
+                cursor.close()
+        print(f"Applied migration {version}: {name}")
+        if follow_up == 'rebuild_search_index':
+            from catalog_management import rebuild_search_index
+            rebuild_search_index()
+        done.append(name)
+    return done
+
+def shipped_queries():
+    """
+    Returns the queries the modules issue, with representative parameters,
+    keyed by a descriptive name. Keep this in sync when adding queries.
+    """
+    from catalog_management import _ranked_query
+    from fines import ACCRUE_QUERY
+    from holds import NEXT_HOLDS_QUERY, EXPIRED_HOLDS_QUERY, _AHEAD_SQL
+    from notices import NOTICE_LOANS_QUERY, USER_NOTICE_LOANS_QUERY
+    today = datetime.now().date()
+    return {
+        'search_books': _ranked_query(['history']),
+        'search_books_page (next page)': _ranked_query(['history'], after=(5, 100), limit=51),
+        'search_books (isbn)': ("SELECT * FROM books WHERE isbn IN (%s, %s, %s)", ('0140449132', '9780140449136', '0140449132')),
+        'get_book_by_id': ("SELECT * FROM books WHERE book_id = %s", (1,)),
+        'authenticate_user': ("SELECT * FROM users WHERE username = %s AND password = %s", ('user', 'hash')),
+        'get_user_id': ("SELECT user_id FROM users WHERE username = %s", ('user',)),
+        'get_transactions': ("SELECT * FROM transactions WHERE user_id = %s AND return_date IS NULL", (1,)),
+        'get_loan_dashboard': ("""SELECT u.fines, u.membership_category,
+                                         t.transaction_id, t.book_id, t.issue_date, t.due_date,
+                                         b.title, b.author, b.isbn
+                                  FROM users u
+                                  LEFT JOIN transactions t ON t.user_id = u.user_id AND t.return_date IS NULL
+                                  LEFT JOIN books b ON b.book_id = t.book_id
+                                  WHERE u.user_id = %s
+                                  ORDER BY t.due_date, t.transaction_id""", (1,)),
+        'issue_book': ("""UPDATE books SET available_copies = available_copies - 1
+                          WHERE book_id = %s AND available_copies > 0
+                          AND NOT EXISTS (SELECT 1 FROM users WHERE user_id = %s AND fines > 0)""", (1, 1)),
+        'return_book': ("UPDATE transactions SET return_date = %s WHERE transaction_id = %s AND return_date IS NULL", (today, 1)),
+        'accrue_fines (range)': ("SELECT MIN(transaction_id), MAX(transaction_id) FROM transactions WHERE return_date IS NULL AND due_date < %s",
+                                 (today,)),
+        'accrue_fines': (ACCRUE_QUERY, (today, today, today, 1, 50000, 1, 50000, today, today)),
+        'release_copies': (NEXT_HOLDS_QUERY, (1, 1)),
+        'collect_hold': ("""UPDATE reservations SET status = 'completed'
+                            WHERE user_id = %s AND book_id = %s AND status = 'active' AND hold_expires IS NOT NULL
+                            AND NOT EXISTS (SELECT 1 FROM users WHERE user_id = %s AND fines > 0)""", (1, 1, 1)),
+        'get_user_holds': (f"SELECT r.reservation_id, {_AHEAD_SQL} AS ahead FROM reservations r WHERE r.user_id = %s AND r.status = 'active'",
+                           (1,)),
+        'place_hold (already held)': ("SELECT COUNT(*) FROM reservations WHERE user_id = %s AND book_id = %s AND status = 'active'",
+                                       (1, 1)),
+        'expire_holds': (EXPIRED_HOLDS_QUERY, (today, 1000)),
+        'send_notices': (NOTICE_LOANS_QUERY, (1, today, 5000)),
+        'send_notices (one user)': (USER_NOTICE_LOANS_QUERY, (1, today)),
+    }
+
+def _full_scans(cursor, query, params):
+    """
+    Returns the names of the tables a query reads in full, according to EXPLAIN.
+    """
+    if db_config.DB_BACKEND == 'sqlite':
+        # EXPLAIN QUERY PLAN names tables by alias, and materialized subqueries by their own alias
+        aliases = {}
+        for table, alias in re.findall(r"\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", query, flags=re.IGNORECASE):
+            aliases[table] = table
+            if alias and alias.upper() not in ('WHERE', 'ON', 'SET', 'JOIN', 'LEFT', 'INNER', 'GROUP', 'ORDER', 'LIMIT', 'SELECT'):
+                aliases[alias] = table
+        cursor.execute("EXPLAIN QUERY PLAN " + query, params)
+        scans = []
+        for row in cursor.fetchall():
+            match = re.match(r"SCAN (\w+)", row['detail'])
+            if match and match.group(1) in aliases:
+                scans.append(aliases[match.group(1)])
+        return scans
+    cursor.execute("EXPLAIN " + query, params)
+    # type ALL is a table scan and index a full index scan; <derivedN> tables are subquery results
+    return [row['table'] for row in cursor.fetchall()
+            if row['type'] in ('ALL', 'index') and row['table'] and not row['table'].startswith('<')]
+
+def _row_count(cursor, table):
+    if db_config.DB_BACKEND == 'sqlite':
+        cursor.execute(f"SELECT COUNT(*) AS table_rows FROM {table}")
+    else:
+        # An estimate, which is all the check needs and avoids counting a large table
+        cursor.execute("SELECT TABLE_ROWS AS table_rows FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                       (table,))
+    row = cursor.fetchone()
+    return (row['table_rows'] or 0) if row else 0
+
+def check_plans(min_rows=DEFAULT_MIN_ROWS):
+    """
+    EXPLAINs every shipped query and reports full scans of large tables.
+
+    Parameters:
+    min_rows (int): Tables with fewer rows than this may be scanned, 0 flags every scan
+
+    Returns:
+    list: One message per full scan of a large table
+    """
+    problems = []
+    with get_connection() as connection:
+        if not connection:
+            return ["Could not connect to the database."]
+        cursor = connection.cursor(dictionary=True)
+        for name, (query, params) in shipped_queries().items():
+            for table in dict.fromkeys(_full_scans(cursor, query, params)):
+                rows = _row_count(cursor, table)
+                if rows >= min_rows:
+                    problems.append(f"{name}: full scan of {table} ({rows} rows)")
+        connection.rollback()
+        cursor.close()
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply schema migrations and check query plans.")
+    parser.add_argument("--status", action="store_true", help="List migrations and whether they are applied")
+    parser.add_argument("--check-plans", action="store_true", help="Fail if a shipped query fully scans a large table")
+    parser.add_argument("--min-rows", type=int, default=DEFAULT_MIN_ROWS, help="Row count from which a table counts as large")
+    args = parser.parse_args()
+
+    if args.status:
+        applied = applied_versions()
+        if applied is None:
+            sys.exit(1)
+        for version, name, _ in MIGRATIONS:
+            print(f"{version:4d} {name:30s} {'applied' if version in applied else 'pending'}")
+        return
+    if args.check_plans:
+        problems = check_plans(args.min_rows)
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+        print("No full scans of large tables.")
+        return
+    applied = migrate()
+    if applied is None:
+        sys.exit(1)
+    if not applied:
+        print("Schema is up to date.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+# notices.py
+from db_config import get_connection, Error
+from metrics import timed
+import argparse
+import json
+import os
+import smtplib
+import socket
+import time
+from datetime import date, datetime, timedelta
+from email.mime.text import MIMEText
+from email.utils import format_datetime
+from string import Template
+
+# Where notices are delivered: a Maildir (tmp/, new/, cur/) that a mail
+# client or an MTA picks them up from, overridable from .env
+NOTICE_SPOOL_DIR = os.environ.get('NOTICE_SPOOL_DIR') or 'notices'
+# host[:port] of an SMTP server to send notices to instead of the spool
+NOTICE_SMTP_HOST = os.environ.get('NOTICE_SMTP_HOST')
+NOTICE_FROM = os.environ.get('NOTICE_FROM') or 'library@localhost'
+# Signature at the end of every notice
+NOTICE_LIBRARY = os.environ.get('NOTICE_LIBRARY') or 'The Library'
+# Directory with <template name>.txt files replacing the TEMPLATES below
+NOTICE_TEMPLATE_DIR = os.environ.get('NOTICE_TEMPLATE_DIR')
+# Loans due back within this many days get a reminder
+NOTICE_DUE_SOON_DAYS = int(os.environ.get('NOTICE_DUE_SOON_DAYS') or 3)
+# Notices delivered per second, 0 for no limit
+NOTICE_RATE = float(os.environ.get('NOTICE_RATE') or 0)
+# Loans read per query
+NOTICE_CHUNK_SIZE = 5000
+# Notices delivered between checkpoints, and per SMTP connection
+NOTICE_BATCH_SIZE = 500
+
+# Notices are rendered with string.Template. A patron with an overdue loan
+# gets the 'overdue' notice, which also lists their loans due soon in the
+# 'due_soon_section'; the others get the 'due_soon' notice. Each loan is one
+# 'loan' line. A notice starts with its Subject header and a blank line.
+TEMPLATES = {
+    'overdue': """Subject: Overdue library books
+
+Dear $full_name,
+
+The following books are overdue. Please return or renew them as soon as
+possible, a fine is charged for every day a book is late.
+
+$overdue_loans
+$due_soon_section
+Your outstanding fines are $fines.
+
+$library
+""",
+    'due_soon': """Subject: Library books due soon
+
+Dear $full_name,
+
+The following books are due back by $due_soon_by:
+
+$due_soon_loans
+
+$library
+""",
+    'due_soon_section': """
+These books are also due back by $due_soon_by:
+
+$due_soon_loans
+""",
+    'loan': "  - $title by $author, due $due_date",
+}
+
+# Open loans due by a date of the users after a user_id, read in the order
+# of idx_transactions_open_user so each chunk is one index range read.
+# Only the user_id is ordered on: the last user of a full chunk may have
+# loans in the next one, so it is read again from the next chunk.
+NOTICE_LOANS_QUERY = """SELECT t.user_id, u.full_name, u.email, u.fines, t.transaction_id, t.due_date, b.title, b.author
+                        FROM transactions t
+                        JOIN users u ON u.user_id = t.user_id
+                        LEFT JOIN books b ON b.book_id = t.book_id
+                        WHERE t.return_date IS NULL AND t.user_id > %s AND t.due_date <= %s
+                        ORDER BY t.user_id
+                        LIMIT %s"""
+
+# All of one user's open loans due by a date, for a user with more loans than fit in a chunk
+USER_NOTICE_LOANS_QUERY = """SELECT t.user_id, u.full_name, u.email, u.fines, t.transaction_id, t.due_date, b.title, b.author
+                             FROM transactions t
+                             JOIN users u ON u.user_id = t.user_id
+                             LEFT JOIN books b ON b.book_id = t.book_id
+                             WHERE t.user_id = %s AND t.return_date IS NULL AND t.due_date <= %s"""
+
+def load_templates(directory=NOTICE_TEMPLATE_DIR):
+    """
+    Returns the notice templates, with those in directory replacing the defaults.
+
+    Parameters:
+    directory (str): Directory with <template name>.txt files, or None for the defaults
+
+    Returns:
+    dict: string.Template by template name
+
+    Raises ValueError if a template uses a placeholder that is not known.
+    """
+    templates = {}
+    for name, text in TEMPLATES.items():
+        path = os.path.join(directory, f"{name}.txt") if directory else None
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as template_file:
+                text = template_file.read()
+        templates[name] = Template(text)
+    # Renders a sample notice so a mistyped placeholder fails before anything is sent
+    sample = {'user_id': 0, 'full_name': '', 'email': '', 'fines': 0,
+              'loans': [(0, date.today(), '', ''), (0, date.today() - timedelta(days=1), '', '')]}
+    try:
+        render_notice(templates, sample, date.today(), date.today())
+    except (KeyError, ValueError) as err:
+        raise ValueError(f"Notice template uses an unknown placeholder: {err}")
+    return templates
+
+def render_notice(templates, user, as_of, due_soon_by):
+    """
+    Renders the notice of one user.
+
+    Parameters:
+    templates (dict): Templates returned by load_templates
+    user (dict): Dictionary with the keys user_id, full_name, email, fines and loans,
+        a list of (transaction_id, due_date, title, author) tuples
+    as_of (date): Loans due before this date are overdue
+    due_soon_by (date): Last due date of the loans due soon
+
+    Returns:
+    tuple: (subject, body)
+    """
+    def lines(loans):
+        return "\n".join(templates['loan'].substitute(title=title or '', author=author or 'unknown author', due_date=due_date)
+                         for _, due_date, title, author in sorted(loans, key=lambda loan: loan[1]))
+
+    overdue = [loan for loan in user['loans'] if loan[1] < as_of]
+    due_soon = [loan for loan in user['loans'] if loan[1] >= as_of]
+    values = {'full_name': user['full_name'] or 'patron', 'fines': f"{user['fines'] or 0:.2f}",
+              'due_soon_by': due_soon_by, 'due_soon_loans': lines(due_soon), 'library': NOTICE_LIBRARY}
+    if overdue:
+        section = templates['due_soon_section'].substitute(values) if due_soon else ""
+        text = templates['overdue'].substitute(values, overdue_loans=lines(overdue), due_soon_section=section)
+    else:
+        text = templates['due_soon'].substitute(values)
+
+    header, _, body = text.partition("\n\n")
+    subject = header[len("Subject:"):].strip() if header.startswith("Subject:") else ""
+    return subject, body
+
+def iter_notice_users(as_of, due_soon_by, after_user_id=0, chunk_size=NOTICE_CHUNK_SIZE):
+    """
+    Yields the users with loans overdue as of a date or due soon after it,
+    in user_id order, with their loans grouped. Loans are read in chunks of
+    chunk_size, one short indexed query each, so at most one chunk is held
+    in memory however many loans are open.
+
+    Parameters:
+    as_of (date): Date the notices are sent
+    due_soon_by (date): Last due date of the loans reminded of
+    after_user_id (int): Only users after this one are yielded, to resume a run
+    chunk_size (int): Number of loans read per query
+
+    Yields:
+    dict: Dictionary with the keys user_id, full_name, email, fines and loans,
+        a list of (transaction_id, due_date, title, author) tuples
+    """
+    def group(rows):
+        users = {}
+        for user_id, full_name, email, fines, transaction_id, due_date, title, author in rows:
+            if isinstance(due_date, datetime):
+                due_date = due_date.date()
+            user = users.setdefault(user_id, {'user_id': user_id, 'full_name': full_name, 'email': email,
+                                              'fines': fines, 'loans': []})
+            user['loans'].append((transaction_id, due_date, title, author))
+        return list(users.values())
+
+    while True:
+        with get_connection(readonly=True) as connection:
+            if not connection:
+                return
+            cursor = connection.cursor()
+            try:
+                cursor.execute(NOTICE_LOANS_QUERY, (after_user_id, due_soon_by, chunk_size))
+                rows = cursor.fetchall()
+                complete = len(rows) < chunk_size
+                if not complete and rows[0][0] == rows[-1][0]:
+                    # One user with more loans than a chunk
+                    cursor.execute(USER_NOTICE_LOANS_QUERY, (rows[0][0], due_soon_by))
+                    rows = cursor.fetchall()
+                    complete = None
+                connection.commit()
+            finally:
+                cursor.close()
+        users = group(rows)
+        if complete is False:
+            # The last user's loans may continue in the next chunk
+            users.pop()
+        yield from users
+        if complete or not users:
+            return
+        after_user_id = users[-1]['user_id']
+
+def build_message(user, subject, body, as_of):
+    """
+    Returns the email of a rendered notice. Its Message-ID is the same for
+    the same user and day, so a notice delivered again by a resumed run can
+    be recognised as a duplicate.
+    """
+    # MIMEText rather than EmailMessage: it does not parse and refold every header, several times faster per notice
+    message = MIMEText(body)
+    message['From'] = NOTICE_FROM
+    message['To'] = user['email']
+    message['Subject'] = subject
+    message['Date'] = format_datetime(datetime.now().astimezone())
+    message['Message-ID'] = f"<notice.{as_of.isoformat()}.{user['user_id']}@{NOTICE_FROM.rpartition('@')[2] or 'library'}>"
+    return message
+
+class MaildirSpool:
+    """
+    Delivers notices into a Maildir. A batch is written to tmp/, flushed to
+    disk and renamed into new/, so readers never see a partly written
+    message. A notice is named after its day and user, so delivering it
+    again replaces it.
+    """
+
+    def __init__(self, directory=NOTICE_SPOOL_DIR):
+        self.directory = directory
+        for subdirectory in ('tmp', 'new', 'cur'):
+            os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+        self._host = socket.gethostname().replace('/', '_').replace(':', '_')
+
+    def send_batch(self, messages):
+        """
+        Delivers a list of (user, message, as_of) tuples.
+        """
+        names = []
+        for user, message, as_of in messages:
+            name = f"notice-{as_of.isoformat()}-{user['user_id']}.{self._host}"
+            with open(os.path.join(self.directory, 'tmp', name), 'wb') as message_file:
+                message_file.write(message.as_bytes())
+                if not hasattr(os, 'sync'):
+                    os.fsync(message_file.fileno())
+            names.append(name)
+        if hasattr(os, 'sync'):
+            # One flush for the whole batch rather than one per message
+            os.sync()
+        for name in names:
+            os.replace(os.path.join(self.directory, 'tmp', name), os.path.join(self.directory, 'new', name))
+
+class SMTPSpool:
+    """
+    Sends notices to an SMTP server, one connection per batch.
+    """
+
+    def __init__(self, host=NOTICE_SMTP_HOST):
+        self.host, _, port = host.partition(':')
+        self.port = int(port) if port else 25
+
+    def send_batch(self, messages):
+        """
+        Sends a list of (user, message, as_of) tuples.
+        """
+        with smtplib.SMTP(self.host, self.port, timeout=30) as server:
+            for _, message, _ in messages:
+                server.send_message(message)
+
+def _checkpoint_path(directory, as_of):
+    return os.path.join(directory, f".checkpoint-{as_of.isoformat()}.json")
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as checkpoint_file:
+            return json.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+
+def _write_checkpoint(path, checkpoint):
+    temporary = f"{path}.tmp"
+    with open(temporary, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temporary, path)
+
+@timed
+def send_notices(as_of=None, due_soon_days=NOTICE_DUE_SOON_DAYS, spool=None, batch_size=NOTICE_BATCH_SIZE,
+                 rate=NOTICE_RATE, restart=False, chunk_size=NOTICE_CHUNK_SIZE):
+    """
+    Sends every patron with overdue loans, or loans due within due_soon_days,
+    one notice listing them.
+
+    Loans are streamed from the database in chunks grouped by user, and
+    notices are rendered and delivered in batches of batch_size, so memory
+    stays bounded however many are sent. After each batch the last user
+    notified is saved to a checkpoint file in NOTICE_SPOOL_DIR for the day.
+    A run that is stopped resumes after that user when run again for the
+    same day, and a finished run sends nothing more that day unless
+    restart is set. Notices of a batch that was being delivered when the
+    run stopped are delivered again; the spool replaces them, and SMTP
+    receivers can recognise them by their Message-ID.
+
+    Parameters:
+    as_of (date): Day the notices are for, defaults to today
+    due_soon_days (int): Loans due within this many days get a reminder
+    spool: Object with a send_batch(messages) method, defaults to SMTPSpool
+        if NOTICE_SMTP_HOST is set and MaildirSpool otherwise
+    batch_size (int): Notices delivered between checkpoints
+    rate (float): Notices delivered per second at most, 0 for no limit
+    restart (bool): Whether to ignore the day's checkpoint and send every notice again
+    chunk_size (int): Number of loans read per query
+
+    Returns:
+    dict: Dictionary with the keys sent (notices delivered), skipped (patrons without an email address),
+        loans (loans listed in the notices sent), resumed_after (user_id the run resumed after) and elapsed (seconds)
+    """
+    as_of = as_of or datetime.now().date()
+    due_soon_by = as_of + timedelta(days=due_soon_days)
+    stats = {"sent": 0, "skipped": 0, "loans": 0, "resumed_after": 0, "elapsed": 0.0}
+    started = time.monotonic()
+
+    templates = load_templates()
+    if spool is None:
+        spool = SMTPSpool() if NOTICE_SMTP_HOST else MaildirSpool()
+    os.makedirs(NOTICE_SPOOL_DIR, exist_ok=True)
+    checkpoint_path = _checkpoint_path(NOTICE_SPOOL_DIR, as_of)
+    checkpoint = None if restart else _read_checkpoint(checkpoint_path)
+    if checkpoint and checkpoint.get('done'):
+        stats["elapsed"] = time.monotonic() - started
+        return stats
+    after_user_id = checkpoint['after_user_id'] if checkpoint else 0
+    stats["resumed_after"] = after_user_id
+
+    interval = 1 / rate if rate > 0 else 0
+    next_send = time.monotonic()
+    batch = []
+
+    def deliver(last_user_id, done=False):
+        if batch:
+            spool.send_batch(batch)
+            stats["sent"] += len(batch)
+            stats["loans"] += sum(len(user['loans']) for user, _, _ in batch)
+            batch.clear()
+        _write_checkpoint(checkpoint_path, {'as_of': as_of.isoformat(), 'after_user_id': last_user_id, 'done': done})
+
+    last_user_id = after_user_id
+    try:
+        for user in iter_notice_users(as_of, due_soon_by, after_user_id, chunk_size):
+            last_user_id = user['user_id']
+            if not user['email']:
+                stats["skipped"] += 1
+                continue
+            if interval:
+                # Paced as the notices are built, so a batch is delivered at the rate it was filled
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_send = max(next_send, time.monotonic()) + interval
+            subject, body = render_notice(templates, user, as_of, due_soon_by)
+            batch.append((user, build_message(user, subject, body, as_of), as_of))
+            if len(batch) >= batch_size:
+                deliver(last_user_id)
+        deliver(last_user_id, done=True)
+    except (Error, OSError, smtplib.SMTPException) as err:
+        # The checkpoint still names the last batch delivered in full
+        print(f"Error: {err}")
+
+    stats["elapsed"] = time.monotonic() - started
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Send patrons notices of overdue loans and loans due soon. Run again to resume a stopped run.")
+    parser.add_argument("--as-of", type=date.fromisoformat, help="Day the notices are for (YYYY-MM-DD), defaults to today")
+    parser.add_argument("--due-soon-days", type=int, default=NOTICE_DUE_SOON_DAYS, help="Remind of loans due within this many days")
+    parser.add_argument("--batch-size", type=int, default=NOTICE_BATCH_SIZE, help="Notices delivered between checkpoints")
+    parser.add_argument("--rate", type=float, default=NOTICE_RATE, help="Notices delivered per second at most, 0 for no limit")
+    parser.add_argument("--restart", action="store_true", help="Ignore the day's checkpoint and send every notice again")
+    args = parser.parse_args()
+
+    try:
+        stats = send_notices(args.as_of, args.due_soon_days, batch_size=args.batch_size, rate=args.rate, restart=args.restart)
+    except ValueError as err:
+        print(f"Error: {err}")
+        return
+    resumed = f" (resumed after user {stats['resumed_after']})" if stats['resumed_after'] else ""
+    print(f"Sent {stats['sent']} notices listing {stats['loans']} loans{resumed}, skipped {stats['skipped']} patrons "
+          f"without an email address, in {stats['elapsed']:.1f}s.")
+
+if __name__ == "__main__":
+    main()
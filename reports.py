@@ -0,0 +1,419 @@
+# reports.py
+import argparse
+import ast
+import csv
+import importlib
+import json
+import os
+import sys
+import time
+import zipfile
+from array import array
+from collections import Counter
+from datetime import date, datetime
+
+from db_config import get_connection, Error
+from metrics import timed
+
+# Where reports and the snapshot are written, overridable from .env
+REPORTS_DIR = os.environ.get('REPORTS_DIR') or 'reports'
+SNAPSHOT_PATH = os.path.join(REPORTS_DIR, 'snapshot.npz')
+# Set to 0 to aggregate in pure Python even if NumPy is installed
+USE_NUMPY = (os.environ.get('REPORTS_USE_NUMPY') or '1') not in ('0', 'false', 'no')
+# Rows read per query; each chunk is its own short statement so no long read holds up the database
+CHUNK_SIZE = 50000
+# Rows fetched per round trip within a chunk
+FETCH_SIZE = 5000
+# Titles listed in the most borrowed report
+TOP_BOOKS = 20
+
+# Membership categories and Dewey classes are stored as small integer codes
+CATEGORIES = ('staff', 'student', 'public')
+DEWEY_CLASSES = tuple(f"{digit}00" for digit in range(10)) + ('unclassified',)
+UNCLASSIFIED = len(DEWEY_CLASSES) - 1
+
+# Columns of each snapshot table: (column, array typecode). Dates are day
+# ordinals with 0 for NULL, and amounts are in cents.
+TABLES = {
+    'transactions': (('transaction_id', 'q'), ('book_id', 'q'), ('user_id', 'q'),
+                     ('issue_day', 'i'), ('due_day', 'i'), ('return_day', 'i')),
+    'books': (('book_id', 'q'), ('dewey', 'b'), ('total_copies', 'i')),
+    'users': (('user_id', 'q'), ('category', 'b'), ('fines', 'q')),
+    'fine_ledger': (('ledger_id', 'q'), ('user_id', 'q'), ('accrual_day', 'i'), ('amount', 'q')),
+}
+_DTYPES = {'b': '<i1', 'i': '<i4', 'q': '<i8'}
+
+def _day(value):
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        value = date.fromisoformat(value[:10])
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.toordinal()
+
+def _cents(value):
+    return int(round((value or 0) * 100))
+
+def _dewey(value):
+    value = (value or "").strip()
+    return int(value[0]) if value[:1].isdigit() else UNCLASSIFIED
+
+def _category(value):
+    return CATEGORIES.index(value) if value in CATEGORIES else CATEGORIES.index('public')
+
+# Queries reading each table in keyset order from a given id, with a function
+# converting a row to the table's column values
+_SCANS = {
+    'transactions': ("""SELECT transaction_id, book_id, user_id, issue_date, due_date, return_date
+                        FROM transactions WHERE transaction_id > %s ORDER BY transaction_id LIMIT %s""",
+                     lambda row: (row[0], row[1] or 0, row[2] or 0, _day(row[3]), _day(row[4]), _day(row[5]))),
+    'books': ("""SELECT book_id, dewey_decimal, total_copies, title, author
+                 FROM books WHERE book_id > %s ORDER BY book_id LIMIT %s""",
+              lambda row: (row[0], _dewey(row[1]), row[2] or 0)),
+    'users': ("""SELECT user_id, membership_category, fines
+                 FROM users WHERE user_id > %s ORDER BY user_id LIMIT %s""",
+              lambda row: (row[0], _category(row[1]), _cents(row[2]))),
+    'fine_ledger': ("""SELECT ledger_id, user_id, accrual_date, amount
+                       FROM fine_ledger WHERE ledger_id > %s ORDER BY ledger_id LIMIT %s""",
+                    lambda row: (row[0], row[1], _day(row[2]), _cents(row[3]))),
+}
+
+def _numpy():
+    # NumPy is optional and slow to import, so it is only loaded when a report runs
+    if not USE_NUMPY:
+        return None
+    try:
+        return importlib.import_module('numpy')
+    except ImportError:
+        return None
+
+class Snapshot:
+    """
+    A columnar copy of the tables the reports read: one typed array per
+    column, plus the titles and authors of the books.
+
+    Snapshots are saved as .npz files, a zip of one .npy file per column,
+    which NumPy can load directly but which are written and read here
+    without it.
+    """
+
+    def __init__(self, columns=None, labels=None, created=None):
+        self.columns = columns or {f"{table}.{column}": array(typecode)
+                                   for table, spec in TABLES.items() for column, typecode in spec}
+        self.labels = labels or {}
+        self.created = created or datetime.now().isoformat(timespec='seconds')
+
+    def column(self, table, column):
+        return self.columns[f"{table}.{column}"]
+
+    def rows(self, table):
+        """
+        Returns the number of rows of a table.
+        """
+        return len(self.column(table, TABLES[table][0][0]))
+
+    def save(self, path):
+        """
+        Writes the snapshot to path, replacing any snapshot there only once it is complete.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = f"{path}.tmp"
+        with zipfile.ZipFile(temporary, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, values in self.columns.items():
+                archive.writestr(f"{name}.npy", _npy_bytes(values))
+            archive.writestr('meta.json', json.dumps({'created': self.created, 'labels': self.labels}))
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a snapshot written by save().
+        """
+        columns = {}
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                if name.endswith('.npy'):
+                    columns[name[:-len('.npy')]] = _npy_array(archive.read(name))
+            meta = json.loads(archive.read('meta.json'))
+        labels = {int(book_id): label for book_id, label in meta['labels'].items()}
+        return cls(columns, labels, meta['created'])
+
+def _npy_bytes(values):
+    # Format version 1.0: magic, version, header length, header padded to a multiple of 64 bytes
+    header = f"{{'descr': '{_DTYPES[values.typecode]}', 'fortran_order': False, 'shape': ({len(values)},), }}"
+    header += " " * (63 - (10 + len(header)) % 64) + "\n"
+    data = values
+    if sys.byteorder == 'big':
+        data = array(values.typecode, values)
+        data.byteswap()
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, 'little') + header.encode('latin1') + data.tobytes()
+
+def _npy_array(content):
+    header_length = int.from_bytes(content[8:10], 'little')
+    header = ast.literal_eval(content[10:10 + header_length].decode('latin1'))
+    typecode = {dtype: typecode for typecode, dtype in _DTYPES.items()}[header['descr']]
+    values = array(typecode)
+    values.frombytes(content[10 + header_length:])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+@timed
+def take_snapshot(chunk_size=CHUNK_SIZE, fetch_size=FETCH_SIZE):
+    """
+    Copies the transactions, books, users and fine_ledger tables into a
+    Snapshot.
+
+    Each table is read in primary key order, chunk_size rows per query,
+    from an unbuffered cursor fetch_size rows at a time, and committed
+    between chunks. No statement runs for long or holds a read view open,
+    so the copy can run against the production database during opening hours.
+
+    Returns:
+    Snapshot: The copy, or None if the database could not be read
+    """
+    snapshot = Snapshot()
+    with get_connection(readonly=True) as connection:
+        if not connection:
+            return None
+        try:
+            for table, (query, convert) in _SCANS.items():
+                columns = [snapshot.column(table, column) for column, _ in TABLES[table]]
+                last_id = 0
+                while True:
+                    cursor = connection.cursor(buffered=False)
+                    cursor.execute(query, (last_id, chunk_size))
+                    count = 0
+                    while True:
+                        rows = cursor.fetchmany(fetch_size)
+                        if not rows:
+                            break
+                        for row in rows:
+                            for values, value in zip(columns, convert(row)):
+                                values.append(value)
+                            if table == 'books':
+                                snapshot.labels[row[0]] = f"{row[3]} by {row[4]}" if row[4] else row[3]
+                        count += len(rows)
+                        last_id = rows[-1][0]
+                    cursor.close()
+                    connection.commit()
+                    if count < chunk_size:
+                        break
+        except Error as err:
+            connection.rollback()
+            print(f"Error: {err}")
+            return None
+    return snapshot
+
+def _aggregate_numpy(np, snapshot, first_day, last_day, as_of_day, top):
+    def column(table, name):
+        values = snapshot.column(table, name)
+        return np.frombuffer(values, dtype=_DTYPES[values.typecode]) if len(values) else np.zeros(0, dtype=np.int64)
+
+    issue_day = column('transactions', 'issue_day')
+    in_period = (issue_day >= first_day) & (issue_day <= last_day)
+    book_id = column('transactions', 'book_id')[in_period]
+    user_id = column('transactions', 'user_id')[in_period]
+    due_day = column('transactions', 'due_day')[in_period]
+    return_day = column('transactions', 'return_day')[in_period]
+
+    # Lookup arrays from id to code, -1 for ids missing from the snapshot
+    users = column('users', 'user_id')
+    category_of = np.full(int(max(users.max(initial=0), user_id.max(initial=0))) + 1, -1, dtype=np.int64)
+    category_of[users] = column('users', 'category')
+    books = column('books', 'book_id')
+    dewey_of = np.full(int(max(books.max(initial=0), book_id.max(initial=0))) + 1, UNCLASSIFIED, dtype=np.int64)
+    dewey_of[books] = column('books', 'dewey')
+
+    loans_per_book = np.bincount(book_id, minlength=1)
+    top_ids = np.argsort(-loans_per_book, kind='stable')[:top]
+    most_borrowed = [(int(book), int(loans_per_book[book])) for book in top_ids if loans_per_book[book] > 0]
+
+    category = category_of[user_id]
+    known = category >= 0
+    late = (return_day > due_day) | ((return_day == 0) & (due_day < as_of_day))
+    open_overdue = (return_day == 0) & (due_day < as_of_day)
+    loans_by_category = np.bincount(category[known], minlength=len(CATEGORIES))
+    late_by_category = np.bincount(category[known & late], minlength=len(CATEGORIES))
+    open_by_category = np.bincount(category[known & open_overdue], minlength=len(CATEGORIES))
+
+    accrual_day = column('fine_ledger', 'accrual_day')
+    charged = (accrual_day >= first_day) & (accrual_day <= last_day)
+    ledger_category = category_of[column('fine_ledger', 'user_id')[charged]]
+    amounts = column('fine_ledger', 'amount')[charged]
+    charged_by_category = np.bincount(ledger_category[ledger_category >= 0], weights=amounts[ledger_category >= 0],
+                                      minlength=len(CATEGORIES))
+    user_category = column('users', 'category')
+    outstanding_by_category = np.bincount(user_category, weights=column('users', 'fines'), minlength=len(CATEGORIES))
+    members_by_category = np.bincount(user_category, minlength=len(CATEGORIES))
+
+    book_dewey = column('books', 'dewey')
+    titles_by_class = np.bincount(book_dewey, minlength=len(DEWEY_CLASSES))
+    copies_by_class = np.bincount(book_dewey, weights=column('books', 'total_copies'), minlength=len(DEWEY_CLASSES))
+    loans_by_class = np.bincount(dewey_of[book_id], minlength=len(DEWEY_CLASSES))
+    borrowed_by_class = np.bincount(dewey_of[np.unique(book_id)], minlength=len(DEWEY_CLASSES))
+
+    return {
+        'most_borrowed': most_borrowed,
+        'categories': [[int(value) for value in counts] for counts in
+                       (loans_by_category, late_by_category, open_by_category,
+                        charged_by_category, outstanding_by_category, members_by_category)],
+        'classes': [[int(value) for value in counts] for counts in
+                    (titles_by_class, copies_by_class, loans_by_class, borrowed_by_class)],
+    }
+
+def _aggregate_python(snapshot, first_day, last_day, as_of_day, top):
+    category_of = dict(zip(snapshot.column('users', 'user_id'), snapshot.column('users', 'category')))
+    dewey_of = dict(zip(snapshot.column('books', 'book_id'), snapshot.column('books', 'dewey')))
+    size = len(CATEGORIES)
+    loans, late, open_overdue = [0] * size, [0] * size, [0] * size
+    loans_per_book = Counter()
+    loans_by_class = [0] * len(DEWEY_CLASSES)
+
+    transactions = zip(snapshot.column('transactions', 'book_id'), snapshot.column('transactions', 'user_id'),
+                       snapshot.column('transactions', 'issue_day'), snapshot.column('transactions', 'due_day'),
+                       snapshot.column('transactions', 'return_day'))
+    for book_id, user_id, issue_day, due_day, return_day in transactions:
+        if not first_day <= issue_day <= last_day:
+            continue
+        loans_per_book[book_id] += 1
+        loans_by_class[dewey_of.get(book_id, UNCLASSIFIED)] += 1
+        category = category_of.get(user_id)
+        if category is None:
+            continue
+        loans[category] += 1
+        if return_day == 0 and due_day < as_of_day:
+            open_overdue[category] += 1
+            late[category] += 1
+        elif return_day > due_day:
+            late[category] += 1
+
+    charged = [0] * size
+    for user_id, accrual_day, amount in zip(snapshot.column('fine_ledger', 'user_id'),
+                                            snapshot.column('fine_ledger', 'accrual_day'),
+                                            snapshot.column('fine_ledger', 'amount')):
+        category = category_of.get(user_id)
+        if category is not None and first_day <= accrual_day <= last_day:
+            charged[category] += amount
+    outstanding, members = [0] * size, [0] * size
+    for category, fines in zip(snapshot.column('users', 'category'), snapshot.column('users', 'fines')):
+        outstanding[category] += fines
+        members[category] += 1
+
+    titles_by_class, copies_by_class, borrowed_by_class = ([0] * len(DEWEY_CLASSES) for _ in range(3))
+    for book_id, dewey, copies in zip(snapshot.column('books', 'book_id'), snapshot.column('books', 'dewey'),
+                                      snapshot.column('books', 'total_copies')):
+        titles_by_class[dewey] += 1
+        copies_by_class[dewey] += copies
+    for book_id in loans_per_book:
+        borrowed_by_class[dewey_of.get(book_id, UNCLASSIFIED)] += 1
+
+    # Ties are broken by book_id, the same as the NumPy path
+    most_borrowed = sorted(loans_per_book.items(), key=lambda item: (-item[1], item[0]))[:top]
+    return {
+        'most_borrowed': most_borrowed,
+        'categories': [loans, late, open_overdue, charged, outstanding, members],
+        'classes': [titles_by_class, copies_by_class, loans_by_class, borrowed_by_class],
+    }
+
+@timed
+def build_reports(snapshot, since=None, until=None, as_of=None, top=TOP_BOOKS):
+    """
+    Computes the management reports from a snapshot.
+
+    Loans are counted in the period they were issued in and fines in the
+    period they were charged in. The group-bys are vectorized with NumPy
+    when it is installed, and done in plain Python otherwise.
+
+    Parameters:
+    snapshot (Snapshot): The data, e.g. from take_snapshot() or Snapshot.load()
+    since (date): First issue date counted, defaults to the first loan
+    until (date): Last issue date counted, defaults to as_of
+    as_of (date): Date loans still out are counted as overdue at, defaults to today
+    top (int): Titles listed in most_borrowed
+
+    Returns:
+    dict: Dictionary with the keys most_borrowed, overdue_by_category, fines_by_category and usage_by_dewey_class
+        (lists of row dictionaries), plus period, snapshot_created and engine
+    """
+    as_of = as_of or datetime.now().date()
+    first_day = since.toordinal() if since else 0
+    last_day = (until or as_of).toordinal()
+    np = _numpy()
+    if np is not None:
+        totals = _aggregate_numpy(np, snapshot, first_day, last_day, as_of.toordinal(), top)
+    else:
+        totals = _aggregate_python(snapshot, first_day, last_day, as_of.toordinal(), top)
+
+    loans, late, open_overdue, charged, outstanding, members = totals['categories']
+    titles, copies, class_loans, borrowed = totals['classes']
+    return {
+        'period': {'since': since.isoformat() if since else None, 'until': (until or as_of).isoformat(),
+                   'as_of': as_of.isoformat()},
+        'snapshot_created': snapshot.created,
+        'engine': 'numpy' if np is not None else 'python',
+        'most_borrowed': [{'book_id': book_id, 'title': snapshot.labels.get(book_id), 'loans': count}
+                          for book_id, count in totals['most_borrowed']],
+        'overdue_by_category': [{'membership_category': name, 'loans': loans[i], 'returned_late_or_overdue': late[i],
+                                 'overdue_now': open_overdue[i], 'overdue_rate': round(late[i] / loans[i], 4) if loans[i] else 0.0}
+                                for i, name in enumerate(CATEGORIES)],
+        'fines_by_category': [{'membership_category': name, 'members': members[i], 'charged': charged[i] / 100,
+                               'outstanding': outstanding[i] / 100}
+                              for i, name in enumerate(CATEGORIES)],
+        'usage_by_dewey_class': [{'dewey_class': name, 'titles': titles[i], 'copies': copies[i], 'loans': class_loans[i],
+                                  'titles_borrowed': borrowed[i],
+                                  'loans_per_copy': round(class_loans[i] / copies[i], 4) if copies[i] else 0.0}
+                                 for i, name in enumerate(DEWEY_CLASSES)],
+    }
+
+def write_reports(reports, directory=REPORTS_DIR):
+    """
+    Writes the reports to a directory, as reports.json and one CSV file per report.
+
+    Returns:
+    list: Paths of the files written
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = [os.path.join(directory, 'reports.json')]
+    with open(paths[0], 'w') as report_file:
+        json.dump(reports, report_file, indent=2)
+    for name in ('most_borrowed', 'overdue_by_category', 'fines_by_category', 'usage_by_dewey_class'):
+        rows = reports[name]
+        paths.append(os.path.join(directory, f"{name}.csv"))
+        with open(paths[-1], 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=list(rows[0]) if rows else ['empty'])
+            writer.writeheader()
+            writer.writerows(rows)
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description="Circulation reports: most borrowed titles, overdue rates and fines by membership category, and usage by Dewey class.")
+    parser.add_argument("--snapshot", default=SNAPSHOT_PATH, help="Snapshot file the reports are computed from")
+    parser.add_argument("--refresh", action="store_true", help="Copy the database into a new snapshot even if one exists")
+    parser.add_argument("--since", type=date.fromisoformat, help="First issue date counted (YYYY-MM-DD)")
+    parser.add_argument("--until", type=date.fromisoformat, help="Last issue date counted (YYYY-MM-DD), defaults to --as-of")
+    parser.add_argument("--as-of", type=date.fromisoformat, help="Date loans still out are counted as overdue at, defaults to today")
+    parser.add_argument("--top", type=int, default=TOP_BOOKS, help="Titles listed in the most borrowed report")
+    parser.add_argument("--output-dir", default=REPORTS_DIR, help="Directory the reports are written to")
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    if args.refresh or not os.path.exists(args.snapshot):
+        snapshot = take_snapshot()
+        if snapshot is None:
+            sys.exit(1)
+        snapshot.save(args.snapshot)
+        print(f"Saved a snapshot of {snapshot.rows('transactions')} loans to {args.snapshot} in {time.monotonic() - started:.1f}s.")
+    else:
+        snapshot = Snapshot.load(args.snapshot)
+        print(f"Using the snapshot taken {snapshot.created}, pass --refresh for a new one.")
+
+    reports = build_reports(snapshot, args.since, args.until, args.as_of, args.top)
+    paths = write_reports(reports, args.output_dir)
+    print(f"Wrote {', '.join(paths)} in {time.monotonic() - started:.1f}s ({reports['engine']} group-bys).")
+
+if __name__ == "__main__":
+    main()
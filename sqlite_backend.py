@@ -0,0 +1,218 @@
+# sqlite_backend.py
+import os
+import re
+import sqlite3
+import threading
+from datetime import date
+from decimal import Decimal
+from functools import lru_cache
+
+# Schema applied to new SQLite databases, the SQLite version of table-creation.sql
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'table-creation-sqlite.sql')
+# Milliseconds a writer waits for another connection's write lock before giving up
+BUSY_TIMEOUT_MS = 5000
+
+# MySQL error numbers reported for the matching SQLite errors, so callers can
+# handle both backends the same way
+ER_LOCK_WAIT_TIMEOUT = 1205
+ER_DUP_ENTRY = 1062
+ER_NO_REFERENCED_ROW = 1452
+
+class Error(Exception):
+    """
+    Base class of the errors raised by SQLite connections. Like
+    mysql.connector.Error it has `errno` and `msg` attributes.
+    """
+
+    def __init__(self, msg, errno=None):
+        super().__init__(msg)
+        self.msg = msg
+        self.errno = errno
+
+class IntegrityError(Error):
+    pass
+
+class OperationalError(Error):
+    pass
+
+def _translate_error(err):
+    message = str(err)
+    if isinstance(err, sqlite3.IntegrityError):
+        errno = ER_DUP_ENTRY if "UNIQUE" in message else ER_NO_REFERENCED_ROW if "FOREIGN KEY" in message else None
+        return IntegrityError(message, errno)
+    if isinstance(err, sqlite3.OperationalError):
+        # "database is locked" plays the role of a MySQL lock wait timeout
+        return OperationalError(message, ER_LOCK_WAIT_TIMEOUT if "locked" in message else None)
+    return Error(message)
+
+@lru_cache(maxsize=512)
+def translate_sql(query):
+    """
+    Rewrites the MySQL dialect used by the domain modules to SQLite.
+
+    Handles %s placeholders, INSERT IGNORE, ON DUPLICATE KEY UPDATE with
+    VALUES(column) and locking reads (FOR UPDATE), which SQLite does not
+    need because writers lock the whole database.
+
+    Parameters:
+    query (str): Query in MySQL dialect
+
+    Returns:
+    str: The equivalent SQLite query
+    """
+    query = query.replace("%s", "?")
+    query = re.sub(r"\bINSERT\s+IGNORE\b", "INSERT OR IGNORE", query, flags=re.IGNORECASE)
+    match = re.search(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", query, flags=re.IGNORECASE)
+    if match:
+        assignments = re.sub(r"\bVALUES\((\w+)\)", r"excluded.\1", query[match.end():], flags=re.IGNORECASE)
+        query = query[:match.start()] + "ON CONFLICT DO UPDATE SET" + assignments
+    query = re.sub(r"\s+FOR\s+UPDATE\b", "", query, flags=re.IGNORECASE)
+    return query
+
+def _datediff(first, second):
+    if first is None or second is None:
+        return None
+    return (date.fromisoformat(str(first)[:10]) - date.fromisoformat(str(second)[:10])).days
+
+sqlite3.register_adapter(date, date.isoformat)
+# SQLite stores DECIMAL columns as REAL anyway, and a float also compares
+# correctly with computed values such as search scores, which a string would not
+sqlite3.register_adapter(Decimal, float)
+sqlite3.register_converter("DATE", lambda value: date.fromisoformat(value.decode()))
+sqlite3.register_converter("DECIMAL", lambda value: Decimal(value.decode()))
+
+class Cursor:
+    """
+    Wraps a sqlite3 cursor with the parts of the mysql.connector cursor API
+    the domain modules use, including dictionary rows.
+    """
+
+    def __init__(self, cursor, dictionary=False):
+        self._cursor = cursor
+        self.dictionary = dictionary
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def execute(self, query, params=()):
+        try:
+            self._cursor.execute(translate_sql(query), tuple(params or ()))
+        except sqlite3.Error as err:
+            raise _translate_error(err) from err
+
+    def executemany(self, query, seq_of_params):
+        try:
+            self._cursor.executemany(translate_sql(query), [tuple(params) for params in seq_of_params])
+        except sqlite3.Error as err:
+            raise _translate_error(err) from err
+
+    def _row(self, row):
+        if row is None or not self.dictionary:
+            return row
+        return {column[0]: value for column, value in zip(self._cursor.description, row)}
+
+    def fetchone(self):
+        return self._row(self._cursor.fetchone())
+
+    def fetchmany(self, size=1):
+        return [self._row(row) for row in self._cursor.fetchmany(size)]
+
+    def fetchall(self):
+        return [self._row(row) for row in self._cursor.fetchall()]
+
+    def __iter__(self):
+        for row in self._cursor:
+            yield self._row(row)
+
+    def close(self):
+        self._cursor.close()
+
+class Connection:
+    """
+    Wraps a sqlite3 connection with the parts of the mysql.connector
+    connection API the domain modules and the pool use.
+    """
+
+    # SQLite rows are always read on demand, there is never an unread result to drain
+    unread_result = False
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self, dictionary=False, buffered=None):
+        return Cursor(self._connection.cursor(), dictionary)
+
+    @property
+    def in_transaction(self):
+        return self._connection.in_transaction
+
+    def commit(self):
+        try:
+            self._connection.commit()
+        except sqlite3.Error as err:
+            raise _translate_error(err) from err
+
+    def rollback(self):
+        try:
+            self._connection.rollback()
+        except sqlite3.Error as err:
+            raise _translate_error(err) from err
+
+    def is_connected(self):
+        try:
+            self._connection.execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def ping(self, reconnect=False):
+        if not self.is_connected():
+            raise OperationalError("SQLite connection is closed")
+
+    def consume_results(self):
+        pass
+
+    def close(self):
+        self._connection.close()
+
+_initialized = set()
+_initialize_lock = threading.Lock()
+
+def connect(path):
+    """
+    Opens a SQLite database in WAL mode, creating its tables and indexes
+    if the database is new.
+
+    Parameters:
+    path (str): Path of the database file
+
+    Returns:
+    Connection: The wrapped connection
+    """
+    try:
+        connection = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False,
+                                     timeout=BUSY_TIMEOUT_MS / 1000)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.create_function("DATEDIFF", 2, _datediff, deterministic=True)
+        with _initialize_lock:
+            if path not in _initialized:
+                # Existing databases are upgraded by migrations.py, whose changes the
+                # schema may already depend on (e.g. indexes on added columns)
+                if not connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'users'").fetchone()[0]:
+                    with open(SCHEMA_PATH) as schema:
+                        connection.executescript(schema.read())
+                _initialized.add(path)
+    except sqlite3.Error as err:
+        raise _translate_error(err) from err
+    return Connection(connection)
@@ -0,0 +1,136 @@
+# startup.py
+import importlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Start-up times are measured from the first import of this module, the first line of main.py
+STARTED = time.perf_counter()
+
+# Defaults of the settings below, overridable from .env. This module is imported
+# before db_config, whose import loads .env, so they are read when used, see _setting().
+# Connections opened while the login form is shown
+STARTUP_CONNECTIONS = 2
+# Books of this many recent loans are loaded into the book cache
+STARTUP_PRELOAD_LOANS = 200
+# File the start-up timing report is written to as JSON, '-' prints it, unset writes none
+STARTUP_REPORT = None
+# Modules the client needs after login, in the order they are first used
+WARM_UP_MODULES = ('db_executor', 'user_management', 'circulation', 'holds', 'catalog_management')
+
+# Milestones, as seconds since STARTED, and warm-up steps, as seconds taken
+_marks = {}
+_steps = {}
+_lock = threading.Lock()
+_warm_up_thread = None
+_reported = False
+
+def mark(milestone):
+    """
+    Records the time since start-up at which a milestone was first reached,
+    e.g. 'interactive' when the login form is first drawn.
+    """
+    with _lock:
+        _marks.setdefault(milestone, time.perf_counter() - STARTED)
+    _report_when_complete()
+
+def _setting(name, default):
+    return os.environ.get(name) or default
+
+@contextmanager
+def step(name):
+    """
+    Context manager recording how long a warm-up step took.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _lock:
+            _steps[name] = time.perf_counter() - started
+
+def warm_up():
+    """
+    Does the work the first login and the windows after it would otherwise
+    wait for: resolves the database configuration, imports the domain
+    modules, opens STARTUP_CONNECTIONS pooled connections, loads the books
+    of recent loans into the book cache, starts building the search
+    indexes and starts following the event log. Errors are printed and
+    leave the rest to be done on first use.
+    """
+    try:
+        with step('configure'):
+            import db_config
+            db_config.configure()
+        for module in WARM_UP_MODULES:
+            with step(f'import {module}'):
+                importlib.import_module(module)
+        with step('open connections'):
+            db_config.get_pool().prefill(int(_setting('STARTUP_CONNECTIONS', STARTUP_CONNECTIONS)))
+            # The first lag check decides whether searches can use the read replicas
+            router = db_config.get_router()
+            if router:
+                router.start_monitor()
+        with step('preload books'):
+            importlib.import_module('catalog_management').preload_books(int(_setting('STARTUP_PRELOAD_LOANS', STARTUP_PRELOAD_LOANS)))
+        with step('start search indexes'):
+            importlib.import_module('typeahead').start_typeahead_build()
+            importlib.import_module('fuzzy_search').start_trigram_build()
+            importlib.import_module('facets').start_facet_build()
+        with step('follow event log'):
+            importlib.import_module('event_log').start_cache_follower()
+            importlib.import_module('event_log').start_index_follower()
+    except Exception as err:
+        print(f"Error: {err}")
+    mark('warmed_up')
+
+def start_warm_up():
+    """
+    Runs warm_up() on a daemon thread, once per process.
+    """
+    global _warm_up_thread
+    with _lock:
+        if _warm_up_thread is not None:
+            return
+        _warm_up_thread = threading.Thread(target=warm_up, name="startup-warm-up", daemon=True)
+    _warm_up_thread.start()
+
+def report():
+    """
+    Returns the start-up timings in milliseconds.
+
+    Returns:
+    dict: Dictionary with the keys milestones (time since start-up at which
+        each was reached) and steps (time each warm-up step took)
+    """
+    with _lock:
+        return {
+            'milestones': {name: round(seconds * 1000, 1) for name, seconds in _marks.items()},
+            'steps': {name: round(seconds * 1000, 1) for name, seconds in _steps.items()},
+        }
+
+def _report_when_complete():
+    # Published once both the form is usable and the warm-up has finished
+    global _reported
+    with _lock:
+        if _reported or 'interactive' not in _marks or 'warmed_up' not in _marks:
+            return
+        _reported = True
+    timings = report()
+    # Imported only now, they are not needed to show the login form
+    import json
+    import metrics
+    for kind, values in (('startup_us', timings['milestones']), ('startup_step_us', timings['steps'])):
+        for name, ms in values.items():
+            metrics.histogram(kind, name).record(ms * 1000)
+    # Read after the warm-up imported db_config, which loads .env
+    report_path = _setting('STARTUP_REPORT', STARTUP_REPORT)
+    if report_path == '-':
+        print(f"Start-up timings (ms): {json.dumps(timings)}")
+    elif report_path:
+        try:
+            with open(report_path, 'w') as report_file:
+                json.dump(timings, report_file, indent=2)
+        except OSError as err:
+            print(f"Error: {err}")
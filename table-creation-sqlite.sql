@@ -0,0 +1,88 @@
+-- SQLite version of table-creation.sql, applied automatically when DB_BACKEND=sqlite
+
+-- Users Table
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username VARCHAR(50) NOT NULL UNIQUE,
+    password VARCHAR(255) NOT NULL,
+    role TEXT NOT NULL CHECK (role IN ('admin', 'librarian', 'borrower')),
+    full_name VARCHAR(100),
+    email VARCHAR(100),
+    phone VARCHAR(20),
+    membership_category TEXT NOT NULL CHECK (membership_category IN ('student', 'staff', 'public')),
+    fines DECIMAL(10,2) DEFAULT 0.00
+);
+
+-- Books Table
+CREATE TABLE IF NOT EXISTS books (
+    book_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title VARCHAR(255) NOT NULL,
+    author VARCHAR(255),
+    isbn VARCHAR(20) UNIQUE,
+    publisher VARCHAR(100),
+    edition VARCHAR(50),
+    genre VARCHAR(50),
+    language VARCHAR(50),
+    publication_year INTEGER,
+    dewey_decimal VARCHAR(20),
+    subject_tags VARCHAR(255),
+    total_copies INT DEFAULT 1,
+    available_copies INT DEFAULT 1
+);
+
+-- Transactions Table
+CREATE TABLE IF NOT EXISTS transactions (
+    transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INT,
+    book_id INT,
+    issue_date DATE,
+    due_date DATE,
+    return_date DATE,
+    FOREIGN KEY (user_id) REFERENCES users(user_id),
+    FOREIGN KEY (book_id) REFERENCES books(book_id)
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_user_loans ON transactions (user_id, return_date, due_date, book_id, issue_date);
+CREATE INDEX IF NOT EXISTS idx_transactions_open_user ON transactions (return_date, user_id, due_date);
+CREATE INDEX IF NOT EXISTS idx_transactions_book_open ON transactions (book_id, return_date);
+
+-- Reservations Table
+CREATE TABLE IF NOT EXISTS reservations (
+    reservation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INT,
+    book_id INT,
+    reservation_date DATE,
+    status TEXT DEFAULT 'active' CHECK (status IN ('active', 'completed', 'cancelled')),
+    priority TINYINT NOT NULL DEFAULT 2,
+    hold_expires DATE,
+    FOREIGN KEY (user_id) REFERENCES users(user_id),
+    FOREIGN KEY (book_id) REFERENCES books(book_id)
+);
+CREATE INDEX IF NOT EXISTS idx_reservations_hold_queue ON reservations (book_id, status, hold_expires, priority, reservation_id);
+CREATE INDEX IF NOT EXISTS idx_reservations_hold_expiry ON reservations (status, hold_expires);
+CREATE INDEX IF NOT EXISTS idx_reservations_user_holds ON reservations (user_id, status, book_id);
+
+-- Search Index: one row per distinct term of a book, weighted by the fields it appears in.
+-- NOCASE lets SQLite serve the prefix LIKE lookups of search_books from the primary key.
+CREATE TABLE IF NOT EXISTS book_search_terms (
+    term VARCHAR(64) NOT NULL COLLATE NOCASE,
+    book_id INT NOT NULL,
+    weight SMALLINT NOT NULL,
+    PRIMARY KEY (term, book_id),
+    FOREIGN KEY (book_id) REFERENCES books(book_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_book_search_terms_book ON book_search_terms (book_id);
+
+-- Fine Ledger: one row per loan per day fines were charged for it
+CREATE TABLE IF NOT EXISTS fine_ledger (
+    ledger_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    transaction_id INT NOT NULL,
+    user_id INT NOT NULL,
+    accrual_date DATE NOT NULL,
+    days INT NOT NULL,
+    amount DECIMAL(10,2) NOT NULL,
+    posted BOOLEAN NOT NULL DEFAULT FALSE,
+    UNIQUE (transaction_id, accrual_date),
+    FOREIGN KEY (transaction_id) REFERENCES transactions(transaction_id),
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_fine_ledger_user ON fine_ledger (user_id);
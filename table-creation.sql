@@ -13,7 +13,7 @@ CREATE TABLE IF NOT EXISTS users (
     email VARCHAR(100),
     phone VARCHAR(20),
     membership_category ENUM('student', 'staff', 'public') NOT NULL,
-    fines DECIMAL(5,2) DEFAULT 0.00
+    fines DECIMAL(10,2) DEFAULT 0.00
 );
 
 -- Books Table
@@ -41,6 +41,9 @@ CREATE TABLE IF NOT EXISTS transactions (
     issue_date DATE,
     due_date DATE,
     return_date DATE,
+    INDEX idx_transactions_user_loans (user_id, return_date, due_date, book_id, issue_date),
+    INDEX idx_transactions_open_user (return_date, user_id, due_date),
+    INDEX idx_transactions_book_open (book_id, return_date),
     FOREIGN KEY (user_id) REFERENCES users(user_id),
     FOREIGN KEY (book_id) REFERENCES books(book_id)
 );
@@ -52,6 +55,39 @@ CREATE TABLE IF NOT EXISTS reservations (
     book_id INT,
     reservation_date DATE,
     status ENUM('active', 'completed', 'cancelled') DEFAULT 'active',
+    -- Hold queue order within a book, lower first: staff 0, student 1, public 2
+    priority TINYINT NOT NULL DEFAULT 2,
+    -- Set while a returned copy is kept for the holder, who must collect it by this date
+    hold_expires DATE,
+    INDEX idx_reservations_hold_queue (book_id, status, hold_expires, priority, reservation_id),
+    INDEX idx_reservations_hold_expiry (status, hold_expires),
+    -- A user's holds, also used by the user_id foreign key
+    INDEX idx_reservations_user_holds (user_id, status, book_id),
     FOREIGN KEY (user_id) REFERENCES users(user_id),
     FOREIGN KEY (book_id) REFERENCES books(book_id)
 );
+
+-- Search Index: one row per distinct term of a book, weighted by the fields it appears in
+CREATE TABLE IF NOT EXISTS book_search_terms (
+    term VARCHAR(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+    book_id INT NOT NULL,
+    weight SMALLINT NOT NULL,
+    PRIMARY KEY (term, book_id),
+    INDEX idx_book_search_terms_book (book_id),
+    FOREIGN KEY (book_id) REFERENCES books(book_id) ON DELETE CASCADE
+);
+
+-- Fine Ledger: one row per loan per day fines were charged for it
+CREATE TABLE IF NOT EXISTS fine_ledger (
+    ledger_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    transaction_id INT NOT NULL,
+    user_id INT NOT NULL,
+    accrual_date DATE NOT NULL,
+    days INT NOT NULL,
+    amount DECIMAL(10,2) NOT NULL,
+    posted BOOLEAN NOT NULL DEFAULT FALSE,
+    UNIQUE KEY uq_fine_ledger_transaction_date (transaction_id, accrual_date),
+    INDEX idx_fine_ledger_user (user_id),
+    FOREIGN KEY (transaction_id) REFERENCES transactions(transaction_id),
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
@@ -0,0 +1,52 @@
+# tests/conftest.py
+import itertools
+import os
+import tempfile
+
+import pytest
+
+# Settings are read from the environment, so the tests point the database and
+# every file the modules write at a scratch directory before importing them.
+# Assigned rather than defaulted so a developer's .env never reaches a real server.
+_DIRECTORY = tempfile.mkdtemp(prefix='library-tests-')
+os.environ.update({
+    'DB_BACKEND': 'sqlite',
+    'DB_PATH': os.path.join(_DIRECTORY, 'library.db'),
+    'DB_REPLICAS': '',
+    'EVENT_LOG_DIR': os.path.join(_DIRECTORY, 'events'),
+    'METRICS_SLOW_QUERY_LOG': os.path.join(_DIRECTORY, 'slow_queries.log'),
+    'REPORTS_DIR': os.path.join(_DIRECTORY, 'reports'),
+    'NOTICE_SPOOL_DIR': os.path.join(_DIRECTORY, 'notices'),
+})
+
+_ids = itertools.count(1)
+
+@pytest.fixture
+def scratch_dir():
+    return _DIRECTORY
+
+@pytest.fixture
+def make_user():
+    """Registers a borrower with a unique username and returns its user ID."""
+    from user_management import register_member, get_user_id
+
+    def make(membership_category='public', role='borrower', username=None):
+        username = username or f'user{next(_ids)}'
+        assert register_member(username, 'secret', role, f'User {username}', f'{username}@example.org',
+                               '555-0100', membership_category)
+        return get_user_id(username)
+    return make
+
+@pytest.fixture
+def make_book():
+    """Adds a book with a unique title and returns its book ID."""
+    from catalog_management import add_book
+
+    def make(total_copies=1, title=None, author='Test Author', isbn=None, genre='Fiction', language='English',
+             publication_year=2000, dewey_decimal='813', subject_tags='testing'):
+        title = title or f'Book {next(_ids)}'
+        book_id = add_book(title, author, isbn, 'Test Press', '1st', genre, language, publication_year,
+                           dewey_decimal, subject_tags, total_copies)
+        assert book_id
+        return book_id
+    return make
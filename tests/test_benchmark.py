@@ -0,0 +1,37 @@
+# tests/test_benchmark.py
+import json
+import os
+import subprocess
+import sys
+
+import benchmark
+
+def test_percentile_uses_the_nearest_rank():
+    values = list(range(1, 101))
+    assert benchmark.percentile(values, 50) == 50 and benchmark.percentile(values, 95) == 95
+    assert benchmark.percentile(values, 100) == 100 and benchmark.percentile([], 95) == 0.0
+
+def test_workload_is_deterministic_and_skewed():
+    first, second = benchmark.Workload(100, 50, seed=7), benchmark.Workload(100, 50, seed=7)
+    draws = [first.book_id() for _ in range(500)]
+    assert draws == [second.book_id() for _ in range(500)]
+    assert draws.count(1) > draws.count(100)
+
+def test_compare_reports_regressions_beyond_the_tolerance():
+    def report(p95_ms, ops_per_sec):
+        return {'workloads': {'checkout_rush': {'operations': {'issue_book': {'p95_ms': p95_ms, 'ops_per_sec': ops_per_sec}}}}}
+    assert benchmark.compare(report(11, 95), report(10, 100), 0.2) == []
+    assert len(benchmark.compare(report(13, 70), report(10, 100), 0.2)) == 2
+
+def test_small_run_reports_every_workload_and_stays_consistent(tmp_path):
+    output = tmp_path / 'report.json'
+    # Run in its own process, which sets up its own database before importing the library modules
+    completed = subprocess.run([sys.executable, benchmark.__file__, '--books', '200', '--users', '100', '--reservations', '20',
+                                '--operations', '60', '--workers', '4', '--database', str(tmp_path / 'bench.db'),
+                                '--output', str(output)], capture_output=True, text=True, timeout=300,
+                               cwd=os.path.dirname(benchmark.__file__))
+    assert completed.returncode == 0, completed.stdout + completed.stderr
+    report = json.loads(output.read_text())
+    assert set(report['workloads']) == set(benchmark.WORKLOADS)
+    assert report['checks'] == {'negative_available': 0, 'mismatched_available': 0}
+    assert report['workloads']['checkout_rush']['operations']['issue_book']['count'] == 60
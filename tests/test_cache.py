@@ -0,0 +1,58 @@
+# tests/test_cache.py
+import cache
+import circulation
+from cache import LRUCache, book_cache
+from catalog_management import get_book_by_id
+
+def test_least_recently_used_entry_is_evicted():
+    lru = LRUCache("test", 2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    assert lru.get('a') == 1
+    lru.put('c', 3)
+    assert (lru.get('a'), lru.get('b'), lru.get('c')) == (1, None, 3)
+    stats = lru.stats()
+    assert (stats['size'], stats['hits'], stats['misses'], stats['evictions']) == (2, 3, 1, 1)
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    lru = LRUCache("test", 10, ttl=5)
+    lru.put('a', 1)
+    now[0] += 4
+    assert lru.get('a') == 1
+    now[0] += 2
+    assert lru.get('a') is None and lru.stats()['expirations'] == 1
+
+def test_get_or_load_does_not_cache_none():
+    lru = LRUCache("test", 10)
+    loads = []
+
+    def loader(value):
+        loads.append(value)
+        return value
+
+    assert lru.get_or_load('missing', lambda: loader(None)) is None
+    assert lru.get_or_load('missing', lambda: loader('found')) == 'found'
+    assert lru.get_or_load('missing', lambda: loader('stale')) == 'found'
+    assert loads == [None, 'found']
+
+def test_invalidation_notifies_listeners():
+    lru = LRUCache("test", 10)
+    invalidated = []
+    lru.add_listener(invalidated.append)
+    lru.put('a', 1)
+    lru.invalidate('a')
+    lru.invalidate('never cached')
+    lru.put('b', 2)
+    lru.clear()
+    assert invalidated == ['a', 'never cached', None]
+    assert lru.get('b') is None and lru.stats()['invalidations'] == 2
+
+def test_books_are_cached_until_a_loan_changes_them(make_user, make_book):
+    book_id = make_book(total_copies=2)
+    first = get_book_by_id(book_id)
+    assert get_book_by_id(book_id) is first
+    circulation.issue_book(make_user(), book_id)
+    assert book_cache.get(book_id) is None
+    assert get_book_by_id(book_id)['available_copies'] == 1
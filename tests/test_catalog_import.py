@@ -0,0 +1,102 @@
+# tests/test_catalog_import.py
+import os
+
+import pytest
+
+from catalog_import import normalize_record, import_books, read_csv_records, read_marc_records, InvalidRecord, BOOK_COLUMNS
+from catalog_management import normalize_isbn, isbn_is_valid, isbn_to_13, search_books, add_book
+from db_config import get_connection
+
+def _copies(isbn):
+    with get_connection(readonly=True) as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*), SUM(total_copies), SUM(available_copies) FROM books WHERE isbn = %s", (isbn,))
+        row = cursor.fetchone()
+        cursor.close()
+    return tuple(row)
+
+def test_isbn_normalization_and_check_digits():
+    assert normalize_isbn(' 0-306-40615-2 ') == '0306406152'
+    assert normalize_isbn('080442957x') == '080442957X'
+    assert normalize_isbn('978 0 306 40615 7') == '9780306406157'
+    assert normalize_isbn('12345') is None and normalize_isbn('97803064061X7') is None
+    assert isbn_is_valid('0306406152') and isbn_is_valid('080442957X') and isbn_is_valid('9780306406157')
+    assert not isbn_is_valid('0306406153') and not isbn_is_valid('9780306406158')
+    assert isbn_to_13('0306406152') == '9780306406157'
+    assert isbn_to_13('9780306406157') == '9780306406157'
+
+def test_normalize_record_validates_and_trims():
+    values = normalize_record({'title': '  A Title ', 'isbn': '0-306-40615-2', 'publication_year': '1850',
+                               'total_copies': '3', 'publisher': 'P' * 300})
+    row = dict(zip(BOOK_COLUMNS, values))
+    assert row['title'] == 'A Title' and row['isbn'] == '9780306406157'
+    assert row['publication_year'] is None and len(row['publisher']) == 100
+    assert row['total_copies'] == 3 and values[-1] == 3
+    assert dict(zip(BOOK_COLUMNS, normalize_record({'title': 'T'})))['total_copies'] == 1
+    for record in ({'title': ''}, {'title': 'T', 'isbn': '0306406153'}, {'title': 'T', 'total_copies': 'two'},
+                   {'title': 'T', 'total_copies': '0'}, {'title': 'T', 'publication_year': 'old'}):
+        with pytest.raises(InvalidRecord):
+            normalize_record(record)
+
+def test_import_merges_copies_on_isbn_across_batches():
+    isbn_10 = next(candidate for candidate in ('555000001' + check for check in '0123456789X') if isbn_is_valid(candidate))
+    isbn = isbn_to_13(isbn_10)
+    records = [
+        {'title': 'Importable Quokka', 'author': 'A. Writer', 'isbn': isbn, 'total_copies': '2'},
+        {'title': 'Importable Quokka', 'isbn': isbn_10, 'total_copies': '1'},
+        {'title': 'No Isbn Quokka', 'total_copies': '1'},
+        {'title': 'No Isbn Quokka', 'total_copies': '1'},
+        {'title': '', 'isbn': isbn},
+        {'title': 'Importable Quokka', 'isbn': '-'.join([isbn[:3], isbn[3:]]), 'total_copies': '4'},
+    ]
+    progress = []
+    stats = import_books(records, batch_size=2, progress=lambda stats: progress.append(dict(stats)))
+    assert (stats['read'], stats['inserted'], stats['merged'], stats['rejected']) == (6, 3, 2, 1)
+    assert [update['read'] for update in progress] == [2, 4, 6]
+    assert _copies(isbn) == (1, 7, 7)
+    # New books are searchable, rows without an ISBN are never merged
+    assert len(search_books('quokka')) == 3
+
+    stats = import_books([{'title': 'Importable Quokka', 'isbn': isbn}])
+    assert (stats['inserted'], stats['merged']) == (0, 1)
+    assert _copies(isbn) == (1, 8, 8)
+
+def test_books_added_by_hand_merge_with_imports(make_book):
+    isbn_10 = next(candidate for candidate in ('555000002' + check for check in '0123456789X') if isbn_is_valid(candidate))
+    isbn = isbn_to_13(isbn_10)
+    book_id = make_book(title='Handmade Numbat', isbn='-'.join([isbn_10[:1], isbn_10[1:4], isbn_10[4:9], isbn_10[9:]]))
+    assert _copies(isbn) == (1, 1, 1)
+    stats = import_books([{'title': 'Handmade Numbat', 'isbn': isbn, 'total_copies': '2'}])
+    assert (stats['inserted'], stats['merged']) == (0, 1)
+    assert _copies(isbn) == (1, 3, 3)
+    assert [book['book_id'] for book in search_books(isbn)] == [book_id]
+    assert add_book('Handmade Numbat', 'A. Writer', isbn[:-1] + str((int(isbn[-1]) + 1) % 10), 'Press', '1', 'Fiction',
+                    'English', 2000, '813', 'testing', 1) is None
+
+def test_read_csv_records_matches_headers(scratch_dir):
+    path = os.path.join(scratch_dir, 'import.csv')
+    with open(path, 'w', encoding='utf-8') as csv_file:
+        csv_file.write('Title,Author,Publication Year,Shelf\nCsv Wombat,Someone,2001,B4\n')
+    assert list(read_csv_records(path)) == [{'title': 'Csv Wombat', 'author': 'Someone', 'publication_year': '2001'}]
+
+def _marc_record(fields):
+    # An ISO 2709 record with UTF-8 data from (tag, field data) pairs
+    directory, data = b"", b""
+    for tag, value in fields:
+        encoded = value.encode() + b"\x1e"
+        directory += tag.encode() + b"%04d%05d" % (len(encoded), len(data))
+        data += encoded
+    base_address = 24 + len(directory) + 1
+    leader = b"%05dnam a22%05d   4500" % (base_address + len(data) + 1, base_address)
+    return leader + directory + b"\x1e" + data + b"\x1d"
+
+def test_corrupt_marc_stream_is_rejected_after_the_records_before_it(scratch_dir):
+    path = os.path.join(scratch_dir, 'import.mrc')
+    with open(path, 'wb') as marc_file:
+        for title in ('Marcfile Heron', 'Marcfile Egret'):
+            marc_file.write(_marc_record([('008', ' ' * 35 + 'eng'), ('245', f"10\x1fa{title} /"), ('100', "1 \x1faBird, Ann.")]))
+        marc_file.write(b"xx9z!" + b"garbage")
+    stats = import_books(read_marc_records(path), batch_size=10)
+    assert (stats['read'], stats['inserted'], stats['rejected']) == (3, 2, 1)
+    assert sorted(book['title'] for book in search_books('marcfile')) == ['Marcfile Egret', 'Marcfile Heron']
+    assert {book['language'] for book in search_books('marcfile')} == {'English'}
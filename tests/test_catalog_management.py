@@ -0,0 +1,73 @@
+# tests/test_catalog_management.py
+from decimal import Decimal
+
+import pytest
+
+import catalog_management
+from catalog_management import tokenize, index_terms, search_books, search_books_page, iter_search_books
+from http_api import encode_cursor, decode_cursor, HTTPError
+
+def test_tokenize_folds_case_and_accents():
+    assert tokenize("Gödel, Escher & BACH_2nd") == ['godel', 'escher', 'bach', '2nd']
+    assert tokenize(None) == [] and tokenize(1984) == ['1984']
+
+def test_index_terms_sum_field_weights():
+    terms = index_terms({'title': 'Ocean Ocean Tales', 'author': 'Ann Ocean', 'genre': 'Sea', 'publication_year': 1999})
+    weights = catalog_management.SEARCH_FIELD_WEIGHTS
+    assert terms['ocean'] == weights['title'] + weights['author']
+    assert terms['tales'] == weights['title']
+    assert terms['1999'] == weights['publication_year']
+
+def test_search_ranks_by_weight_and_matches_prefixes(make_book):
+    in_title = make_book(title='Marmalade Skies', author='Ann Other', subject_tags='weather')
+    in_author = make_book(title='Weather Notes', author='Ada Marmalade', subject_tags='weather')
+    in_tags = make_book(title='Kitchen Notes', author='Ann Other', subject_tags='marmalade')
+    assert [book['book_id'] for book in search_books('marmalade')] == [in_title, in_author, in_tags]
+    assert [book['book_id'] for book in search_books('marma')] == [in_title, in_author, in_tags]
+    assert [book['book_id'] for book in search_books('marmalade weather')][:2] == [in_author, in_title]
+    assert search_books('ma') == [] and search_books('  ') == []
+    assert len(search_books('marmalade', limit=2)) == 2
+
+def test_prefix_matching_several_terms_of_a_book_counts_once(make_book):
+    both = make_book(title='Spelling Variants', subject_tags='dostoevsky dostoyevsky')
+    one = make_book(title='Single Spelling', subject_tags='dostoevsky')
+    scores = {book['book_id']: book['score'] for book in search_books('dostoy dostoe')}
+    assert scores[both] == 2 * scores[one]
+    scores = {book['book_id']: book['score'] for book in search_books('dost')}
+    assert scores[both] == scores[one] == catalog_management.SEARCH_FIELD_WEIGHTS['subject_tags']
+
+def test_isbn_lookup_accepts_hyphens_and_isbn_10(make_book):
+    book_id = make_book(title='An Isbn Lookup', isbn='9780306406157')
+    for keyword in ('978-0-306-40615-7', '9780306406157', '0306406152', '0-306-40615-2'):
+        assert [book['book_id'] for book in search_books(keyword)] == [book_id]
+
+def test_keyset_pages_cover_every_match_once(make_book):
+    # Ties in score are broken by book_id, so equal scores must not repeat or skip books across pages
+    ids = [make_book(title='Pagination Nebula' if n % 3 else 'Pagination Nebula Nebula', author='Writer', subject_tags=f'tag{n}')
+           for n in range(8)]
+    ids += [make_book(title='Other Book', author='Writer', subject_tags='nebula') for _ in range(3)]
+    expected = [book['book_id'] for book in search_books('nebula')]
+    assert sorted(expected) == sorted(ids)
+
+    seen, after, pages = [], None, 0
+    while True:
+        page = search_books_page('nebula', page_size=3, after=after)
+        if after is None:
+            assert page['total_estimate'] == len(ids) and page['total_is_exact']
+        else:
+            assert page['total_estimate'] is None
+        seen += [book['book_id'] for book in page['results']]
+        pages += 1
+        after = page['next_cursor']
+        if after is None:
+            break
+    assert seen == expected
+    assert pages == 4
+    assert [book['book_id'] for book in iter_search_books('nebula', fetch_size=2)] == expected
+
+def test_cursor_round_trip_and_malformed_cursors():
+    assert decode_cursor(encode_cursor((Decimal('12'), 40))) == (Decimal('12'), 40)
+    assert encode_cursor(None) is None and decode_cursor('') is None
+    for bad in ('12', 'x:1', '1:y', '1:2:3'):
+        with pytest.raises(HTTPError):
+            decode_cursor(bad)
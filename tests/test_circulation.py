@@ -0,0 +1,113 @@
+# tests/test_circulation.py
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import circulation
+from db_config import get_connection
+
+def _book_counts(book_id):
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""SELECT b.total_copies, b.available_copies,
+                                 (SELECT COUNT(*) FROM transactions t WHERE t.book_id = b.book_id AND t.return_date IS NULL)
+                          FROM books b WHERE b.book_id = %s""", (book_id,))
+        counts = cursor.fetchone()
+        cursor.close()
+    return counts
+
+def test_concurrent_checkouts_never_overissue(make_user, make_book):
+    copies = 3
+    book_id = make_book(total_copies=copies)
+    users = [make_user() for _ in range(12)]
+    for _ in range(5):
+        with ThreadPoolExecutor(max_workers=len(users)) as executor:
+            results = list(executor.map(lambda user_id: circulation.issue_book(user_id, book_id), users))
+
+        issued = [result for result in results if result['status'] == circulation.ISSUED]
+        assert len(issued) == copies
+        assert {result['status'] for result in results} <= {circulation.ISSUED, circulation.NOT_AVAILABLE}
+        total, available, open_loans = _book_counts(book_id)
+        assert available >= 0
+        assert open_loans <= total
+        assert available + open_loans == total
+
+        # A loan returned twice at once is only counted back once
+        transaction_id = issued[0]['transaction_id']
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            returns = list(executor.map(circulation.return_book, [transaction_id] * 4))
+        assert [result['status'] for result in returns].count(circulation.RETURNED) == 1
+        for result in issued[1:]:
+            assert circulation.return_book(result['transaction_id'])['status'] == circulation.RETURNED
+        assert _book_counts(book_id) == (copies, copies, 0)
+
+def test_issue_refused_while_fines_are_owed(make_user, make_book):
+    from user_management import update_user_fine
+
+    user_id = make_user()
+    update_user_fine(user_id, 5)
+    assert circulation.issue_book(user_id, make_book())['status'] == circulation.OUTSTANDING_FINES
+
+def test_loan_dashboard_flags_and_orders_loans(make_user, make_book):
+    from fines import FINE_RATES
+
+    user_id = make_user(membership_category='student')
+    today = date.today()
+    due_dates = {}
+    for days in (10, -3, 2):
+        loan = circulation.issue_book(user_id, make_book())
+        due_dates[loan['transaction_id']] = today + timedelta(days=days)
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.executemany("UPDATE transactions SET due_date = %s WHERE transaction_id = %s",
+                           [(due, transaction_id) for transaction_id, due in due_dates.items()])
+        connection.commit()
+        cursor.close()
+
+    dashboard = circulation.get_loan_dashboard(user_id)
+    loans = dashboard['loans']
+    assert [loan['due_date'] for loan in loans] == sorted(due_dates.values())
+    overdue, due_soon, later = loans
+    assert (overdue['overdue'], overdue['days_overdue'], overdue['accrued_fine']) == (True, 3, 3 * FINE_RATES['student'])
+    assert (due_soon['overdue'], due_soon['due_soon']) == (False, True)
+    assert (later['due_soon'], later['accrued_fine']) == (False, 0)
+    assert overdue['title'].startswith('Book ')
+    assert dashboard['outstanding_fines'] == 0
+
+    assert circulation.get_loan_dashboard(make_user()) == {'outstanding_fines': 0, 'loans': []}
+
+def test_batch_issue_decides_each_scan_against_the_locked_counts(make_user, make_book):
+    one, two = make_book(total_copies=1), make_book(total_copies=2)
+    user_id = make_user()
+    missing = 10 ** 9
+    result = circulation.issue_books(user_id, [one, one, two, missing, two])
+    assert [(item['book_id'], item['status']) for item in result['items']] == [
+        (one, circulation.ISSUED), (one, circulation.NOT_AVAILABLE), (two, circulation.ISSUED),
+        (missing, circulation.NOT_FOUND), (two, circulation.ISSUED)]
+    assert (result['status'], result['issued']) == (circulation.ISSUED, 3)
+    assert _book_counts(one) == (1, 0, 1) and _book_counts(two) == (2, 0, 2)
+    assert circulation.issue_books(user_id, [])['issued'] == 0
+
+def test_batch_return_charges_fines_and_feeds_holds(make_user, make_book):
+    from datetime import date, timedelta
+    from fines import FINE_RATES
+    from holds import get_user_holds
+
+    held, other = make_book(), make_book()
+    borrower, waiting = make_user('public'), make_user()
+    loans = [item['transaction_id'] for item in circulation.issue_books(borrower, [held, other])['items']]
+    circulation.place_hold(waiting, held)
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("UPDATE transactions SET due_date = %s WHERE transaction_id = %s",
+                       (date.today() - timedelta(days=2), loans[1]))
+        connection.commit()
+        cursor.close()
+
+    # The first loan is scanned twice, the second scan finds it already returned
+    result = circulation.return_books([loans[0], loans[1], loans[0]])
+    assert [item['status'] for item in result['items']] == [circulation.RETURNED, circulation.RETURNED, circulation.NOT_FOUND]
+    assert result['returned'] == 2
+    assert result['fines_by_user'] == {borrower: 2 * FINE_RATES['public']}
+    assert result['total_fine'] == 2 * FINE_RATES['public']
+    assert result['items'][0]['hold']['user_id'] == waiting and get_user_holds(waiting)[0]['ready']
+    assert _book_counts(held) == (1, 0, 0) and _book_counts(other) == (1, 1, 0)
@@ -0,0 +1,90 @@
+# tests/test_db_config.py
+import threading
+
+import pytest
+
+import db_config
+from db_config import ConnectionPool, PoolTimeoutError
+
+class FakeConnection:
+    def __init__(self, healthy=True):
+        self.healthy = healthy
+        self.in_transaction = False
+        self.rolled_back = False
+        self.closed = False
+
+    def rollback(self):
+        self.rolled_back = True
+        self.in_transaction = False
+
+    def ping(self, reconnect=False):
+        if not self.healthy:
+            raise db_config.Error("gone away")
+
+    def close(self):
+        self.closed = True
+
+def _pool(**settings):
+    opened = []
+
+    def factory():
+        opened.append(FakeConnection())
+        return opened[-1]
+    return ConnectionPool(factory, **settings), opened
+
+def test_connections_are_reused_and_bounded():
+    pool, opened = _pool(size=2, timeout=0.05)
+    first = pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+    second = pool.acquire()
+    with pytest.raises(PoolTimeoutError):
+        pool.acquire()
+    assert len(opened) == 2
+
+    released = []
+    waiter = threading.Thread(target=lambda: released.append(pool.acquire(timeout=5)))
+    waiter.start()
+    pool.release(second)
+    waiter.join()
+    assert released == [second]
+
+def test_unfinished_transactions_are_rolled_back_on_release():
+    pool, _ = _pool(size=1)
+    connection = pool.acquire()
+    connection.in_transaction = True
+    pool.release(connection)
+    assert connection.rolled_back
+
+def test_stale_and_old_connections_are_replaced():
+    pool, opened = _pool(size=1, ping_interval=0.000001, recycle=3600)
+    connection = pool.acquire()
+    connection.healthy = False
+    pool.release(connection)
+    replacement = pool.acquire()
+    assert replacement is not connection and connection.closed
+    pool.release(replacement)
+
+    pool.recycle = 0.000001
+    assert pool.acquire() is not replacement and replacement.closed
+    assert len(opened) == 3
+
+def test_a_failed_connect_frees_its_slot():
+    pool = ConnectionPool(lambda: None, size=1, timeout=0.05)
+    assert pool.acquire() is None
+    assert pool.acquire() is None
+
+def test_prefill_and_close():
+    pool, opened = _pool(size=3)
+    assert pool.prefill(2) == 2
+    assert pool.prefill(2) == 0
+    checked_out = pool.acquire()
+    pool.close()
+    assert [connection.closed for connection in opened] == [connection is not checked_out for connection in opened]
+    pool.release(checked_out)
+    assert checked_out.closed and pool._open == 0
+
+def test_get_connection_yields_none_when_the_database_is_unreachable(monkeypatch):
+    monkeypatch.setattr(db_config, '_pool', ConnectionPool(lambda: None, size=1))
+    with db_config.get_connection() as connection:
+        assert connection is None
@@ -0,0 +1,83 @@
+# tests/test_db_executor.py
+import threading
+import time
+import tkinter as tk
+
+from db_executor import run_in_background, LatestTask
+
+class FakeWidget:
+    """Stands in for a Tk widget: after() callbacks run when the test drives the loop."""
+
+    def __init__(self):
+        self.scheduled = []
+        self.destroyed = False
+
+    def after(self, delay, callback):
+        if self.destroyed:
+            raise tk.TclError("application has been destroyed")
+        self.scheduled.append(callback)
+
+    def run_until_idle(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        while self.scheduled and time.monotonic() < deadline:
+            callbacks, self.scheduled = self.scheduled, []
+            for callback in callbacks:
+                callback()
+            time.sleep(0.001)
+        assert not self.scheduled
+
+def test_results_and_errors_are_delivered_on_the_calling_thread():
+    widget = FakeWidget()
+    delivered = []
+    release = threading.Event()
+
+    def slow_add(a, b):
+        release.wait(5)
+        return a + b
+
+    def fail():
+        raise ValueError("no database")
+
+    run_in_background(widget, slow_add, 2, b=3, on_success=lambda result: delivered.append((result, threading.current_thread())))
+    run_in_background(widget, fail, on_error=lambda err: delivered.append((str(err), threading.current_thread())))
+    # The caller is not blocked while the slow call runs
+    assert 5 not in [result for result, _ in delivered]
+    release.set()
+    widget.run_until_idle()
+    assert {result for result, _ in delivered} == {5, "no database"}
+    assert all(thread is threading.current_thread() for _, thread in delivered)
+
+def test_latest_task_drops_superseded_results():
+    widget = FakeWidget()
+    shown = []
+    latest = LatestTask()
+    first_started, release = threading.Event(), threading.Event()
+
+    def search(text):
+        if text == 'fir':
+            first_started.set()
+            release.wait(5)
+        return text
+
+    latest.run(widget, search, 'fir', on_success=shown.append)
+    first_started.wait(5)
+    latest.run(widget, search, 'first', on_success=shown.append)
+    release.set()
+    widget.run_until_idle()
+    assert shown == ['first']
+
+    latest.run(widget, search, 'cancelled', on_success=shown.append)
+    latest.cancel()
+    widget.run_until_idle()
+    assert shown == ['first'] and latest.task is None
+
+def test_closed_window_stops_polling():
+    widget = FakeWidget()
+    release = threading.Event()
+    delivered = []
+    task = run_in_background(widget, release.wait, 5, on_success=delivered.append)
+    widget.destroyed = True
+    widget.run_until_idle()
+    release.set()
+    task.future.result(5)
+    assert task.cancelled and delivered == [] and widget.scheduled == []
@@ -0,0 +1,123 @@
+# tests/test_event_log.py
+import os
+import threading
+import zlib
+from decimal import Decimal
+
+import event_log
+from event_log import EventLog, CirculationState, RECORD_SIZE, _BODY, _CRC, _decode
+
+def _events(count, start=0):
+    return [{'type': event_log.LOAN_ISSUED, 'user_id': 7, 'book_id': start + n + 1, 'ref_id': 100 + n, 'copies': -1}
+            for n in range(count)]
+
+def test_records_round_trip_and_a_bad_crc_is_rejected():
+    body = _BODY.pack(5, 1700000000.0, 7, -2, 11, 22, 33, 1250)
+    record = bytearray(body + _CRC.pack(zlib.crc32(body)))
+    assert len(record) == RECORD_SIZE
+    event = _decode(record, 0)
+    assert (event['seq'], event['type'], event['copies'], event['user_id'], event['book_id'], event['ref_id']) == \
+        (5, event_log.FINE_PAID, -2, 11, 22, 33)
+    assert event['amount'] == Decimal('12.50')
+    record[20] ^= 0xFF
+    assert _decode(record, 0) is None
+
+def test_append_numbers_events_across_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(event_log, 'SEGMENT_RECORDS', 4)
+    log = EventLog(str(tmp_path))
+    assert log.last_seq() == 0
+    assert log.append(_events(3)) == 3
+    assert log.append(_events(6, 3)) == 9
+    assert log.segments() == [1, 5, 9]
+    assert [event['seq'] for event in log.read()] == list(range(1, 10))
+    assert [event['book_id'] for event in log.read(after_seq=6, limit=2)] == [7, 8]
+
+def test_unlocked_readers_ignore_a_torn_record_and_the_writer_cuts_it(tmp_path):
+    log = EventLog(str(tmp_path))
+    log.append(_events(2))
+    path = os.path.join(str(tmp_path), event_log._segment_name(1))
+    with open(path, 'ab') as segment:
+        segment.write(b'\x01' * (RECORD_SIZE // 2))
+    size = os.path.getsize(path)
+    assert log.last_seq() == 2
+    assert len(log.read()) == 2
+    assert os.path.getsize(path) == size
+    assert log.append(_events(1, 2)) == 3
+    assert os.path.getsize(path) == 3 * RECORD_SIZE
+    assert [event['seq'] for event in log.read()] == [1, 2, 3]
+
+def test_concurrent_appends_get_distinct_sequence_numbers(tmp_path):
+    log = EventLog(str(tmp_path))
+    threads = [threading.Thread(target=lambda: [log.append(_events(1)) for _ in range(50)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [event['seq'] for event in log.read()] == list(range(1, 201))
+
+def test_state_snapshot_round_trip(tmp_path):
+    state = CirculationState(9, {1: 3, 2: 0}, {5: 1250})
+    state.apply({'seq': 10, 'type': event_log.LOAN_ISSUED, 'user_id': 5, 'book_id': 1, 'copies': -1, 'amount': 0})
+    state.apply({'seq': 11, 'type': event_log.FINE_PAID, 'user_id': 5, 'book_id': None, 'copies': 0, 'amount': Decimal('2.50')})
+    path = str(tmp_path / 'snapshot.bin')
+    state.save(path)
+    loaded = CirculationState.load(path)
+    assert (loaded.seq, loaded.copies, loaded.fines) == (11, {1: 2, 2: 0}, {5: 1000})
+
+def test_replayed_state_matches_the_database(make_user, make_book):
+    from circulation import issue_book, return_book
+
+    assert event_log.take_snapshot() is not None
+    user_id = make_user()
+    book_id = make_book(total_copies=2)
+    loan = issue_book(user_id, book_id)
+    issue_book(make_user(), book_id)
+    return_book(loan['transaction_id'])
+    differences = event_log.check()
+    assert (differences['books'], differences['users']) == (0, 0)
+    assert event_log.replay().copies[book_id] == 1
+
+def _wait_for(condition, timeout=10):
+    stop = threading.Event()
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return True
+        stop.wait(0.05)
+    return False
+
+def test_index_follower_picks_up_other_processes_changes():
+    from db_config import get_connection
+    from facets import facet_index, build_facet_index, bitmap, AVAILABLE, UNAVAILABLE
+    from typeahead import typeahead_index
+
+    build_facet_index()
+    stop = threading.Event()
+    follower = threading.Thread(target=event_log._follow_indexes, args=(stop, event_log.event_log.last_seq()), daemon=True)
+    follower.start()
+    try:
+        # Another process adds a book and lends its only copy
+        with get_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("""INSERT INTO books (title, author, genre, language, publication_year, dewey_decimal, subject_tags,
+                                                 total_copies, available_copies)
+                              VALUES ('Zephyrine Chronicles', 'Ola Elsewhere', 'Fantasy', 'English', 2020, '823', 'winds', 1, 1)""")
+            book_id = cursor.lastrowid
+            connection.commit()
+        event_log.record(event_log.COPIES_ADDED, book_id=book_id, copies=1)
+        assert _wait_for(lambda: facet_index.has_book(book_id))
+        assert book_id in [found for found, _ in typeahead_index.suggest('zephyr')]
+        assert facet_index.narrow(bitmap([book_id]), {'availability': AVAILABLE}) == bitmap([book_id])
+
+        with get_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("UPDATE books SET available_copies = 0 WHERE book_id = %s", (book_id,))
+            connection.commit()
+        event_log.record(event_log.LOAN_ISSUED, 1, book_id, 1, copies=-1)
+
+        def checked_out():
+            facet_index.refresh()
+            return facet_index.narrow(bitmap([book_id]), {'availability': UNAVAILABLE}) == bitmap([book_id])
+        assert _wait_for(checked_out)
+    finally:
+        stop.set()
+        follower.join()
@@ -0,0 +1,93 @@
+# tests/test_facets.py
+import pytest
+
+from facets import (FacetIndex, bitmap, dewey_class, normalize_filters, AVAILABLE, UNAVAILABLE)
+
+BOOKS = [
+    {'book_id': 1, 'genre': 'Fiction', 'language': 'English', 'publication_year': 1965, 'dewey_decimal': '813.54', 'available_copies': 2},
+    {'book_id': 2, 'genre': 'Fiction', 'language': 'French', 'publication_year': 1965, 'dewey_decimal': '843', 'available_copies': 0},
+    {'book_id': 3, 'genre': 'History', 'language': 'English', 'publication_year': 2001, 'dewey_decimal': '940.1', 'available_copies': 1},
+    {'book_id': 70, 'genre': 'History', 'language': 'English', 'publication_year': None, 'dewey_decimal': '', 'available_copies': 0},
+]
+
+def test_bitmap_sets_one_bit_per_book():
+    assert bitmap([]) == 0
+    assert bitmap([0, 3, 9]) == 0b1000001001
+    assert bitmap([70]) == 1 << 70
+
+def test_dewey_class_and_filter_normalization():
+    assert dewey_class('823.914') == '800'
+    assert dewey_class(' 5') == '500'
+    assert dewey_class('') is None and dewey_class(None) is None and dewey_class('R823') is None
+    assert normalize_filters({'publication_year': '1965', 'dewey_class': '843'}) == {'publication_year': 1965, 'dewey_class': '800'}
+    for bad in ({'colour': 'red'}, {'publication_year': 'soon'}, {'dewey_class': 'x'}, {'availability': 'maybe'}):
+        with pytest.raises(ValueError):
+            normalize_filters(bad)
+
+def test_counts_and_narrowing():
+    index = FacetIndex()
+    index.load(BOOKS)
+    results = bitmap([1, 2, 3, 70])
+    counts = index.counts(results)
+    assert counts['genre'] == [('Fiction', 2), ('History', 2)]
+    assert counts['language'] == [('English', 3), ('French', 1)]
+    assert counts['dewey_class'] == [('800', 2), ('900', 1)]
+    assert counts['availability'] == [(AVAILABLE, 2), (UNAVAILABLE, 2)]
+    narrowed = index.narrow(results, {'language': 'English', 'availability': AVAILABLE})
+    assert narrowed == bitmap([1, 3])
+    assert index.stats()['books'] == 4
+
+def test_books_added_during_a_build_survive_the_swap():
+    index = FacetIndex()
+
+    def books():
+        yield BOOKS[0]
+        index.add(BOOKS[2])
+        yield BOOKS[1]
+
+    index.load(books())
+    assert index.narrow(bitmap([1, 2, 3]), {'genre': 'History'}) == bitmap([3])
+    assert index.stats()['books'] == 3
+
+def test_set_available_moves_a_book_between_values():
+    index = FacetIndex()
+    index.load(BOOKS)
+    index.set_available(2, True)
+    index.set_available(1, False)
+    index.set_available(99, True)
+    assert index.narrow(bitmap([1, 2, 3, 99]), {'availability': AVAILABLE}) == bitmap([2, 3])
+
+def test_search_counts_facets_only_once_the_index_is_ready(make_book, monkeypatch):
+    import catalog_management
+    import facets
+
+    make_book(title='Facet Quasar Atlas', genre='Science', total_copies=1)
+    make_book(title='Facet Quasar Guide', genre='Travel', total_copies=1)
+    monkeypatch.setattr(catalog_management, 'facets_ready', lambda: False)
+    page = catalog_management.search_books_page('quasar', with_facets=True)
+    assert page['facets'] is None and page['total_estimate'] == 2
+
+    monkeypatch.undo()
+    facets.build_facet_index()
+    page = catalog_management.search_books_page('quasar', with_facets=True, filters={'genre': 'Travel'})
+    assert page['total_estimate'] == 1
+    assert [book['title'] for book in page['results']] == ['Facet Quasar Guide']
+    assert dict(page['facets']['genre']) == {'Travel': 1}
+
+def test_changes_are_applied_in_one_batch_before_the_next_read():
+    index = FacetIndex()
+    index.load(BOOKS[:2])
+    bitmaps = index._bitmaps['availability']
+    index.add(BOOKS[2])
+    index.set_available(1, False)
+    index.set_available(2, True)
+    index.set_available(1, True)
+    # Nothing is rewritten until the index is read
+    assert index._bitmaps['availability'] is bitmaps and bitmaps[AVAILABLE] == bitmap([1])
+    assert index.narrow(bitmap([1, 2, 3]), {'availability': AVAILABLE}) == bitmap([1, 2, 3])
+    assert index.narrow(bitmap([1, 2, 3]), {'genre': 'History'}) == bitmap([3])
+    assert index._added == [] and index._availability == {}
+    # A book added after a change was queued for it keeps its own availability
+    index.set_available(70, True)
+    index.add(BOOKS[3])
+    assert index.narrow(bitmap([70]), {'availability': UNAVAILABLE}) == bitmap([70])
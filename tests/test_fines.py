@@ -0,0 +1,59 @@
+# tests/test_fines.py
+from datetime import date, timedelta
+from decimal import Decimal
+
+import circulation
+import fines
+from db_config import get_connection
+
+def _overdue_loan(user_id, book_id, days):
+    transaction_id = circulation.issue_book(user_id, book_id)['transaction_id']
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("UPDATE transactions SET due_date = %s WHERE transaction_id = %s",
+                       (date.today() - timedelta(days=days), transaction_id))
+        connection.commit()
+        cursor.close()
+    return transaction_id
+
+def _fines(user_id):
+    with get_connection(readonly=True) as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT fines FROM users WHERE user_id = %s", (user_id,))
+        fine = cursor.fetchone()[0]
+        cursor.execute("SELECT SUM(days), COUNT(*) FROM fine_ledger WHERE user_id = %s AND posted = TRUE", (user_id,))
+        days, rows = cursor.fetchone()
+        cursor.close()
+    return Decimal(fine), days or 0, rows
+
+def test_accrual_charges_each_overdue_day_once(make_user, make_book):
+    today = date.today()
+    public, staff = make_user('public'), make_user('staff')
+    _overdue_loan(public, make_book(), 5)
+    _overdue_loan(public, make_book(), 1)
+    _overdue_loan(staff, make_book(), 5)
+
+    stats = fines.accrue_fines(as_of=today - timedelta(days=2), chunk_size=1)
+    assert stats['loans'] >= 1 and stats['amount'] >= 3 * fines.FINE_RATES['public']
+    assert _fines(public) == (3 * fines.FINE_RATES['public'], 3, 1)
+
+    # Running again for the same date charges nothing, a later date only the new days
+    fines.accrue_fines(as_of=today - timedelta(days=2))
+    assert _fines(public) == (3 * fines.FINE_RATES['public'], 3, 1)
+    fines.accrue_fines(as_of=today, chunk_size=2)
+    assert _fines(public) == (6 * fines.FINE_RATES['public'], 6, 3)
+    assert _fines(staff) == (0, 0, 0)
+
+def test_return_charges_the_days_not_yet_charged(make_user, make_book):
+    user_id = make_user('student')
+    transaction_id = _overdue_loan(user_id, make_book(), 4)
+    fines.accrue_fines(as_of=date.today() - timedelta(days=1))
+    assert _fines(user_id) == (3 * fines.FINE_RATES['student'], 3, 1)
+
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        assert fines.accrue_transaction_fine(cursor, transaction_id) == fines.FINE_RATES['student']
+        assert fines.accrue_transaction_fines(cursor, [transaction_id]) == {}
+        connection.commit()
+        cursor.close()
+    assert _fines(user_id) == (4 * fines.FINE_RATES['student'], 4, 2)
@@ -0,0 +1,57 @@
+# tests/test_fuzzy_search.py
+import fuzzy_search
+from fuzzy_search import TrigramIndex, trigrams
+
+WORDS = ['dostoevsky', 'dostoyevsky', 'tolstoy', 'history', 'mystery', 'histology', 'dust', 'doves']
+
+def _jaccard(first, second):
+    first, second = trigrams(first), trigrams(second)
+    return len(first & second) / len(first | second)
+
+def _index(words=WORDS):
+    index = TrigramIndex()
+    index.load({'title': word} for word in words)
+    return index
+
+def test_trigrams_are_padded():
+    assert trigrams('cat') == {'  c', ' ca', 'cat', 'at '}
+
+def test_similar_finds_typos_ranked_by_similarity():
+    matches = _index().similar('dostoyevski')
+    assert [term for term, _ in matches][:2] == ['dostoyevsky', 'dostoevsky']
+    assert matches[0][1] > matches[1][1] >= fuzzy_search.MIN_SIMILARITY
+    assert _index().similar('qqqqqq') == []
+
+def test_pruned_candidates_find_every_match_a_full_scan_finds():
+    index = _index(WORDS + [f'{word}s' for word in WORDS] + ['histories', 'mistery', 'hysteria'])
+    for query in ('histroy', 'mystrey', 'dostoevski', 'tolstoi', 'doves'):
+        for min_similarity in (0.2, 0.3, 0.5):
+            expected = {term for term in index._terms if _jaccard(query, term) >= min_similarity}
+            found = {term for term, _ in index.similar(query, limit=1000, min_similarity=min_similarity)}
+            assert found == expected, (query, min_similarity)
+
+def test_words_added_during_a_build_survive_the_swap():
+    index = TrigramIndex()
+
+    def books():
+        yield {'title': 'history'}
+        index.add_book({'title': 'zeppelin'})
+        yield {'title': 'mystery'}
+
+    index.load(books())
+    assert [term for term, _ in index.similar('zepelin')] == ['zeppelin']
+    assert index.stats()['terms'] == 3
+
+def test_fuzzy_searches_do_not_wait_for_the_build(monkeypatch):
+    from catalog_management import search_books_page
+    index = TrigramIndex()
+    monkeypatch.setattr(fuzzy_search, 'trigram_index', index)
+    # A build that is still running
+    monkeypatch.setattr(fuzzy_search, '_build_thread', object())
+    assert fuzzy_search.expand_keyword('histroy') == {}
+    page = search_books_page('qzxhistroy', fuzzy=True)
+    assert page['results'] == [] and page['fuzzy_pending'] and not page['fuzzy']
+
+    index.load({'title': word} for word in WORDS)
+    assert 'history' in fuzzy_search.expand_keyword('histroy')
+    assert not search_books_page('qzxhistroy', fuzzy=True)['fuzzy_pending']
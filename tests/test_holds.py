@@ -0,0 +1,66 @@
+# tests/test_holds.py
+from datetime import date, timedelta
+
+import circulation
+import holds
+from circulation import (ISSUED, RETURNED, NOT_AVAILABLE, HOLD_PLACED, HOLD_CANCELLED, ALREADY_HELD, BOOK_AVAILABLE)
+from db_config import get_connection
+
+def _available(book_id):
+    with get_connection(readonly=True) as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT available_copies FROM books WHERE book_id = %s", (book_id,))
+        available = cursor.fetchone()[0]
+        cursor.close()
+    return available
+
+def test_estimate_wait_cycles_through_the_open_loans():
+    today = date(2024, 1, 1)
+    loans = [(date(2023, 12, 20), date(2024, 1, 3)), (date(2023, 12, 25), date(2024, 1, 8))]
+    assert [holds.estimate_wait(loans, ahead, today) for ahead in range(4)] == [2, 7, 16, 21]
+    assert holds.estimate_wait([], 0, today) is None
+
+def test_queue_is_served_by_priority_then_order(make_user, make_book):
+    book_id = make_book()
+    borrower, public, student = make_user(), make_user('public'), make_user('student')
+    assert circulation.place_hold(public, book_id)['status'] == BOOK_AVAILABLE
+    loan = circulation.issue_book(borrower, book_id)
+
+    public_hold = circulation.place_hold(public, book_id)
+    assert (public_hold['status'], public_hold['position']) == (HOLD_PLACED, 1)
+    assert circulation.place_hold(public, book_id)['status'] == ALREADY_HELD
+    student_hold = circulation.place_hold(student, book_id)
+    assert student_hold['position'] == 1
+    assert [hold['position'] for hold in holds.get_user_holds(public)] == [2]
+    assert holds.get_queue_length(book_id) == 2
+
+    # The returned copy is set aside for the student, whose membership is served first
+    returned = circulation.return_book(loan['transaction_id'])
+    assert returned['status'] == RETURNED and returned['hold'] == {'reservation_id': student_hold['reservation_id'], 'user_id': student}
+    assert _available(book_id) == 0
+    ready = holds.get_user_holds(student)[0]
+    assert ready['ready'] and ready['hold_expires'] == date.today() + timedelta(days=holds.HOLD_PICKUP_DAYS)
+    assert circulation.issue_book(public, book_id)['status'] == NOT_AVAILABLE
+    assert circulation.issue_book(student, book_id)['status'] == ISSUED
+    assert holds.get_user_holds(student) == [] and holds.get_queue_length(book_id) == 1
+
+def test_uncollected_holds_expire_to_the_next_in_line(make_user, make_book):
+    book_id = make_book()
+    first, second = make_user(), make_user()
+    loan = circulation.issue_book(make_user(), book_id)
+    first_hold = circulation.place_hold(first, book_id)
+    second_hold = circulation.place_hold(second, book_id)
+    circulation.return_book(loan['transaction_id'])
+
+    later = date.today() + timedelta(days=holds.HOLD_PICKUP_DAYS + 1)
+    stats = holds.expire_holds(as_of=later)
+    assert stats['expired'] >= 1 and stats['promoted'] >= 1
+    assert holds.get_user_holds(first) == []
+    assert holds.get_user_holds(second)[0]['ready']
+    assert holds.expire_holds(as_of=later)['expired'] == 0
+
+    # Cancelling the ready hold puts the copy back on the shelf, nobody else is waiting
+    cancelled = circulation.cancel_hold(second_hold['reservation_id'])
+    assert (cancelled['status'], cancelled['hold']) == (HOLD_CANCELLED, None)
+    assert _available(book_id) == 1
+    assert circulation.cancel_hold(first_hold['reservation_id'])['status'] == circulation.NOT_FOUND
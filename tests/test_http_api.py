@@ -0,0 +1,107 @@
+# tests/test_http_api.py
+import asyncio
+import itertools
+import json
+from decimal import Decimal
+
+import library_service
+from http_api import LibraryServer
+
+def _exchange(*requests):
+    """Sends raw requests down one connection and returns the (status, body) responses until it closes."""
+    async def run():
+        api = LibraryServer(workers=2)
+        server = await asyncio.start_server(api.handle_client, '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+        writer.write(b''.join(requests))
+        await writer.drain()
+        responses = []
+        while True:
+            status_line = await asyncio.wait_for(reader.readline(), 10)
+            if not status_line:
+                break
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                name, _, value = line.decode().partition(':')
+                headers[name.lower()] = value.strip()
+            body = json.loads(await reader.readexactly(int(headers['content-length'])))
+            responses.append((int(status_line.split()[1]), body))
+            if headers['connection'] == 'close':
+                break
+        writer.close()
+        server.close()
+        api.executor.shutdown()
+        return responses
+    return asyncio.run(run())
+
+def _request(method, path, body=None, token=None, close=True):
+    payload = json.dumps(body).encode() if body is not None else b''
+    head = f"{method} {path} HTTP/1.1\r\nContent-Length: {len(payload)}\r\n"
+    if token:
+        head += f"Authorization: Bearer {token}\r\n"
+    if close:
+        head += "Connection: close\r\n"
+    return (head + "\r\n").encode() + payload
+
+_logins = itertools.count(1)
+
+def _login(make_user, role='borrower'):
+    username = f'{role}{next(_logins)}'
+    user_id = make_user(role=role, username=username)
+    result = library_service.login(username, 'secret')
+    assert result['status'] == library_service.OK and result['token']
+    return user_id, result['token']
+
+def test_sessions_issue_tokens_required_by_mutating_routes(make_user, make_book):
+    user_id, token = _login(make_user)
+    other_id = make_user()
+    book_id = make_book(total_copies=2)
+
+    [(status, body)] = _exchange(_request('POST', '/loans', {'user_id': user_id, 'book_id': book_id}))
+    assert status == 401
+    [(status, body)] = _exchange(_request('POST', '/loans', {'user_id': other_id, 'book_id': book_id}, token))
+    assert status == 403
+    [(status, body)] = _exchange(_request('POST', '/loans', {'user_id': user_id, 'book_id': book_id}, token))
+    assert status == 201
+    transaction_id = body['transaction_id']
+
+    _, librarian_token = _login(make_user, role='librarian')
+    [(status, body)] = _exchange(_request('POST', f'/loans/{transaction_id}/return', token=librarian_token))
+    assert (status, body['status']) == (200, 'returned')
+
+    [(status, body)] = _exchange(_request('DELETE', '/sessions', token=token))
+    assert status == 200
+    assert library_service.get_session(token) is None
+
+def test_fine_payments_need_staff_and_a_finite_amount(make_user):
+    from user_management import update_user_fine
+
+    user_id, token = _login(make_user)
+    _, librarian_token = _login(make_user, role='librarian')
+    update_user_fine(user_id, 10)
+
+    path = f'/users/{user_id}/fine-payments'
+    [(status, _)] = _exchange(_request('POST', path, {'amount': 4}, token))
+    assert status == 403
+    [(status, _)] = _exchange(_request('POST', path, {'amount': 'NaN'}, librarian_token))
+    assert status == 400
+    [(status, body)] = _exchange(_request('POST', path, {'amount': '4.50'}, librarian_token))
+    assert status == 200 and Decimal(body['remaining_fines']) == Decimal('5.50')
+    [(status, _)] = _exchange(_request('POST', path, {'amount': 6}, librarian_token))
+    assert status == 400
+
+def test_self_registration_is_limited_to_public_members(make_user):
+    fields = {'password': 'secret', 'full_name': 'New Member', 'email': 'new@example.org', 'phone': '555-0199'}
+    [(status, _)] = _exchange(_request('POST', '/users', dict(fields, username='newstudent', membership_category='student')))
+    assert status == 403
+    [(status, _)] = _exchange(_request('POST', '/users', dict(fields, username='newpublic', membership_category='public')))
+    assert status == 200
+    _, librarian_token = _login(make_user, role='librarian')
+    [(status, _)] = _exchange(_request('POST', '/users', dict(fields, username='newstudent', membership_category='student'),
+                                       librarian_token))
+    assert status == 200
+
+def test_bad_content_length_closes_the_connection():
+    bad = b"POST /sessions HTTP/1.1\r\nContent-Length: abc\r\n\r\n{}"
+    responses = _exchange(bad, _request('GET', '/health'))
+    assert [status for status, _ in responses] == [400]
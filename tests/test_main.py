@@ -0,0 +1,137 @@
+# tests/test_main.py
+import types
+
+import pytest
+
+import db_executor
+import main
+from catalog_import import import_books
+from catalog_management import search_books_page
+
+class FakeWidget:
+    """Accepts any widget call; keeps the options and bindings the tests look at."""
+
+    def __init__(self, *args, **options):
+        self.options = options
+        self.bindings = {}
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+    def config(self, **options):
+        self.options.update(options)
+
+    def bind(self, sequence, callback):
+        self.bindings[sequence] = callback
+
+class FakeTreeview(FakeWidget):
+    """Keeps the rows of a ttk.Treeview and which of them are attached, in display order."""
+
+    instances = []
+
+    def __init__(self, *args, **options):
+        super().__init__(*args, **options)
+        self.rows, self.shown, self.selected = {}, [], ()
+        FakeTreeview.instances.append(self)
+
+    def insert(self, parent, index, text=""):
+        row = f"row{len(self.rows)}"
+        self.rows[row] = text
+        self.shown.append(row)
+        return row
+
+    def item(self, row, text, values):
+        self.rows[row] = text
+
+    def move(self, row, parent, index):
+        if row in self.shown:
+            self.shown.remove(row)
+        self.shown.insert(index, row)
+
+    def detach(self, row):
+        if row in self.shown:
+            self.shown.remove(row)
+
+    def selection_set(self, rows):
+        self.selected = rows if isinstance(rows, tuple) else (rows,)
+
+    def selection(self):
+        return self.selected
+
+    def texts(self):
+        return [self.rows[row] for row in self.shown]
+
+class FakeEntry(FakeWidget):
+    value = ""
+
+    def get(self):
+        return FakeEntry.value
+
+class FakeScrollbar(FakeWidget):
+    instances = []
+
+    def __init__(self, *args, **options):
+        super().__init__(*args, **options)
+        self.position = None
+        FakeScrollbar.instances.append(self)
+
+    def set(self, first, last):
+        self.position = (first, last)
+
+@pytest.fixture
+def fake_tk(monkeypatch):
+    buttons = []
+
+    def button(*args, **options):
+        buttons.append(FakeWidget(*args, **options))
+        return buttons[-1]
+
+    monkeypatch.setattr(main, 'tk', types.SimpleNamespace(
+        Tk=FakeWidget, Toplevel=FakeWidget, Label=FakeWidget, Entry=FakeEntry, Listbox=FakeWidget, Frame=FakeWidget,
+        Button=button, Scrollbar=FakeScrollbar, StringVar=FakeWidget, OptionMenu=FakeWidget, END='end'))
+    monkeypatch.setattr(main, 'ttk', types.SimpleNamespace(Treeview=FakeTreeview))
+    monkeypatch.setattr(main, 'messagebox', types.SimpleNamespace(showinfo=lambda *args: None, showerror=lambda *args: None))
+    fetches = []
+
+    # Calls run synchronously, so every page fetch has landed when a scroll returns
+    def run_now(widget, func, *args, on_success=None, on_error=None, **kwargs):
+        fetches.append(kwargs.get('page_size'))
+        on_success(func(*args, **kwargs))
+
+    monkeypatch.setattr(db_executor, 'run_in_background', run_now)
+    FakeTreeview.instances.clear()
+    FakeScrollbar.instances.clear()
+    return types.SimpleNamespace(buttons=buttons, fetches=fetches)
+
+def test_result_list_draws_only_the_rows_in_view(fake_tk, make_user):
+    count = 130
+    import_books({'title': f'Zephyrlist Volume {n}', 'author': 'Serial Author'} for n in range(count))
+    expected = [book['title'] for book in search_books_page('zephyrlist', page_size=count + 10)['results']]
+    assert len(expected) == count
+
+    FakeEntry.value = 'zephyrlist'
+    main.show_search_books_window({'user_id': make_user(), 'role': 'borrower'})
+    next(button for button in fake_tk.buttons if button.options.get('text') == 'Search').options['command']()
+    tree, = FakeTreeview.instances
+    scrollbar, = FakeScrollbar.instances
+
+    # A fixed set of rows is drawn whatever the number of results, and only the first page was fetched
+    assert len(tree.rows) == main.RESULT_ROWS
+    assert tree.texts() == expected[:main.RESULT_ROWS]
+    assert len(fake_tk.fetches) == 1
+
+    # Jumping into the unfetched part fetches the missing results and draws them
+    scrollbar.options['command']('moveto', '0.5')
+    first = count // 2
+    assert tree.texts() == expected[first:first + main.RESULT_ROWS]
+    assert len(fake_tk.fetches) == 2 and len(tree.rows) == main.RESULT_ROWS
+
+    scrollbar.options['command']('moveto', '1.0')
+    assert tree.texts() == expected[-main.RESULT_ROWS:]
+    assert scrollbar.position == ((count - main.RESULT_ROWS) / count, 1.0)
+
+    # Keyboard selection scrolls the selected result into view
+    tree.bindings['<Prior>'](None)
+    tree.bindings['<Up>'](None)
+    assert tree.texts()[0] == expected[count - main.RESULT_ROWS - 1]
+    assert tree.rows[tree.selected[0]] == expected[count - main.RESULT_ROWS - 1]
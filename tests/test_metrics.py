@@ -0,0 +1,64 @@
+# tests/test_metrics.py
+import json
+import random
+
+import metrics
+from db_config import get_connection
+from metrics import Histogram, statement_name, histogram
+
+def test_histogram_quantiles_stay_within_bucket_error():
+    values = [int(random.Random(3).lognormvariate(8, 2)) for _ in range(20000)]
+    hist = Histogram()
+    for value in values:
+        hist.record(value)
+    values.sort()
+    for q in (0.5, 0.9, 0.99):
+        exact = values[int(q * len(values)) - 1]
+        assert abs(hist.quantile(q) - exact) <= max(exact * 0.07, 1)
+    summary = hist.summary()
+    assert (summary['count'], summary['min'], summary['max']) == (len(values), values[0], values[-1])
+    assert Histogram().quantile(0.99) == 0
+
+def test_small_values_are_recorded_exactly():
+    hist = Histogram()
+    for value in (0, 1, 2, 31, -5):
+        hist.record(value)
+    assert [hist.quantile(q) for q in (0.2, 0.4, 0.6, 0.8, 1.0)] == [0, 0, 1, 2, 31]
+
+def test_statement_names_collapse_placeholder_lists():
+    assert statement_name("SELECT *\n  FROM books WHERE book_id IN (%s, %s,%s)") == \
+        "SELECT * FROM books WHERE book_id IN (%s, ...)"
+    assert statement_name("INSERT INTO t VALUES (%s, %s), (%s, %s), (%s, %s)") == "INSERT INTO t VALUES (%s, ...), ..."
+
+def test_statements_are_timed_and_slow_ones_logged(monkeypatch, scratch_dir):
+    query = "SELECT book_id FROM books WHERE book_id >= %s /* metrics test */"
+    monkeypatch.setattr(metrics, 'SLOW_QUERY_MS', 0)
+    with get_connection(readonly=True) as connection:
+        cursor = connection.cursor()
+        cursor.execute(query, (0,))
+        rows = cursor.fetchall()
+        cursor.close()
+    assert histogram('statement_us', query).count == 1
+    assert histogram('statement_rows', query).count == 1 and histogram('statement_rows', query).max == len(rows)
+    with open(metrics.SLOW_QUERY_LOG) as log:
+        assert f"rows={len(rows)} {query}" in log.read()
+
+    # A result fetched empty has zero rows, not an unknown number
+    with get_connection(readonly=True) as connection:
+        cursor = connection.cursor()
+        cursor.execute(query, (-1,))
+        cursor.fetchall()
+        cursor.execute("SELECT book_id FROM books WHERE book_id < %s /* metrics test */", (0,))
+        assert cursor.fetchall() == []
+        cursor.close()
+    assert histogram('statement_rows', query).count == 2
+    assert histogram('statement_rows', "SELECT book_id FROM books WHERE book_id < %s /* metrics test */").max == 0
+
+def test_snapshots_export_as_json_and_prometheus(tmp_path):
+    histogram('function_us', 'tests.exported').record(1500)
+    prometheus = metrics.prometheus_text()
+    assert 'library_function_seconds_count{function="tests.exported"} 1' in prometheus
+    assert 'library_function_seconds{function="tests.exported",quantile="0.5"} 0.0015' in prometheus
+    path = tmp_path / 'metrics.json'
+    metrics.write_snapshot(str(path))
+    assert json.loads(path.read_text())['function_us']['tests.exported']['count'] == 1
@@ -0,0 +1,27 @@
+# tests/test_migrations.py
+import migrations
+from db_config import get_connection
+
+def test_migrations_apply_once_and_leave_no_full_scans():
+    migrations.migrate()
+    assert migrations.applied_versions() == {version for version, _, _ in migrations.MIGRATIONS}
+    assert migrations.migrate() == []
+    assert migrations.check_plans(min_rows=0) == []
+
+def test_schema_files_define_every_migrated_index():
+    for backend, path in migrations.SCHEMA_FILES.items():
+        with open(path) as schema:
+            text = schema.read()
+        for index in ('idx_reservations_user_holds', 'idx_transactions_open_user', 'idx_reservations_hold_queue'):
+            assert index in text, (backend, index)
+
+def test_overdue_loans_have_one_open_loan_index():
+    migrations.migrate()
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        assert migrations._index_exists(cursor, 'transactions', 'idx_transactions_open_user')
+        assert not migrations._index_exists(cursor, 'transactions', 'idx_transactions_due')
+        cursor.close()
+    for backend, path in migrations.SCHEMA_FILES.items():
+        with open(path) as schema:
+            assert 'idx_transactions_due' not in schema.read(), backend
@@ -0,0 +1,89 @@
+# tests/test_notices.py
+from datetime import date, timedelta
+
+import circulation
+import notices
+from db_config import get_connection
+
+def _loans(user_id, make_book, due_in_days):
+    """Issues one book per due date, given in days from today, and returns the transaction IDs."""
+    transaction_ids = [circulation.issue_book(user_id, make_book())['transaction_id'] for _ in due_in_days]
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.executemany("UPDATE transactions SET due_date = %s WHERE transaction_id = %s",
+                           [(date.today() + timedelta(days=days), transaction_id)
+                            for days, transaction_id in zip(due_in_days, transaction_ids)])
+        connection.commit()
+        cursor.close()
+    return transaction_ids
+
+def _patrons(make_user, make_book):
+    # Loans due in more than NOTICE_DUE_SOON_DAYS are not part of any notice
+    due_in_days = {'few': [-2, 1, 30], 'many': [-5, -4, -1, 0, 2], 'one': [3], 'none': [30]}
+    patrons = {}
+    for name, days in due_in_days.items():
+        user_id = make_user()
+        transaction_ids = _loans(user_id, make_book, days)
+        patrons[name] = (user_id, {transaction_id for transaction_id, due in zip(transaction_ids, days)
+                                   if due <= notices.NOTICE_DUE_SOON_DAYS})
+    return patrons
+
+def test_users_are_grouped_whole_across_chunk_boundaries(make_user, make_book):
+    patrons = _patrons(make_user, make_book)
+    first = min(user_id for user_id, _ in patrons.values())
+    due_soon_by = date.today() + timedelta(days=notices.NOTICE_DUE_SOON_DAYS)
+    expected = [(user_id, loans) for user_id, loans in sorted(patrons.values()) if loans]
+    # Chunks smaller than one user's loans and chunks ending mid-user both keep each user in one piece
+    for chunk_size in (1, 2, 3, 4, 100):
+        users = list(notices.iter_notice_users(date.today(), due_soon_by, first - 1, chunk_size))
+        assert [(user['user_id'], {loan[0] for loan in user['loans']}) for user in users] == expected, chunk_size
+
+def test_notice_lists_overdue_and_due_soon_loans():
+    templates = notices.load_templates()
+    today = date(2024, 5, 10)
+    user = {'user_id': 1, 'full_name': 'Ada', 'email': 'ada@example.org', 'fines': 12.5,
+            'loans': [(1, date(2024, 5, 12), 'Later', 'B'), (2, date(2024, 5, 1), 'Late', None)]}
+    subject, body = notices.render_notice(templates, user, today, date(2024, 5, 13))
+    assert subject == "Overdue library books"
+    assert "Dear Ada," in body and "12.50" in body
+    assert body.index("Late by unknown author, due 2024-05-01") < body.index("These books are also due back by 2024-05-13")
+    assert "Later by B, due 2024-05-12" in body
+
+    subject, body = notices.render_notice(templates, dict(user, loans=user['loans'][:1]), today, date(2024, 5, 13))
+    assert subject == "Library books due soon" and "Late by" not in body
+
+class FailingSpool:
+    """Collects delivered notices and fails the delivery after `fail_after` batches."""
+
+    def __init__(self, fail_after=None):
+        self.delivered = []
+        self.fail_after = fail_after
+
+    def send_batch(self, messages):
+        if self.fail_after is not None and len(self.delivered) >= self.fail_after:
+            raise OSError("spool is full")
+        self.delivered.append([user['user_id'] for user, _, _ in messages])
+
+def test_stopped_runs_resume_after_the_last_delivered_batch(make_user, make_book):
+    patrons = _patrons(make_user, make_book)
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("UPDATE users SET email = NULL WHERE user_id = %s", (patrons['one'][0],))
+        connection.commit()
+        cursor.close()
+    ours = {user_id for user_id, loans in patrons.values() if loans}
+    # A day no other test sends notices for
+    as_of = date.today() + timedelta(days=1000)
+
+    stopped = FailingSpool(fail_after=1)
+    stats = notices.send_notices(as_of=as_of, spool=stopped, batch_size=1, restart=True)
+    assert stats['sent'] == 1
+    resumed = FailingSpool()
+    stats = notices.send_notices(as_of=as_of, spool=resumed, batch_size=1)
+    assert stats['resumed_after'] == stopped.delivered[0][0]
+    delivered = [user_id for batch in stopped.delivered + resumed.delivered for user_id in batch]
+    assert len(delivered) == len(set(delivered))
+    assert ours - {patrons['one'][0]} <= set(delivered) and patrons['one'][0] not in delivered
+
+    # A finished run sends nothing more that day
+    assert notices.send_notices(as_of=as_of, spool=FailingSpool())['sent'] == 0
@@ -0,0 +1,105 @@
+# tests/test_replicas.py
+import os
+import threading
+
+import pytest
+
+import db_config
+from db_config import ReplicaRouter, get_connection
+
+def _database_file(readonly):
+    with get_connection(readonly=readonly) as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT file FROM pragma_database_list WHERE name = 'main'")
+        path = cursor.fetchone()[0]
+        cursor.close()
+    return os.path.basename(path)
+
+def _in_thread(function):
+    # Writes are remembered per thread, so each scenario starts on a thread that has not written
+    result = []
+    thread = threading.Thread(target=lambda: result.append(function()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+@pytest.fixture
+def router(monkeypatch, tmp_path):
+    def make(count=2, selection='round_robin'):
+        router = ReplicaRouter([str(tmp_path / f'replica{n}.db') for n in range(count)], selection)
+        # Checked by the tests instead of a monitor thread
+        router._monitor = threading.current_thread()
+        router.check()
+        monkeypatch.setattr(db_config, '_router', router)
+        return router
+    return make
+
+def test_reads_are_spread_over_current_replicas(router):
+    replicas = router()
+    assert [replica.lag for replica in replicas.replicas] == [0.0, 0.0]
+    assert _in_thread(lambda: [_database_file(True) for _ in range(4)]) == ['replica0.db', 'replica1.db'] * 2
+    assert _in_thread(lambda: _database_file(False)) == 'library.db'
+
+def test_lagging_replicas_are_skipped(router):
+    replicas = router()
+    replicas.replicas[0].lag = db_config.REPLICA_MAX_LAG + 1
+    assert _in_thread(lambda: {_database_file(True) for _ in range(3)}) == {'replica1.db'}
+    replicas.replicas[1].lag = None
+    assert _in_thread(lambda: _database_file(True)) == 'library.db'
+
+def test_least_latency_prefers_the_fastest_replica(router):
+    replicas = router(selection='least_latency')
+    replicas.replicas[0].latency, replicas.replicas[1].latency = 0.02, 0.001
+    assert _in_thread(lambda: {_database_file(True) for _ in range(3)}) == {'replica1.db'}
+
+def test_a_thread_reads_its_own_writes_from_the_primary(router):
+    router()
+
+    def write_then_read():
+        with get_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+            connection.commit()
+        return db_config.wrote_recently(), _database_file(True)
+
+    assert _in_thread(write_then_read) == (True, 'library.db')
+    # Other threads keep reading from the replicas
+    wrote, database = _in_thread(lambda: (db_config.wrote_recently(), _database_file(True)))
+    assert not wrote and database.startswith('replica')
+
+def test_unreachable_replicas_are_reported(router, tmp_path):
+    replicas = router()
+    replicas.replicas.append(db_config.Replica(str(tmp_path / 'missing' / 'replica.db')))
+    replicas.check()
+    missing = replicas.stats()[-1]
+    assert (missing['lag'], missing['error']) == (None, "Could not connect.")
+    assert len(replicas.usable()) == 2
+
+def test_a_failing_check_marks_the_replica_unusable_and_the_monitor_keeps_running(router, monkeypatch):
+    replicas = router()
+    broken = replicas.replicas[0]
+
+    def fail():
+        raise ValueError("unexpected lag value")
+
+    monkeypatch.setattr(broken, 'check', fail)
+    replicas.check()
+    assert (broken.lag, broken.error) == (None, "unexpected lag value")
+    assert replicas.usable() == [replicas.replicas[1]]
+
+    # The monitor survives a pass that fails as a whole
+    passes = []
+
+    def check():
+        passes.append(1)
+        if len(passes) == 1:
+            raise RuntimeError("pass failed")
+        raise SystemExit
+
+    monkeypatch.setattr(replicas, 'check', check)
+    monkeypatch.setattr(db_config, 'REPLICA_CHECK_INTERVAL', 0)
+    with pytest.raises(SystemExit):
+        replicas._run_monitor()
+    assert len(passes) == 2 and replicas.usable() == []
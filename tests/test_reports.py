@@ -0,0 +1,83 @@
+# tests/test_reports.py
+import json
+import os
+from datetime import date
+
+import pytest
+
+import reports
+from db_config import get_connection
+from reports import Snapshot, build_reports, take_snapshot, write_reports
+
+def _snapshot():
+    snapshot = Snapshot(created='2024-03-01T00:00:00')
+    def add(table, *rows):
+        names = [column for column, _ in reports.TABLES[table]]
+        for row in rows:
+            for name, value in zip(names, row):
+                snapshot.column(table, name).append(value)
+
+    day = date(2024, 2, 1).toordinal()
+    # (id, category: 0 staff, 1 student, 2 public, fines in cents)
+    add('users', (1, 1, 0), (2, 2, 1050), (3, 2, 0))
+    # (id, Dewey class, copies)
+    add('books', (10, 5, 2), (11, 8, 1), (12, reports.UNCLASSIFIED, 3))
+    # (id, book, user, issued, due, returned): on time, returned late, still out and overdue, outside the period
+    add('transactions', (1, 10, 1, day, day + 14, day + 10), (2, 10, 2, day, day + 14, day + 16),
+        (3, 11, 2, day + 1, day + 15, 0), (4, 12, 3, day - 40, day - 26, day - 20))
+    add('fine_ledger', (1, 2, day + 16, 2000), (2, 2, day - 30, 500))
+    snapshot.labels = {10: 'Popular by Someone', 11: 'Other', 12: 'Old'}
+    return snapshot, day
+
+def _check(result):
+    assert result['most_borrowed'] == [{'book_id': 10, 'title': 'Popular by Someone', 'loans': 2},
+                                       {'book_id': 11, 'title': 'Other', 'loans': 1}]
+    by_category = {row['membership_category']: row for row in result['overdue_by_category']}
+    assert (by_category['student']['loans'], by_category['student']['returned_late_or_overdue']) == (1, 0)
+    assert by_category['public'] == {'membership_category': 'public', 'loans': 2, 'returned_late_or_overdue': 2,
+                                     'overdue_now': 1, 'overdue_rate': 1.0}
+    fines = {row['membership_category']: row for row in result['fines_by_category']}
+    assert fines['public'] == {'membership_category': 'public', 'members': 2, 'charged': 20.0, 'outstanding': 10.5}
+    usage = {row['dewey_class']: row for row in result['usage_by_dewey_class']}
+    assert usage['500'] == {'dewey_class': '500', 'titles': 1, 'copies': 2, 'loans': 2, 'titles_borrowed': 1, 'loans_per_copy': 1.0}
+    assert usage['unclassified']['loans'] == 0 and usage['unclassified']['copies'] == 3
+
+def test_reports_in_pure_python(monkeypatch):
+    monkeypatch.setattr(reports, 'USE_NUMPY', False)
+    snapshot, day = _snapshot()
+    result = build_reports(snapshot, since=date.fromordinal(day - 1), as_of=date.fromordinal(day + 30))
+    assert result['engine'] == 'python'
+    _check(result)
+
+def test_numpy_reports_match_pure_python(monkeypatch):
+    pytest.importorskip('numpy')
+    snapshot, day = _snapshot()
+    result = build_reports(snapshot, since=date.fromordinal(day - 1), as_of=date.fromordinal(day + 30))
+    assert result['engine'] == 'numpy'
+    _check(result)
+
+def test_snapshot_round_trips_through_npz(tmp_path):
+    snapshot, _ = _snapshot()
+    path = str(tmp_path / 'snapshot.npz')
+    snapshot.save(path)
+    loaded = Snapshot.load(path)
+    assert loaded.columns == snapshot.columns and loaded.labels == snapshot.labels and loaded.created == snapshot.created
+    assert not os.path.exists(f"{path}.tmp")
+
+def test_snapshot_copies_the_database_in_chunks(make_user, make_book, tmp_path):
+    import circulation
+    circulation.issue_book(make_user(), make_book())
+    snapshot = take_snapshot(chunk_size=3, fetch_size=2)
+    with get_connection(readonly=True) as connection:
+        cursor = connection.cursor()
+        for table in reports.TABLES:
+            cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            assert snapshot.rows(table) == cursor.fetchone()[0]
+        cursor.close()
+    assert len(set(snapshot.column('transactions', 'transaction_id'))) == snapshot.rows('transactions')
+
+    paths = write_reports(build_reports(snapshot), str(tmp_path))
+    assert [os.path.basename(path) for path in paths] == ['reports.json', 'most_borrowed.csv', 'overdue_by_category.csv',
+                                                          'fines_by_category.csv', 'usage_by_dewey_class.csv']
+    with open(paths[0]) as report_file:
+        assert json.load(report_file)['most_borrowed']
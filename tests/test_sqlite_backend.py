@@ -0,0 +1,52 @@
+# tests/test_sqlite_backend.py
+import os
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+import sqlite_backend
+from sqlite_backend import translate_sql, connect, IntegrityError, ER_DUP_ENTRY
+
+def test_translate_sql_rewrites_the_mysql_dialect():
+    assert translate_sql("SELECT * FROM books WHERE book_id = %s AND isbn = %s") == \
+        "SELECT * FROM books WHERE book_id = ? AND isbn = ?"
+    assert translate_sql("insert ignore INTO t (a) VALUES (%s)") == "INSERT OR IGNORE INTO t (a) VALUES (?)"
+    assert translate_sql("SELECT available_copies FROM books WHERE book_id = %s FOR UPDATE") == \
+        "SELECT available_copies FROM books WHERE book_id = ?"
+    assert translate_sql("INSERT INTO t (k, n) VALUES (%s, %s) ON DUPLICATE KEY UPDATE n = n + VALUES(n)") == \
+        "INSERT INTO t (k, n) VALUES (?, ?) ON CONFLICT DO UPDATE SET n = n + excluded.n"
+
+@pytest.fixture
+def connection(scratch_dir):
+    connection = connect(os.path.join(scratch_dir, 'backend.db'))
+    yield connection
+    connection.close()
+
+def test_connection_speaks_the_mysql_connector_api(connection):
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute("CREATE TABLE IF NOT EXISTS counts (k TEXT PRIMARY KEY, n INTEGER, day DATE, price DECIMAL(6,2))")
+    cursor.execute("DELETE FROM counts")
+    upsert = "INSERT INTO counts (k, n, day, price) VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE n = n + VALUES(n)"
+    cursor.executemany(upsert, [('a', 1, date(2024, 1, 31), Decimal('2.50')), ('a', 2, date(2024, 1, 31), Decimal('2.50'))])
+    connection.commit()
+    cursor.execute("SELECT k, n, day, price, DATEDIFF(%s, day) AS days FROM counts FOR UPDATE", (date(2024, 3, 1),))
+    assert cursor.fetchall() == [{'k': 'a', 'n': 3, 'day': date(2024, 1, 31), 'price': Decimal('2.5'), 'days': 30}]
+
+    with pytest.raises(IntegrityError) as raised:
+        cursor.execute("INSERT INTO counts (k, n) VALUES (%s, %s)", ('a', 1))
+    assert raised.value.errno == ER_DUP_ENTRY
+    connection.rollback()
+    assert connection.is_connected() and not connection.unread_result
+    cursor.close()
+
+def test_new_databases_get_the_schema(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {row[0] for row in cursor.fetchall()}
+    assert {'users', 'books', 'transactions', 'reservations', 'fine_ledger', 'book_search_terms'} <= tables
+    cursor.close()
+
+def test_datediff_passes_null_through():
+    assert sqlite_backend._datediff(None, '2024-01-01') is None
+    assert sqlite_backend._datediff('2024-03-01 10:00:00', date(2024, 2, 28)) == 2
@@ -0,0 +1,22 @@
+# tests/test_startup.py
+import json
+
+import startup
+
+def test_warm_up_reads_settings_loaded_after_import(tmp_path, monkeypatch):
+    # Set only now, as if from the .env file db_config loads after startup is imported
+    report_path = tmp_path / 'startup.json'
+    monkeypatch.setenv('STARTUP_REPORT', str(report_path))
+    monkeypatch.setenv('STARTUP_CONNECTIONS', '3')
+    monkeypatch.setattr(startup, '_reported', False)
+    monkeypatch.setattr(startup, '_marks', {})
+    monkeypatch.setattr(startup, '_steps', {})
+
+    startup.warm_up()
+    startup.mark('interactive')
+
+    timings = json.loads(report_path.read_text())
+    assert {'warmed_up', 'interactive'} <= set(timings['milestones'])
+    assert 'open connections' in timings['steps'] and 'start search indexes' in timings['steps']
+    import db_config
+    assert db_config.get_pool()._open >= 3
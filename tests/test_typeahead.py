@@ -0,0 +1,40 @@
+# tests/test_typeahead.py
+from typeahead import TypeaheadIndex
+
+def test_prefix_suggestions_rank_titles_and_copies_first():
+    index = TypeaheadIndex()
+    index.load([(1, 'Dune', 'Frank Herbert', 2), (2, 'Dune Messiah', 'Frank Herbert', 5),
+                (3, 'Herbarium', 'Dunstan Hale', 9), (4, 'Emma', 'Jane Austen', 1)])
+    assert [book_id for book_id, _ in index.suggest('du')] == [2, 1, 3]
+    assert index.suggest('dune mess')[0][0] == 2
+    assert index.suggest('herbert')[0][1] == 'Dune Messiah by Frank Herbert'
+    assert index.suggest('zzz') == []
+
+def test_books_added_during_a_build_survive_the_swap():
+    index = TypeaheadIndex()
+
+    def rows():
+        yield (1, 'Dune', 'Frank Herbert', 1)
+        # Added by another thread while the scan is still running
+        index.add(2, 'Dune Messiah', 'Frank Herbert', 1)
+        yield (3, 'Emma', 'Jane Austen', 1)
+
+    index.load(rows())
+    assert {book_id for book_id, _ in index.suggest('dune')} == {1, 2}
+    assert index.stats()['books'] == 3
+    index.add(4, 'Dunes of Mars', 'Someone', 1)
+    assert index._pending is None
+    assert 4 in {book_id for book_id, _ in index.suggest('dunes')}
+
+def test_labels_are_kept_only_for_books_in_a_suggestion_list(monkeypatch):
+    monkeypatch.setattr('typeahead.TOP_PER_TERM', 2)
+    index = TypeaheadIndex()
+    index.load([(book_id, 'Common Words', None, book_id) for book_id in range(1, 4)])
+    assert set(index._labels) == {2, 3} and index.stats()['books'] == 2
+    for book_id in range(4, 7):
+        index.add(book_id, 'Common Words', None, book_id)
+    assert set(index._labels) == set(index._refs) == {5, 6}
+    assert [book_id for book_id, _ in index.suggest('comm')] == [6, 5]
+    # A book with a term of its own stays suggestable
+    index.add(7, 'Common Rarity', None, 0)
+    assert index.suggest('rarity') == [(7, 'Common Rarity')]
@@ -0,0 +1,310 @@
+# typeahead.py
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+
+from db_config import get_connection, Error
+from catalog_management import tokenize
+
+# Books remembered per term and per short prefix; bounds memory to
+# (distinct terms + short prefixes) * SUGGEST_TOP_PER_TERM entries
+TOP_PER_TERM = int(os.environ.get('SUGGEST_TOP_PER_TERM') or 8)
+# Terms past this many are not indexed, bounding memory on huge catalogs
+MAX_TERMS = int(os.environ.get('SUGGEST_MAX_TERMS') or 2000000)
+# Prefixes up to this length have their own precomputed suggestions, since
+# they cover too many terms to merge per keystroke
+SHORT_PREFIX_LENGTH = 3
+# Most terms merged for a longer prefix
+MAX_SCAN_TERMS = 64
+# Number of suggestions returned by default
+SUGGEST_LIMIT = 10
+# Rows fetched per round trip while building
+BUILD_FETCH_SIZE = 5000
+# Longest label kept per book. Labels are only kept for books in some
+# suggestion list, so they are bounded like the lists
+MAX_LABEL_LENGTH = 120
+
+# Rank of a match by the field it is in, ties are broken by the number of copies
+FIELD_RANKS = {'title': 2, 'author': 1}
+# Suggestions are packed in one integer, rank then copies then book_id, so
+# a term's list is a compact array that sorts by relevance
+_COPIES_BITS = 20
+_BOOK_ID_BITS = 32
+_BOOK_ID_MASK = (1 << _BOOK_ID_BITS) - 1
+
+def _key(rank, copies, book_id):
+    copies = min(max(copies or 0, 0), (1 << _COPIES_BITS) - 1)
+    return (((rank << _COPIES_BITS) | copies) << _BOOK_ID_BITS) | book_id
+
+def _label(title, author):
+    label = f"{title} by {author}" if author else str(title)
+    return label[:MAX_LABEL_LENGTH]
+
+def _best_keys(book_id, title, author, copies):
+    # Best key of the book for each of its terms
+    best = {}
+    for field, text in (('title', title), ('author', author)):
+        key = _key(FIELD_RANKS[field], copies, book_id)
+        for term in tokenize(text):
+            if key > best.get(term, 0):
+                best[term] = key
+    return best
+
+class TypeaheadIndex:
+    """
+    An in-memory prefix index over the title and author terms of the
+    catalog, for suggestions as the user types.
+
+    Terms are kept in a sorted list searched with bisect, each with the
+    few most relevant books containing it. Prefixes of up to
+    SHORT_PREFIX_LENGTH characters, which match too many terms to merge
+    per keystroke, keep their own list. A lookup is then a bisect plus a
+    merge of at most MAX_SCAN_TERMS short arrays.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._terms = []
+        self._tops = []
+        self._prefix_tops = {}
+        self._labels = {}
+        # Number of entries of each book across all suggestion lists; a
+        # book's label is dropped when it leaves the last one
+        self._refs = {}
+        # Books added while load() builds a replacement, replayed into it before the swap
+        self._pending = None
+        self.ready = False
+
+    def _keep(self, key, label):
+        book_id = key & _BOOK_ID_MASK
+        self._refs[book_id] = self._refs.get(book_id, 0) + 1
+        self._labels[book_id] = label
+
+    def _release(self, key):
+        book_id = key & _BOOK_ID_MASK
+        refs = self._refs[book_id] - 1
+        if refs:
+            self._refs[book_id] = refs
+        else:
+            del self._refs[book_id]
+            del self._labels[book_id]
+
+    def _new_top(self, key, label):
+        self._keep(key, label)
+        return array('q', [key])
+
+    def _offer(self, top, key, label):
+        # top is kept ascending, so its first element is the weakest suggestion
+        if key in top:
+            return
+        if len(top) >= TOP_PER_TERM:
+            if key <= top[0]:
+                return
+            self._release(top.pop(0))
+        insort(top, key)
+        self._keep(key, label)
+
+    def _add(self, book_id, title, author, copies):
+        best = _best_keys(book_id, title, author, copies)
+        if not best:
+            return
+        label = _label(title, author)
+
+        prefixes = {}
+        for term, key in best.items():
+            for length in range(1, min(len(term), SHORT_PREFIX_LENGTH) + 1):
+                prefix = term[:length]
+                if key > prefixes.get(prefix, 0):
+                    prefixes[prefix] = key
+            position = bisect_left(self._terms, term)
+            if position < len(self._terms) and self._terms[position] == term:
+                self._offer(self._tops[position], key, label)
+            elif len(self._terms) < MAX_TERMS:
+                self._terms.insert(position, term)
+                self._tops.insert(position, self._new_top(key, label))
+        for prefix, key in prefixes.items():
+            top = self._prefix_tops.get(prefix)
+            if top is None:
+                self._prefix_tops[prefix] = self._new_top(key, label)
+            else:
+                self._offer(top, key, label)
+
+    def add(self, book_id, title, author, total_copies):
+        """
+        Adds a book, e.g. when it is added to the catalog.
+        """
+        with self._lock:
+            self._add(book_id, title, author, total_copies)
+            if self._pending is not None:
+                self._pending.append((book_id, title, author, total_copies))
+
+    def load(self, rows):
+        """
+        Replaces the index with the books in rows, an iterable of
+        (book_id, title, author, total_copies). Lookups keep using the old
+        index until the new one is complete, and books added meanwhile
+        are carried over to it.
+        """
+        with self._lock:
+            self._pending = []
+        try:
+            staging = self._build(rows)
+            with self._lock:
+                # The scan may or may not have seen these books; adding one twice is harmless
+                for book in self._pending:
+                    staging._add(*book)
+                self._terms, self._tops = staging._terms, staging._tops
+                self._prefix_tops, self._labels, self._refs = staging._prefix_tops, staging._labels, staging._refs
+                self.ready = True
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def _build(self, rows):
+        staging = TypeaheadIndex()
+        # Collect per term first and sort once, instead of inserting into the sorted list per term
+        tops = {}
+        for book_id, title, author, copies in rows:
+            best = _best_keys(book_id, title, author, copies)
+            if not best:
+                continue
+            label = _label(title, author)
+            for term, key in best.items():
+                top = tops.get(term)
+                if top is None:
+                    if len(tops) < MAX_TERMS:
+                        tops[term] = staging._new_top(key, label)
+                else:
+                    staging._offer(top, key, label)
+                for length in range(1, min(len(term), SHORT_PREFIX_LENGTH) + 1):
+                    prefix_top = staging._prefix_tops.get(term[:length])
+                    if prefix_top is None:
+                        staging._prefix_tops[term[:length]] = staging._new_top(key, label)
+                    else:
+                        staging._offer(prefix_top, key, label)
+        staging._terms = sorted(tops)
+        staging._tops = [tops[term] for term in staging._terms]
+        return staging
+
+    def suggest(self, text, limit=SUGGEST_LIMIT):
+        """
+        Suggests books for partly typed text. The last word is matched as
+        a prefix and earlier words as whole terms; books matching more of
+        the words come first, then title matches, then books with more
+        copies.
+
+        Parameters:
+        text (str): Text typed so far
+        limit (int): Maximum number of suggestions
+
+        Returns:
+        list: (book_id, label) tuples, best first
+        """
+        words = tokenize(text)
+        if not words:
+            return []
+        prefix, earlier = words[-1], words[:-1]
+        with self._lock:
+            if len(prefix) <= SHORT_PREFIX_LENGTH:
+                keys = list(self._prefix_tops.get(prefix, ()))
+            else:
+                keys = []
+                position = bisect_left(self._terms, prefix)
+                end = min(position + MAX_SCAN_TERMS, len(self._terms))
+                while position < end and self._terms[position].startswith(prefix):
+                    keys.extend(self._tops[position])
+                    position += 1
+            # Books containing an earlier word are candidates too, they may
+            # not be among the few remembered for the prefix
+            for word in earlier:
+                position = bisect_left(self._terms, word)
+                if position < len(self._terms) and self._terms[position] == word:
+                    keys.extend(self._tops[position])
+            labels = self._labels
+
+            best = {}
+            for key in keys:
+                book_id = key & _BOOK_ID_MASK
+                if key > best.get(book_id, 0):
+                    best[book_id] = key
+            ranked = []
+            for book_id, key in best.items():
+                label = labels.get(book_id)
+                if label is None:
+                    continue
+                label_words = set(tokenize(label))
+                matched = sum(1 for word in earlier if word in label_words)
+                matched += any(word.startswith(prefix) for word in label_words)
+                ranked.append((matched, key, book_id, label))
+        ranked.sort(reverse=True)
+        return [(book_id, label) for _, _, book_id, label in ranked[:limit]]
+
+    def stats(self):
+        """
+        Returns the number of terms, short prefixes, books in some
+        suggestion list and remembered suggestions.
+        """
+        with self._lock:
+            return {
+                "terms": len(self._terms),
+                "prefixes": len(self._prefix_tops),
+                "books": len(self._labels),
+                "entries": sum(len(top) for top in self._tops) + sum(len(top) for top in self._prefix_tops.values()),
+                "ready": self.ready,
+            }
+
+typeahead_index = TypeaheadIndex()
+
+def _stream_books(fetch_size):
+    with get_connection(readonly=True) as connection:
+        if not connection:
+            return
+        cursor = connection.cursor(buffered=False)
+        finished = False
+        try:
+            cursor.execute("SELECT book_id, title, author, total_copies FROM books")
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    finished = True
+                    break
+                yield from rows
+        finally:
+            if not finished and connection.unread_result:
+                connection.consume_results()
+            cursor.close()
+
+def build_typeahead_index(fetch_size=BUILD_FETCH_SIZE):
+    """
+    Builds the shared typeahead index from a streaming scan of the books
+    table, so the whole table is never held in memory at once.
+
+    Returns:
+    float: Seconds the build took
+    """
+    started = time.monotonic()
+    try:
+        typeahead_index.load(_stream_books(fetch_size))
+    except Error as err:
+        print(f"Error: {err}")
+    return time.monotonic() - started
+
+_build_thread = None
+
+def start_typeahead_build():
+    """
+    Builds the shared typeahead index on a daemon thread, once per process.
+    Suggestions are empty until it is ready.
+    """
+    global _build_thread
+    if _build_thread is None:
+        _build_thread = threading.Thread(target=build_typeahead_index, name="typeahead-build", daemon=True)
+        _build_thread.start()
+
+def suggest(text, limit=SUGGEST_LIMIT):
+    """
+    Suggests books for partly typed text from the shared typeahead index, see TypeaheadIndex.suggest.
+    """
+    return typeahead_index.suggest(text, limit)
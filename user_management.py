@@ -1,8 +1,9 @@
 # user_management.py
-from db_config import create_connection
-import mysql.connector
+from db_config import get_connection, Error
+from cache import user_fine_cache, user_id_cache
+from metrics import timed
+import event_log
 import hashlib
-from tkinter import messagebox
 def hash_password(password):
     """
     Hashes a password using SHA-256.
@@ -15,6 +16,7 @@ def hash_password(password):
     """
     return hashlib.sha256(password.encode()).hexdigest()
 
+@timed
 def register_member(username, password, role, full_name, email, phone, membership_category):
     """
     Registers a new member in the database.
@@ -29,32 +31,33 @@ def register_member(username, password, role, full_name, email, phone, membershi
     membership_category (str): The membership category of the member.
 
     Returns:
-    None
+    bool: True if the member was registered, False otherwise.
     """
     
-    connection = create_connection()
     success = False
     
-    cursor = connection.cursor()
-    hashed_password = hash_password(password)
-    query = """INSERT INTO users (username, password, role, full_name, email, phone, membership_category)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)"""
-    values = (username.lower(), hashed_password, role, full_name, email, phone, membership_category)
-
-    try:
-        cursor.execute(query, values)
-        connection.commit()
-        messagebox.showinfo("Success", "Member registered successfully.")
-        success = True
-    except mysql.connector.Error as err:
-        messagebox.showerror("Error", f"{err}")
-
-    finally:
-        cursor.close()
-        connection.close()
+    with get_connection() as connection:
+        if not connection:
+            return success
+        cursor = connection.cursor()
+        hashed_password = hash_password(password)
+        query = """INSERT INTO users (username, password, role, full_name, email, phone, membership_category)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)"""
+        values = (username.lower(), hashed_password, role, full_name, email, phone, membership_category)
+
+        try:
+            cursor.execute(query, values)
+            connection.commit()
+            success = True
+        except Error as err:
+            print(f"Error: {err}")
+
+        finally:
+            cursor.close()
     
     return success
             
+@timed
 def authenticate_user(username, password):
     """
     Authenticates a user.
@@ -66,16 +69,18 @@ def authenticate_user(username, password):
     Returns:
     dict or None: The user dictionary if authenticated, None otherwise.
     """
-    connection = create_connection()
-    cursor = connection.cursor(dictionary=True)
     hashed_password = hash_password(password)
-    query = "SELECT * FROM users WHERE username = %s AND password = %s"
-    cursor.execute(query, (username.lower(), hashed_password))
-    user = cursor.fetchone()
-    cursor.close()
-    connection.close()
+    with get_connection() as connection:
+        if not connection:
+            return None
+        cursor = connection.cursor(dictionary=True)
+        query = "SELECT * FROM users WHERE username = %s AND password = %s"
+        cursor.execute(query, (username.lower(), hashed_password))
+        user = cursor.fetchone()
+        cursor.close()
     return user
 
+@timed
 def get_user_id(username):
     """
     Returns the user ID of a user.
@@ -86,18 +91,22 @@ def get_user_id(username):
     Returns:
     int: The user ID.
     """
-    connection = create_connection()
-   
-    cursor = connection.cursor()
-    query = "SELECT user_id FROM users WHERE username = %s"
-    cursor.execute(query, (username.lower(),))  
-    result = cursor.fetchone()
-    cursor.close()
-    connection.close()
+    return user_id_cache.get_or_load(username.lower(), lambda: _load_user_id(username))
+
+def _load_user_id(username):
+    with get_connection() as connection:
+        if not connection:
+            return None
+        cursor = connection.cursor()
+        query = "SELECT user_id FROM users WHERE username = %s"
+        cursor.execute(query, (username.lower(),))  
+        result = cursor.fetchone()
+        cursor.close()
     if result:
         return result[0]
     return None
 
+@timed
 def get_user_fine(user_id):
     """
     Returns the fine amount of a user.
@@ -108,17 +117,25 @@ def get_user_fine(user_id):
     Returns:
     int: The fine amount.
     """
-    connection = create_connection()
-    cursor = connection.cursor()
-    query = "SELECT fines FROM users WHERE user_id = %s"
-    cursor.execute(query, (user_id,))
-    result = cursor.fetchone()
-    cursor.close()
-    connection.close()
+    fines = user_fine_cache.get_or_load(user_id, lambda: _load_user_fine(user_id))
+    if fines is not None:
+        return fines
+    return 0
+
+def _load_user_fine(user_id):
+    with get_connection() as connection:
+        if not connection:
+            return None
+        cursor = connection.cursor()
+        query = "SELECT fines FROM users WHERE user_id = %s"
+        cursor.execute(query, (user_id,))
+        result = cursor.fetchone()
+        cursor.close()
     if result:
         return result[0]
-    return 0
+    return None
 
+@timed
 def update_user_fine(user_id, fine_amount):
     """
     Updates the fine amount of a user.
@@ -130,10 +147,51 @@ def update_user_fine(user_id, fine_amount):
     Returns:
     None
     """
-    connection = create_connection()
-    cursor = connection.cursor()
-    query = "UPDATE users SET fines = %s WHERE user_id = %s"
-    cursor.execute(query, (fine_amount, user_id))
-    connection.commit()
-    cursor.close()
-    connection.close() 
+    with get_connection() as connection:
+        if not connection:
+            return
+        cursor = connection.cursor()
+        query = "UPDATE users SET fines = %s WHERE user_id = %s"
+        cursor.execute(query, (fine_amount, user_id))
+        connection.commit()
+        cursor.close()
+    event_log.record(event_log.FINE_SET, user_id, amount=fine_amount)
+    user_fine_cache.invalidate(user_id)
+
+@timed
+def pay_user_fine(user_id, amount):
+    """
+    Records a fine payment.
+
+    The balance is reduced with a single conditional UPDATE, so two desks
+    taking a payment at the same time cannot take the balance below zero.
+
+    Parameters:
+    user_id (int): The user ID.
+    amount (Decimal): The amount paid.
+
+    Returns:
+    The remaining fine amount, or None if the user was not found, owes less than the amount
+    or the database could not be reached.
+    """
+    with get_connection() as connection:
+        if not connection:
+            return None
+        cursor = connection.cursor()
+        try:
+            cursor.execute("UPDATE users SET fines = fines - %s WHERE user_id = %s AND fines >= %s", (amount, user_id, amount))
+            if cursor.rowcount != 1:
+                connection.rollback()
+                return None
+            cursor.execute("SELECT fines FROM users WHERE user_id = %s", (user_id,))
+            remaining = cursor.fetchone()[0]
+            connection.commit()
+        except Error as err:
+            connection.rollback()
+            print(f"Error: {err}")
+            return None
+        finally:
+            cursor.close()
+    event_log.record(event_log.FINE_PAID, user_id, amount=amount)
+    user_fine_cache.invalidate(user_id)
+    return remaining